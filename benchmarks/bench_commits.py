@@ -0,0 +1,73 @@
+#! /usr/bin/env python3
+# Compares commits per second with and without group commit (write-behind).
+# Simulates many users tapping Remove toggles at the same time.
+#
+#   python benchmarks/bench_commits.py --users 200 --taps 20
+import argparse
+import asyncio
+import os
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src'))
+
+import db  # noqa: E402
+
+
+class User():
+    def __init__(self, user_id):
+        self.user_id = user_id
+
+
+async def setup(database, users):
+    products = [{
+        "Title": "Product", "Isin": "NL0000000001", "Market": None, "Bid": 1.0, "Ask": 1.1,
+        "Day": 0.0, "Lever": 2.0, "Stoploss": 0.5, "Stoploss_dist": 50.0, "Reference": 1.0,
+    }]
+    await database.upsert_markets(products)
+    for user in users:
+        await database.new_user(user)
+        await database.insert_to_database(user, "client_markets", products)
+
+
+async def tap(database, user, taps):
+    for index in range(taps):
+        await database.update_database(user, "client_markets", {"NL0000000001": index % 2})
+
+
+async def run(write_behind, users, taps):
+    with tempfile.TemporaryDirectory() as project_dir:
+        database = db.Database(project_dir, write_behind=write_behind)
+        await database._init()
+        await database.create_database()
+
+        clients = [User(index) for index in range(users)]
+        await setup(database, clients)
+        commits = database.commits
+
+        started = time.perf_counter()
+        await asyncio.gather(*[tap(database, user, taps) for user in clients])
+        await database.flush()
+        elapsed = time.perf_counter() - started
+        commits = database.commits - commits
+
+        await database._close()
+
+    writes = users * taps
+    print("%-13s %6d writes  %6d commits  %8.3f s  %9.0f writes/s  %7.0f commits/s" % (
+        "group commit" if write_behind else "per write", writes, commits, elapsed,
+        writes / elapsed, commits / elapsed))
+
+
+async def main(users, taps):
+    await run(False, users, taps)
+    await run(True, users, taps)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Group commit benchmark")
+    parser.add_argument("--users", type=int, default=200)
+    parser.add_argument("--taps", type=int, default=20)
+    args = parser.parse_args()
+    asyncio.run(main(args.users, args.taps))
@@ -0,0 +1,82 @@
+#! /usr/bin/env python3
+# Measures Markets write throughput of db.Database.
+# Compares the old one-formatted-UPDATE-per-row path against the bulk upsert.
+#
+#   python benchmarks/bench_db.py --rows 10000
+import argparse
+import asyncio
+import os
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src'))
+
+import db  # noqa: E402
+
+
+def make_products(rows):
+    products = []
+    for index in range(rows):
+        products.append({
+            "Title": "Product %d" % index,
+            "Isin": "NL%010d" % index,
+            "Market": "/onderliggende-waarden/product-%d" % index,
+            "Type": "Long",
+            "Bid": index / 100,
+            "Ask": index / 100 + 0.01,
+            "Day": 0.5,
+            "Lever": 3.0,
+            "Stoploss": 10.0,
+            "Stoploss_dist": -5.0,
+            "Reference": 12.0,
+            "Ended": 0,
+        })
+    return products
+
+
+async def legacy_update(database, products):
+    # The previous implementation: one formatted statement and one trip per row
+    for item in products:
+        await database.conn.execute(
+            """
+            UPDATE Markets SET Title="{Title}", Market_url="{Market_url}", Bid="{Bid}", Ask="{Ask}", Day="{Day}", Lever="{Lever}", Stoploss="{Stoploss}", Stoploss_dist="{Stoploss_dist}", Reference="{Reference}", Ended="{Ended}" WHERE Isin="{Isin}"
+            """
+            .format(Market_url=item['Market'], **item)
+        )
+    await database._commit()
+
+
+async def run(rows):
+    with tempfile.TemporaryDirectory() as project_dir:
+        database = db.Database(project_dir)
+        await database._init()
+        await database.create_database()
+
+        products = make_products(rows)
+
+        started = time.perf_counter()
+        await database.upsert_markets(products)
+        insert = time.perf_counter() - started
+
+        started = time.perf_counter()
+        await legacy_update(database, products)
+        legacy = time.perf_counter() - started
+
+        started = time.perf_counter()
+        await database.upsert_markets(products[:rows // 2], products[rows // 2:])
+        upsert = time.perf_counter() - started
+
+        await database._close()
+
+    print("rows:                 %d" % rows)
+    print("bulk insert:          %8.3f s  %10.0f rows/s" % (insert, rows / insert))
+    print("legacy update:        %8.3f s  %10.0f rows/s" % (legacy, rows / legacy))
+    print("bulk upsert + ended:  %8.3f s  %10.0f rows/s" % (upsert, rows / upsert))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Markets write throughput")
+    parser.add_argument("--rows", type=int, default=10000)
+    args = parser.parse_args()
+    asyncio.run(run(args.rows))
@@ -0,0 +1,103 @@
+#! /usr/bin/env python3
+# Read latency while a large Markets update is running, with and without
+# the pool of read-only connections.
+#
+#   python benchmarks/bench_readers.py --users 100 --products 20000 --readers 4
+import argparse
+import asyncio
+import os
+import statistics
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src'))
+
+import db  # noqa: E402
+
+
+class User():
+    def __init__(self, user_id):
+        self.user_id = user_id
+
+
+def product(index):
+    return {
+        "Title": "Product %06d" % index, "Isin": "NL%010d" % index, "Market": None, "Bid": 1.0, "Ask": 1.1,
+        "Day": 0.0, "Lever": 2.0, "Stoploss": 0.5, "Stoploss_dist": 50.0, "Reference": 1.0,
+    }
+
+
+async def setup(database, users, products):
+    await database.upsert_markets(products)
+    for index, user in enumerate(users):
+        await database.new_user(user)
+        await database.insert_to_database(user, "client_markets", products[index * 10:index * 10 + 10])
+
+
+async def sample(database, users, stop):
+    # Render list pages round-robin until the write is done
+    latencies = []
+    index = 0
+    while not stop.is_set():
+        user = users[index % len(users)]
+        started = time.perf_counter()
+        await database.read_portfolio(user, 0, 10)
+        latencies.append(time.perf_counter() - started)
+        index += 1
+    return latencies
+
+
+async def run(readers, users, count):
+    with tempfile.TemporaryDirectory() as project_dir:
+        database = db.Database(project_dir, readers=readers)
+        await database._init()
+        try:
+            await database.create_database()
+
+            clients = [User(index) for index in range(users)]
+            products = [product(index) for index in range(count)]
+            await setup(database, clients, products)
+
+            # Idle baseline
+            stop = asyncio.Event()
+            reads = asyncio.create_task(sample(database, clients, stop))
+            await asyncio.sleep(0.5)
+            stop.set()
+            idle = await reads
+
+            # While the whole table is rewritten in one transaction
+            stop = asyncio.Event()
+            reads = asyncio.create_task(sample(database, clients, stop))
+            started = time.perf_counter()
+            for item in products:
+                item["Bid"] += 0.01
+            await database.upsert_markets(products)
+            elapsed = time.perf_counter() - started
+            stop.set()
+            busy = await reads
+        finally:
+            await database._close()
+
+    for name, latencies in (("idle", idle), ("during write", busy)):
+        latencies.sort()
+        print("readers=%d %-13s %6d reads  p50 %7.2f ms  p95 %7.2f ms  max %8.2f ms" % (
+            readers, name, len(latencies),
+            statistics.median(latencies) * 1000,
+            latencies[int(len(latencies) * 0.95)] * 1000,
+            latencies[-1] * 1000))
+    print("readers=%d write of %d products took %.3f s" % (readers, count, elapsed))
+
+
+async def main(users, products, readers):
+    await run(0, users, products)
+    await run(readers, users, products)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Reader pool benchmark")
+    parser.add_argument("--users", type=int, default=100)
+    parser.add_argument("--products", type=int, default=20000)
+    parser.add_argument("--readers", type=int, default=4)
+    args = parser.parse_args()
+    asyncio.run(main(args.users, args.products, args.readers))
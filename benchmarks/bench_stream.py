@@ -0,0 +1,103 @@
+#! /usr/bin/env python3
+# Full reads versus FETCH_STREAMING on the load harness' ING Markets stand-in.
+# Fetches and parses the same products in both modes and reports the bytes read
+# per page and the time until the fields were available.
+#
+#   python benchmarks/bench_stream.py --products 200 --padding 300 --bandwidth 2000
+import argparse
+import asyncio
+import json
+import os
+import statistics
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src'))
+
+import settings  # noqa: E402
+import webscraper  # noqa: E402
+from load_harness import StandIn  # noqa: E402
+
+MODES = (("full", False), ("stream", True))
+
+
+async def fetch_all(isin_list):
+    # (bytes, seconds until the fields were read, seconds until parsed) per page
+    async def one(isin):
+        started = time.perf_counter()
+        status, page, etag, last_modified = await webscraper.fetchProduct(isin)
+        fields = time.perf_counter() - started
+        size = page.bytes if settings.FETCH_STREAMING else len(page.encode("utf-8"))
+        await webscraper.parseProduct(isin, status, page, etag, last_modified)
+        return size, fields, time.perf_counter() - started
+
+    return await webscraper.Scheduler.gather([one(isin) for isin in isin_list])
+
+
+def summary(pages, elapsed):
+    sizes, fields, parsed = zip(*pages)
+    fields, parsed = sorted(fields), sorted(parsed)
+    return {
+        "pages": len(pages),
+        "elapsed_s": elapsed,
+        "bytes_per_page": statistics.mean(sizes),
+        "fields_p50_ms": statistics.median(fields) * 1000,
+        "fields_p95_ms": fields[int(len(fields) * 0.95)] * 1000,
+        "parsed_p50_ms": statistics.median(parsed) * 1000,
+        "parsed_p95_ms": parsed[int(len(parsed) * 0.95)] * 1000,
+    }
+
+
+async def run(args):
+    stand_in = StandIn(
+        args.latency, 0, 0, args.ended, args.seed, padding=args.padding, bandwidth=args.bandwidth)
+    settings.ING_BASE_URL = await stand_in.start("127.0.0.1", 0)
+    settings.FETCH_RATE = settings.FETCH_BURST = 1e6
+    isin_list = ["NL%010d" % index for index in range(args.products)]
+
+    results = {}
+    await webscraper.Session._init()
+    webscraper.Parser._init()
+    try:
+        await fetch_all(isin_list[:settings.FETCH_CONCURRENCY_PER_HOST])  # Warm up the connections and workers
+        for mode, streaming in MODES:
+            settings.FETCH_STREAMING = streaming
+            webscraper.Changes.entries.clear()
+            stand_in.requests.clear()
+
+            started = time.perf_counter()
+            pages = await fetch_all(isin_list)
+            elapsed = time.perf_counter() - started
+
+            failed = [page for page in pages if isinstance(page, Exception)]
+            results[mode] = summary([page for page in pages if not isinstance(page, Exception)], elapsed)
+            results[mode]["failed"] = len(failed)
+            results[mode]["server"] = dict(stand_in.requests)
+    finally:
+        await webscraper.Session._close()
+        webscraper.Parser._close()
+        await stand_in.stop()
+    return results
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Full reads versus streaming of product pages")
+    parser.add_argument("--products", type=int, default=200)
+    parser.add_argument("--padding", type=int, default=300, help="KB of scripts after the product details")
+    parser.add_argument("--bandwidth", type=float, default=2000, help="Send rate in KB/s per page, 0 is unlimited")
+    parser.add_argument("--latency", type=float, default=20, help="Stand-in response time in ms")
+    parser.add_argument("--ended", type=float, default=0.05, help="Fraction of Beëindigd products")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--output", help="Also write the results to this JSON file")
+    args = parser.parse_args()
+
+    results = asyncio.run(run(args))
+    print("%-8s %7s %12s %10s %10s %10s %10s" % (
+        "mode", "pages", "bytes/page", "fields p50", "fields p95", "parsed p50", "parsed p95"))
+    for mode, result in results.items():
+        print("%-8s %7d %12.0f %10.2f %10.2f %10.2f %10.2f" % (
+            mode, result["pages"], result["bytes_per_page"], result["fields_p50_ms"], result["fields_p95_ms"],
+            result["parsed_p50_ms"], result["parsed_p95_ms"]))
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2)
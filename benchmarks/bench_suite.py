@@ -0,0 +1,323 @@
+#! /usr/bin/env python3
+# Offline benchmarks of the scrape, parse and render hot paths.
+# Uses the synthetic product pages in benchmarks/fixtures, padded to the size of a
+# real page (--page-kb), no network needed. See benchmarks/fixtures/README.md.
+# Writes the results as JSON, compare two runs with --compare.
+#
+#   python benchmarks/bench_suite.py --output before.json
+#   python benchmarks/bench_suite.py --output after.json --compare before.json
+import argparse
+import asyncio
+import json
+import os
+import platform
+import re
+import statistics
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src'))
+
+import settings  # noqa: E402
+import db  # noqa: E402
+import parsing  # noqa: E402
+import webscraper  # noqa: E402
+import main  # noqa: E402
+
+FIXTURES = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'fixtures')
+PAGES = ("active", "ended", "malformed")
+
+# Markup around the product details of a real page: navigation, inline scripts and the footer
+NAV_ITEM = '<li class="nav__item"><a class="nav__link" href="/producten/categorie-{0}">Categorie {0}</a></li>\n'
+SCRIPT = '<script type="application/json" data-component="chart-{0}">{{"id": {0}, "series": [{1}]}}</script>\n'
+FOOTER_ITEM = (
+    '<div class="footer__column"><p class="footer__text">Aan de informatie op deze pagina {0} kunnen geen '
+    'rechten worden ontleend.</p><a class="footer__link" href="/over-ons/{0}">Over ons</a></div>\n')
+
+NUMBERS = ("1.234,56", "€\xa0512,30", "€ 628,10", "4,12", "-0,5", "n/a")
+PERCENTAGES = ("2,51 %", "-18,40%", "0,00 %", "12%", "-")
+
+
+class User():
+    def __init__(self, user_id):
+        self.user_id = user_id
+
+
+def load_fixtures(page_kb):
+    pages = {}
+    for name in PAGES:
+        with open(os.path.join(FIXTURES, name + ".html"), encoding="utf-8") as f:
+            pages[name] = pad(f.read(), page_kb)
+    return pages
+
+
+def boilerplate(size, item):
+    # At least size bytes of item markup, with a script every ten items
+    parts = []
+    length = 0
+    index = 0
+    while length < size:
+        part = item.format(index)
+        if index % 10 == 9:
+            part += SCRIPT.format(index, ", ".join("%d.%02d" % (index, step) for step in range(40)))
+        parts.append(part)
+        length += len(part)
+        index += 1
+    return "".join(parts)
+
+
+def pad(html, page_kb):
+    # Grow a fixture to about page_kb KB: navigation before the product details, footer after them
+    size = page_kb * 1024 - len(html)
+    if size <= 0:
+        return html
+    nav = '<nav class="nav"><ul>\n%s</ul></nav>\n' % boilerplate(size * 3 // 5, NAV_ITEM)
+    footer = '<footer class="footer">\n%s</footer>\n' % boilerplate(size * 2 // 5, FOOTER_ITEM)
+
+    body = re.search(r"<body[^>]*>", html)
+    start = body.end() if body else 0
+    end = html.rfind("</body>")
+    if end < start:
+        end = len(html)
+    return html[:start] + nav + html[start:end] + footer + html[end:]
+
+
+def summary(samples, unit=1):
+    # samples: seconds per call, unit: operations per call
+    samples = sorted(samples)
+    return {
+        "runs": len(samples),
+        "mean_ms": statistics.mean(samples) * 1000,
+        "p50_ms": statistics.median(samples) * 1000,
+        "p95_ms": samples[int(len(samples) * 0.95)] * 1000,
+        "ops_per_s": unit * len(samples) / sum(samples) if sum(samples) else 0.0,
+    }
+
+
+def measure(function, runs, *args):
+    samples = []
+    for _ in range(runs):
+        started = time.perf_counter()
+        function(*args)
+        samples.append(time.perf_counter() - started)
+    return samples
+
+
+async def measure_async(function, runs, *args):
+    samples = []
+    for _ in range(runs):
+        started = time.perf_counter()
+        await function(*args)
+        samples.append(time.perf_counter() - started)
+    return samples
+
+
+def bench_parse(pages, runs):
+    results = {}
+    for name, html in pages.items():
+        results["parse.bs4." + name] = summary(measure(parsing.parse_product_page_bs4, runs, name, html))
+        results["parse.lxml." + name] = summary(measure(parsing.parse_product_page_lxml, runs, name, html))
+        results["fingerprint." + name] = summary(measure(parsing.performance_fingerprint, runs, html))
+    return results
+
+
+def bench_numbers(runs):
+    def numbers():
+        for raw in NUMBERS:
+            parsing.parse_number(raw)
+
+    def percentages():
+        for raw in PERCENTAGES:
+            parsing.parse_percent(raw)
+
+    return {
+        "parse_number": summary(measure(numbers, runs), len(NUMBERS)),
+        "parse_percent": summary(measure(percentages, runs), len(PERCENTAGES)),
+    }
+
+
+def bench_render(pages, runs):
+    available, data = parsing.parse_product_page_lxml("NL0000000001", pages["active"])
+    row = db.PortfolioRow(
+        data["Title"], data["Isin"], data["Market"], data["Type"], data["Bid"], data["Ask"], data["Day"],
+        data["Lever"], data["Stoploss"], data["Stoploss_dist"], data["Reference"], 0, time.time(), time.time(), 0)
+    empty = row._replace(**dict.fromkeys(parsing.Quote._fields))
+    user_settings = dict.fromkeys(db.SETTINGS_COLUMNS, 1)
+
+    return {
+        "generate_message.quote": summary(measure(main.generate_message, runs, row, user_settings)),
+        "generate_message.empty": summary(measure(main.generate_message, runs, empty, user_settings)),
+    }
+
+
+async def bench_scrape(pages, runs, batch):
+    # getProductDataHTML with the HTTP fetch replaced by the fixtures
+    isin_list = ["NL%010d" % index for index in range(batch)]
+    names = dict(zip(isin_list, [PAGES[index % len(PAGES)] for index in range(batch)]))
+
+    async def fetch_fixture(isin):
+        return 200, pages[names[isin]], None, None
+
+    async def cold():
+        webscraper.Quotes.entries.clear()
+        webscraper.Changes.entries.clear()
+        await webscraper.getProductDataHTML(isin_list)
+
+    async def unchanged():
+        # Fetched again, but the Performance blocks did not change
+        webscraper.Quotes.entries.clear()
+        await webscraper.getProductDataHTML(isin_list)
+
+    fetch_product = webscraper.fetchProduct
+    webscraper.fetchProduct = fetch_fixture
+    try:
+        webscraper.Parser._init()
+        await cold()  # Start the workers
+        results = {
+            "getProductDataHTML.cold": summary(await measure_async(cold, runs), batch),
+            "getProductDataHTML.unchanged": summary(await measure_async(unchanged, runs), batch),
+            "getProductDataHTML.cached": summary(
+                await measure_async(webscraper.getProductDataHTML, runs, isin_list), batch),
+        }
+    finally:
+        webscraper.fetchProduct = fetch_product
+        webscraper.Parser._close()
+        webscraper.Quotes.entries.clear()
+        webscraper.Changes.entries.clear()
+
+    results["getProductDataHTML.cold"]["executor"] = settings.PARSER_EXECUTOR
+    return results
+
+
+def product(index):
+    return {
+        "Title": "Product %07d" % index, "Isin": "NL%010d" % index, "Market": None, "Type": "Long",
+        "Bid": index / 100, "Ask": index / 100 + 0.01, "Day": 0.5, "Lever": 3.0,
+        "Stoploss": 10.0, "Stoploss_dist": -5.0, "Reference": 12.0,
+    }
+
+
+async def bench_database(size, runs):
+    # size products, tracked by users of 10 products each
+    per_user = 10
+    products = [product(index) for index in range(size)]
+    users = [User(index) for index in range(max(1, size // per_user))]
+
+    with tempfile.TemporaryDirectory() as project_dir:
+        database = db.Database(project_dir)
+        await database._init()
+        try:
+            await database.create_database()
+            await database.upsert_markets(products)
+            for index, user in enumerate(users):
+                await database.new_user(user, durable=False)
+                await database.insert_to_database(
+                    user, "client_markets", products[index * per_user:(index + 1) * per_user], durable=False)
+            await database.flush()
+            await database.load_market_index()
+
+            user = users[len(users) // 2]
+            isin = products[len(users) // 2 * per_user]["Isin"]
+            batch = products[:50]
+            toggle = [0]
+
+            async def read_page():
+                await database.read_portfolio(user, 0, main.list_paging)
+
+            async def read_settings():
+                database.settings_cache.invalidate(user.user_id)
+                await database.read_database(user, "Settings")
+
+            async def mark():
+                toggle[0] ^= 1
+                await database.update_database(user, "client_markets", {isin: toggle[0]})
+
+            async def upsert():
+                for item in batch:
+                    item["Bid"] += 0.01
+                await database.upsert_markets(batch)
+
+            async def upsert_unchanged():
+                await database.upsert_markets(batch)
+
+            def lookup():
+                # Keystrokes of an inline query
+                for query in ("p", "pr", "product 00", isin[:4], isin):
+                    database.market_index.lookup(query, settings.INLINE_RESULTS)
+
+            prefix = "db.%d." % size
+            return {
+                prefix + "market_index.lookup": summary(measure(lookup, runs), 5),
+                prefix + "read_portfolio": summary(await measure_async(read_page, runs)),
+                prefix + "read_settings": summary(await measure_async(read_settings, runs)),
+                prefix + "read_tracked_isins": summary(
+                    await measure_async(database.read_tracked_isins, max(1, runs // 10))),
+                prefix + "update_database": summary(await measure_async(mark, runs)),
+                prefix + "upsert_markets.50": summary(await measure_async(upsert, runs), len(batch)),
+                prefix + "upsert_markets.50.unchanged": summary(
+                    await measure_async(upsert_unchanged, runs), len(batch)),
+            }
+        finally:
+            await database._close()
+
+
+def compare(results, baseline, threshold):
+    # Benchmarks whose p50 got more than threshold slower
+    regressions = []
+    for name, result in results["benchmarks"].items():
+        before = baseline["benchmarks"].get(name)
+        if before is None or not before["p50_ms"]:
+            continue
+        ratio = result["p50_ms"] / before["p50_ms"]
+        print("%-42s %10.4f ms -> %10.4f ms  %+7.1f%%" % (name, before["p50_ms"], result["p50_ms"], (ratio - 1) * 100))
+        if ratio > 1 + threshold:
+            regressions.append(name)
+    return regressions
+
+
+async def run(args):
+    pages = load_fixtures(args.page_kb)
+    benchmarks = {}
+    benchmarks.update(bench_parse(pages, args.runs))
+    benchmarks.update(bench_numbers(args.runs))
+    benchmarks.update(bench_render(pages, args.runs))
+    benchmarks.update(await bench_scrape(pages, max(1, args.runs // 10), args.batch))
+    for size in args.sizes:
+        benchmarks.update(await bench_database(size, args.runs))
+
+    return {
+        "created": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "parser_engine": settings.PARSER_ENGINE,
+        "page_kb": {name: round(len(html.encode("utf-8")) / 1024, 1) for name, html in pages.items()},
+        "benchmarks": benchmarks,
+    }
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Offline benchmark suite")
+    parser.add_argument("--runs", type=int, default=200, help="Calls per benchmark")
+    parser.add_argument("--batch", type=int, default=50, help="Products per getProductDataHTML call")
+    parser.add_argument("--page-kb", type=int, default=120, help="Pad the fixtures to this size, 0 keeps them as they are")
+    parser.add_argument("--sizes", type=int, nargs="+", default=[10, 1000, 100000], help="Tracked products")
+    parser.add_argument("--output", help="Write the results to this JSON file instead of stdout")
+    parser.add_argument("--compare", help="Results of an earlier run")
+    parser.add_argument("--threshold", type=float, default=0.2, help="Allowed slowdown of p50, 0.2 is 20%%")
+    args = parser.parse_args()
+
+    results = asyncio.run(run(args))
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2)
+    else:
+        print(json.dumps(results, indent=2))
+
+    if args.compare:
+        with open(args.compare) as f:
+            regressions = compare(results, json.load(f), args.threshold)
+        if regressions:
+            print("Slower than the baseline: " + ", ".join(regressions))
+            raise SystemExit(1)
@@ -0,0 +1,573 @@
+#! /usr/bin/env python3
+# End-to-end load test of the bot's handlers without Telegram or ingmarkets.nl.
+# Starts a local stand-in for ING Markets that serves synthetic product pages,
+# then drives the handlers registered by main.main() with fake events for many
+# simulated users. Reports handler latency, scrape fan-out and DB contention.
+#
+#   python benchmarks/load_harness.py --users 2000 --latency 80 --error-rate 0.02 --ended 0.05
+#
+# Only the stand-in server, for running the real bot against it:
+#   python benchmarks/load_harness.py --serve --port 8765
+#
+# With --service the scraping runs in a quote service process, see quoteservice.py
+import argparse
+import asyncio
+import json
+import multiprocessing
+import os
+import random
+import signal
+import statistics
+import sys
+import tempfile
+import time
+from collections import defaultdict, deque
+
+from aiohttp import web
+from telethon import TelegramClient, events, types
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src'))
+
+import settings  # noqa: E402
+import db  # noqa: E402
+import webscraper  # noqa: E402
+import providers  # noqa: E402
+import quoteservice  # noqa: E402
+import main  # noqa: E402
+
+PRODUCT_PAGE = """<!DOCTYPE html>
+<html lang="nl"><head><meta charset="utf-8"><title>{title}</title></head>
+<body>
+<header><h1>ING Markets</h1></header>
+<main>
+<h1>{title} <span>{isin}</span></h1>
+<dl class="product-details">
+  <dt>Onderliggende waarde</dt>
+  <dd><a href="/onderliggende-waarden/{slug}">{underlying}</a></dd>
+  <dt>Positie</dt>
+  <dd>{position}</dd>
+</dl>
+<div class="performance" aria-label="Performance">
+  <dl>
+    <dt>Bied <span class="info">i</span></dt><dd><span class="value">{bid}</span></dd>
+    <dt>Laat</dt><dd><span class="value">{ask}</span></dd>
+    <dt>% 1 Dag</dt><dd><span class="value">{day} %</span></dd>
+    <dt>Hefboom</dt><dd><span class="value">{lever}</span></dd>
+    <dt>Stop-loss niveau</dt><dd><span class="value">€&nbsp;{stoploss}</span></dd>
+    <dt>Afstand tot stop loss-niveau</dt><dd><span class="value">{dist}%</span></dd>
+    <dt>Referentiekoers*</dt><dd><span class="value">€ {reference}</span></dd>
+  </dl>
+</div>
+</main>{padding}</body></html>
+"""
+
+ENDED_PAGE = """<!DOCTYPE html><html><head><meta charset="utf-8"></head><body>
+<h1>ING Markets</h1><h1>Beëindigd</h1><p>Dit product is beëindigd.</p></body></html>
+"""
+
+
+# Scripts and footer after the product details, like on the real pages
+PADDING = "<script>/* %s */</script>\n"
+
+
+def dutch(value):
+    return ("%.2f" % value).replace(".", ",")
+
+
+#############################################
+# ING Markets stand-in
+#############################################
+
+class StandIn():
+    # Synthetic /producten/<isin> pages with configurable latency, errors and ended products
+    def __init__(self, latency, jitter, error_rate, ended, seed, etag=False, padding=0, bandwidth=0):
+        self.etag = etag
+        self.padding = PADDING % ("x" * max(0, padding * 1024 - len(PADDING))) if padding else ""
+        self.bandwidth = bandwidth
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.ended = ended
+        self.random = random.Random(seed)
+        self.seed = seed
+        self.requests = defaultdict(int)
+        self.runner = None
+
+    def is_ended(self, isin):
+        return random.Random("%s-%s" % (self.seed, isin)).random() < self.ended
+
+    def page(self, isin):
+        if self.is_ended(isin):
+            return ENDED_PAGE
+
+        rng = random.Random("%s-%s" % (self.seed, isin))
+        bid = rng.uniform(0.5, 2000)
+        underlying = "Underlying %s" % isin[-4:]
+        return PRODUCT_PAGE.format(
+            title="Sprinter %s" % isin, isin=isin, slug=underlying.lower().replace(" ", "-"),
+            underlying=underlying, position=rng.choice(("Long", "Short")),
+            bid=dutch(bid), ask=dutch(bid * 1.002), day=dutch(rng.uniform(-10, 10)),
+            lever=dutch(rng.uniform(1, 20)), stoploss=dutch(bid * 0.8), dist=dutch(rng.uniform(-30, 0)),
+            reference=dutch(bid * 1.1), padding=self.padding)
+
+    async def delay(self):
+        if self.latency or self.jitter:
+            await asyncio.sleep(max(0.0, self.latency + self.random.uniform(-self.jitter, self.jitter)) / 1000)
+
+    async def product(self, request):
+        self.requests["product"] += 1
+        await self.delay()
+        if self.random.random() < self.error_rate:
+            self.requests["error"] += 1
+            return web.Response(status=503, text="Service Unavailable")
+
+        isin = request.match_info["isin"].upper()
+        if not isin[:2] in ("NL", "DE") or len(isin) != 12:
+            self.requests["not_found"] += 1
+            return web.Response(status=404, text="Not Found")
+        if self.is_ended(isin):
+            self.requests["ended"] += 1
+
+        headers = {}
+        if self.etag:
+            # Pages never change, so the validator only depends on the ISIN
+            headers["ETag"] = '"%s-%s"' % (self.seed, isin)
+            if request.headers.get("If-None-Match") == headers["ETag"]:
+                self.requests["not_modified"] += 1
+                return web.Response(status=304, headers=headers)
+        if not self.bandwidth:
+            return web.Response(text=self.page(isin), content_type="text/html", headers=headers)
+
+        # Send the page at `bandwidth` KB/s, in 4 KB writes
+        body = self.page(isin).encode("utf-8")
+        response = web.StreamResponse(headers=headers)
+        response.content_type = "text/html"
+        response.charset = "utf-8"
+        response.content_length = len(body)
+        await response.prepare(request)
+        try:
+            for index in range(0, len(body), 4096):
+                await response.write(body[index:index + 4096])
+                await asyncio.sleep(4096 / (self.bandwidth * 1024))
+            await response.write_eof()
+        except ConnectionResetError:
+            # The client stopped reading, see FETCH_STREAMING
+            self.requests["aborted"] += 1
+        return response
+
+    async def disclaimer(self, request):
+        self.requests["disclaimer"] += 1
+        await self.delay()
+        response = web.Response(text="ok")
+        response.set_cookie("disclaimer", "true", max_age=settings.ING_DISCLAIMER_TTL)
+        return response
+
+    async def start(self, host, port):
+        app = web.Application()
+        app.router.add_get("/producten/{isin}", self.product)
+        app.router.add_post("/disclaimer", self.disclaimer)
+        self.runner = web.AppRunner(app, access_log=None)
+        await self.runner.setup()
+        site = web.TCPSite(self.runner, host, port)
+        await site.start()
+        return "http://%s:%d" % self.runner.addresses[0][:2]
+
+    async def stop(self):
+        await self.runner.cleanup()
+
+
+#############################################
+# Fake Telegram
+#############################################
+
+class FakeMessage():
+    def __init__(self, text):
+        self.text = text
+        self.document = None
+        self.file = None
+
+
+class FakeConversation():
+    # Answers with what the simulated user queued up, like a user typing a reply
+    def __init__(self, client, user_id):
+        self.client = client
+        self.user_id = user_id
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *args):
+        pass
+
+    async def send_message(self, message, **kwargs):
+        return await self.client.send_message(self.user_id, message, **kwargs)
+
+    async def get_response(self, timeout=None):
+        return FakeMessage(self.client.answers[self.user_id].popleft())
+
+    async def cancel_all(self):
+        self.client.answers[self.user_id].clear()
+
+
+class FakeAction():
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *args):
+        pass
+
+
+class FakeClient():
+    # The parts of TelegramClient the handlers use, every API call costs `latency` ms
+    build_reply_markup = staticmethod(TelegramClient.build_reply_markup)
+
+    def __init__(self, latency):
+        self.latency = latency
+        self.answers = defaultdict(deque)
+        self.api_calls = 0
+
+    async def call(self):
+        self.api_calls += 1
+        if self.latency:
+            await asyncio.sleep(self.latency / 1000)
+
+    async def send_message(self, user_id, message, **kwargs):
+        await self.call()
+        return FakeMessage(message)
+
+    async def edit_message(self, message, text, **kwargs):
+        await self.call()
+        return FakeMessage(text)
+
+    def conversation(self, user_id):
+        return FakeConversation(self, user_id)
+
+    def action(self, user_id, action):
+        return FakeAction()
+
+
+class FakeBuilder():
+    async def article(self, title, description=None, **kwargs):
+        return title, description, kwargs
+
+
+class FakeEvent():
+    def __init__(self, client, sender, text=None, data=None):
+        self.client = client
+        self.sender = sender
+        self.text = text
+        self.raw_text = text
+        self.data = data
+        self.builder = FakeBuilder()
+        # Inline queries are typed in the bot's own chat
+        self.query = types.UpdateBotInlineQuery(
+            0, sender.id, text or "", "", peer_type=types.InlineQueryPeerTypeSameBotPM())
+
+    async def get_sender(self):
+        return self.sender
+
+    async def reply(self, message, **kwargs):
+        await self.client.call()
+
+    async def edit(self, message, **kwargs):
+        await self.client.call()
+
+    async def answer(self, results=None, *args, **kwargs):
+        if isinstance(results, list):
+            # Inline query results, built like Telethon does
+            await asyncio.gather(*results)
+        await self.client.call()
+
+
+#############################################
+# Driver
+#############################################
+
+class Driver():
+    # Routes fake messages and button taps to the handlers whose pattern matches,
+    # the way Telethon dispatches updates
+    def __init__(self, client, handlers):
+        self.client = client
+        self.handlers = [(handler, events._get_handlers(handler)[0]) for handler in handlers]
+        self.latencies = defaultdict(list)
+        self.errors = defaultdict(int)
+
+    async def run_handlers(self, sender, matches, **kwargs):
+        for handler in matches:
+            event = FakeEvent(self.client, sender, **kwargs)
+            started = time.perf_counter()
+            try:
+                await handler(event)
+            except Exception as e:
+                self.errors[handler.__name__] += 1
+                if self.errors[handler.__name__] <= 3:
+                    main.logger.error("%s failed: %r" % (handler.__name__, e))
+            self.latencies[handler.__name__].append(time.perf_counter() - started)
+
+    async def message(self, sender, text):
+        matches = [handler for handler, builder in self.handlers
+                   if isinstance(builder, events.NewMessage) and builder.pattern(text)]
+        await self.run_handlers(sender, matches, text=text)
+
+    async def inline(self, sender, text):
+        matches = [handler for handler, builder in self.handlers if isinstance(builder, events.InlineQuery)]
+        await self.run_handlers(sender, matches, text=text)
+
+    async def tap(self, sender, data):
+        data = data.encode("utf-8")
+        matches = [handler for handler, builder in self.handlers
+                   if isinstance(builder, events.CallbackQuery) and builder.match(data)]
+        await self.run_handlers(sender, matches, data=data)
+
+
+async def simulate_user(driver, user_id, universe, args):
+    sender = types.User(id=user_id, access_hash=user_id * 7919, first_name="User %d" % user_id, bot=False)
+    rng = random.Random(user_id)
+
+    async def think():
+        if args.think:
+            await asyncio.sleep(rng.uniform(0, args.think) / 1000)
+
+    await driver.message(sender, "/start")
+
+    products = rng.sample(universe, args.products_per_user)
+    for isin in products:
+        await think()
+        driver.client.answers[user_id].append(isin)
+        await driver.message(sender, "Track")
+
+    if args.import_size:
+        # Bulk Track with a pasted list
+        driver.client.answers[user_id].append("\n".join(rng.sample(universe, args.import_size)))
+        await driver.message(sender, "Track")
+
+    # Search a product inline, one query per keystroke
+    query = rng.choice(products)
+    for length in range(1, args.inline_keystrokes + 1):
+        await driver.inline(sender, query[:length])
+
+    for _ in range(args.rounds):
+        await think()
+        await driver.message(sender, "List")
+        await driver.tap(sender, "2_List")
+
+        await think()
+        await driver.message(sender, "Settings")
+        await driver.tap(sender, "1_Settings_%s_%d" % (rng.choice(db.SETTINGS_COLUMNS), rng.randint(0, 1)))
+
+        await think()
+        await driver.message(sender, "Remove")
+        await driver.tap(sender, "1_Remove_%s" % rng.choice(products))
+        await driver.tap(sender, "Cancel_del")
+
+
+async def monitor(database, samples, interval):
+    # Sample how busy the writer and the reader pool are
+    while True:
+        samples["samples"] += 1
+        if database.write_lock is not None and database.write_lock.locked():
+            samples["writer_busy"] += 1
+        if database.readers and database.reader_pool.empty():
+            samples["readers_exhausted"] += 1
+        samples["write_queue_max"] = max(samples["write_queue_max"], database.write_stats()["queued"])
+        await asyncio.sleep(interval)
+
+
+def percentiles(latencies):
+    latencies = sorted(latencies)
+    pick = lambda q: latencies[min(len(latencies) - 1, int(len(latencies) * q))] * 1000  # noqa: E731
+    return {
+        "calls": len(latencies),
+        "p50_ms": statistics.median(latencies) * 1000,
+        "p95_ms": pick(0.95),
+        "p99_ms": pick(0.99),
+        "max_ms": latencies[-1] * 1000,
+    }
+
+
+async def run(args):
+    stand_in = StandIn(
+        args.latency, args.jitter, args.error_rate, args.ended, args.seed, args.etag, args.padding, args.bandwidth)
+    settings.ING_BASE_URL = await stand_in.start(args.host, args.port)
+    settings.FETCH_STREAMING = args.stream
+    if args.fetch_rate:
+        settings.FETCH_RATE = args.fetch_rate
+        settings.FETCH_BURST = args.fetch_rate
+
+    # A --fake share of the products is served by providers.FakeProvider, in bulk
+    fake = int(args.universe * args.fake)
+    if fake:
+        providers.enable(("ing", "fake"))
+    universe = ["XX%010d" % index for index in range(fake)]
+    universe += ["NL%010d" % index for index in range(fake, args.universe)]
+    client = FakeClient(args.telegram_latency)
+    driver = Driver(client, main.HANDLERS)
+
+    with tempfile.TemporaryDirectory() as project_dir:
+        main.Database = db.Database(project_dir)
+        await main.Database._init()
+        await main.Database.create_database()
+        await main.Database.load_market_index()
+        service = None
+        if args.service:
+            service = await start_service(project_dir, settings.ING_BASE_URL, args)
+            main.Quotes = quoteservice.QuoteClient(os.path.join(project_dir, "quotes.sock"), main.Database)
+        else:
+            main.Quotes = quoteservice.LocalQuotes(main.Database)
+        await main.Quotes._init()
+
+        samples = defaultdict(int)
+        sampler = asyncio.create_task(monitor(main.Database, samples, 0.005))
+        commits = main.Database.commits
+        limit = asyncio.Semaphore(args.concurrency)
+
+        async def user(user_id):
+            async with limit:
+                await simulate_user(driver, user_id, universe, args)
+
+        started = time.perf_counter()
+        try:
+            await asyncio.gather(*[user(user_id) for user_id in range(1, args.users + 1)])
+            await main.Database.flush()
+        finally:
+            elapsed = time.perf_counter() - started
+            sampler.cancel()
+            quote_stats = await main.Quotes.stats()
+            await main.Quotes._close()
+            if service is not None:
+                stop_service(service)
+            await main.Database._close()
+            await stand_in.stop()
+
+    handler_calls = sum(len(latencies) for latencies in driver.latencies.values())
+    scraping_calls = len(driver.latencies["track"]) + len(driver.latencies["current_list"]) + \
+        len(driver.latencies["callback_current_list"])
+    return {
+        "users": args.users,
+        "elapsed_s": elapsed,
+        "handler_calls": handler_calls,
+        "handlers_per_s": handler_calls / elapsed,
+        "handlers": {name: percentiles(latencies) for name, latencies in sorted(driver.latencies.items())},
+        "errors": dict(driver.errors),
+        "scrape": {
+            "server_requests": dict(stand_in.requests),
+            "page_requests_per_scraping_handler": stand_in.requests["product"] / scraping_calls if scraping_calls else 0.0,
+            "quote_cache": quote_stats,
+            # These two are counted in the quote service's process with --service
+            "changes": webscraper.Changes.stats(),
+            "bulk_requests": {provider.name: provider.calls for provider in providers.Enabled if provider.bulk_size},
+        },
+        "database": {
+            "commits": main.Database.commits - commits,
+            "commits_per_s": (main.Database.commits - commits) / elapsed,
+            "writer_busy": samples["writer_busy"] / samples["samples"] if samples["samples"] else 0.0,
+            "readers_exhausted": samples["readers_exhausted"] / samples["samples"] if samples["samples"] else 0.0,
+            "write_queue_max": samples["write_queue_max"],
+            "readers": main.Database.reader_count,
+        },
+        "telegram_api_calls": client.api_calls,
+    }
+
+
+def report(results):
+    print("%d users, %d handler calls in %.2f s (%.0f/s)" % (
+        results["users"], results["handler_calls"], results["elapsed_s"], results["handlers_per_s"]))
+    print("%-24s %7s %9s %9s %9s %9s" % ("handler", "calls", "p50 ms", "p95 ms", "p99 ms", "max ms"))
+    for name, result in results["handlers"].items():
+        print("%-24s %7d %9.2f %9.2f %9.2f %9.2f" % (
+            name, result["calls"], result["p50_ms"], result["p95_ms"], result["p99_ms"], result["max_ms"]))
+    if results["errors"]:
+        print("errors: %s" % results["errors"])
+    print("scrape: %s" % json.dumps(results["scrape"]))
+    print("database: %s" % json.dumps(results["database"]))
+
+
+def run_service(project_dir, base_url, args):
+    # The quote service process of --service, with the harness' settings
+    settings.ING_BASE_URL = base_url
+    settings.FETCH_STREAMING = args.stream
+    if args.fetch_rate:
+        settings.FETCH_RATE = args.fetch_rate
+        settings.FETCH_BURST = args.fetch_rate
+    if args.fake:
+        providers.enable(("ing", "fake"))
+    if args.workers:
+        settings.PARSER_WORKERS = args.workers
+    try:
+        asyncio.run(quoteservice.serve(project_dir, os.path.join(project_dir, "quotes.sock")))
+    except KeyboardInterrupt:
+        pass
+
+
+async def start_service(project_dir, base_url, args):
+    service = multiprocessing.get_context("spawn").Process(
+        target=run_service, args=(project_dir, base_url, args))  # Not a daemon, it starts parser workers
+    service.start()
+    while not os.path.exists(os.path.join(project_dir, "quotes.sock")):
+        if not service.is_alive():
+            raise RuntimeError("The quote service did not start")
+        await asyncio.sleep(0.05)
+    return service
+
+
+def stop_service(service):
+    # SIGINT lets the service close its parser workers
+    os.kill(service.pid, signal.SIGINT)
+    service.join(10)
+    if service.is_alive():
+        service.terminate()
+
+
+async def serve(args):
+    stand_in = StandIn(
+        args.latency, args.jitter, args.error_rate, args.ended, args.seed, args.etag, args.padding, args.bandwidth)
+    url = await stand_in.start(args.host, args.port)
+    main.logger.info("ING Markets stand-in on %s, set settings.ING_BASE_URL to use it" % url)
+    try:
+        await asyncio.Event().wait()
+    finally:
+        await stand_in.stop()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Load harness with a local ING Markets stand-in")
+    parser.add_argument("--users", type=int, default=1000, help="Simulated users")
+    parser.add_argument("--concurrency", type=int, default=500, help="Users active at the same time")
+    parser.add_argument("--universe", type=int, default=500, help="Distinct products users pick from")
+    parser.add_argument("--products-per-user", type=int, default=5)
+    parser.add_argument("--import-size", type=int, default=0, help="ISINs per user in a bulk Track, 0 skips it")
+    parser.add_argument("--inline-keystrokes", type=int, default=6, help="Inline queries per user")
+    parser.add_argument("--rounds", type=int, default=2, help="List/Settings/Remove rounds per user")
+    parser.add_argument("--think", type=float, default=0, help="Max pause between user actions in ms")
+    parser.add_argument("--latency", type=float, default=50, help="Stand-in response time in ms")
+    parser.add_argument("--jitter", type=float, default=20, help="Random +/- on the response time in ms")
+    parser.add_argument("--error-rate", type=float, default=0.01, help="Fraction of 503 responses")
+    parser.add_argument("--ended", type=float, default=0.05, help="Fraction of Beëindigd products")
+    parser.add_argument("--fake", type=float, default=0, help="Fraction of products from the fake bulk provider")
+    parser.add_argument("--etag", action="store_true", help="Send ETags and answer conditional requests with 304")
+    parser.add_argument("--padding", type=int, default=0, help="KB of scripts after the product details")
+    parser.add_argument("--bandwidth", type=float, default=0, help="Stand-in send rate in KB/s per page, 0 is unlimited")
+    parser.add_argument("--stream", action="store_true", help="Set FETCH_STREAMING")
+    parser.add_argument("--service", action="store_true", help="Scrape in a quote service process")
+    parser.add_argument("--workers", type=int, help="Parser processes of the quote service")
+    parser.add_argument("--telegram-latency", type=float, default=0, help="Cost of a Telegram API call in ms")
+    parser.add_argument("--fetch-rate", type=float, help="Override settings.FETCH_RATE (requests/s per host)")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=0)
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--serve", action="store_true", help="Only run the stand-in server")
+    parser.add_argument("--output", help="Also write the results to this JSON file")
+    args = parser.parse_args()
+
+    if args.serve:
+        try:
+            asyncio.run(serve(args))
+        except KeyboardInterrupt:
+            pass
+        raise SystemExit(0)
+
+    results = asyncio.run(run(args))
+    report(results)
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2)
@@ -0,0 +1,57 @@
+#! /usr/bin/env python3
+# Checks that the hot queries in db.HOT_QUERIES are served from an index.
+# Exits with status 1 when one of them scans a whole table.
+#
+#   python benchmarks/query_plans.py
+import asyncio
+import os
+import re
+import sys
+import tempfile
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src'))
+
+import db  # noqa: E402
+
+# A full scan is "SCAN <table>" without an index, covering index scans are fine
+FULL_SCAN = re.compile(r"^SCAN (\w+)(?! USING (COVERING )?INDEX)")
+
+# Tables that are small enough, or read completely on purpose
+ALLOWED_SCANS = {
+    # The refresher reads every tracked product
+    "read_tracked_isins": {"m", "Markets"},
+}
+
+
+async def run():
+    with tempfile.TemporaryDirectory() as project_dir:
+        database = db.Database(project_dir)
+        await database._init()
+        try:
+            await database.create_database()
+            failures = await check_plans(database)
+        finally:
+            await database._close()
+
+    return failures
+
+
+async def check_plans(database, queries=None):
+    # Prints the plans of queries (db.HOT_QUERIES by default), returns how many scan a table
+    failures = 0
+    for name, (sql, parameters) in (queries or db.HOT_QUERIES).items():
+        plan = await database.explain(sql, parameters)
+        scans = [match.group(1) for match in map(FULL_SCAN.match, plan) if match]
+        scans = [table for table in scans if table not in ALLOWED_SCANS.get(name, ())]
+
+        status = "FAIL" if scans else "ok"
+        failures += bool(scans)
+        print("%-4s %s" % (status, name))
+        for line in plan:
+            print("       " + line)
+
+    return failures
+
+
+if __name__ == '__main__':
+    sys.exit(1 if asyncio.run(run()) else 0)
@@ -0,0 +1,207 @@
+import logging
+import asyncio
+import time
+from collections import OrderedDict
+from typing import NamedTuple, Optional
+from scheduler import FetchError
+
+
+class QuoteCache():
+    # In-process quote cache keyed by ISIN with a TTL and LRU eviction.
+    # Concurrent requests for an ISIN that is already being fetched await the
+    # same future instead of sending another HTTP request (single-flight).
+    def __init__(self, ttl, max_size):
+        self.logger = logging.getLogger('client.cache')
+        self.ttl = ttl
+        self.max_size = max_size
+        self.entries = OrderedDict()  # isin -> (expires, available, data)
+        self.inflight = {}  # isin -> future
+
+        self.hits = 0
+        self.misses = 0
+        self.coalesced = 0
+        self.evictions = 0
+
+    def get(self, isin):
+        entry = self.entries.get(isin)
+        if entry is None:
+            return None
+
+        if entry[0] < time.monotonic():
+            del self.entries[isin]
+            return None
+
+        self.entries.move_to_end(isin)
+        return entry
+
+    def put(self, isin, available, data):
+        self.entries[isin] = (time.monotonic() + self.ttl, available, data)
+        self.entries.move_to_end(isin)
+
+        while len(self.entries) > self.max_size:
+            self.entries.popitem(last=False)
+            self.evictions += 1
+
+    def invalidate(self, isin):
+        self.entries.pop(isin, None)
+
+    def stats(self):
+        lookups = self.hits + self.misses + self.coalesced
+        return {
+            "size": len(self.entries),
+            "inflight": len(self.inflight),
+            "hits": self.hits,
+            "misses": self.misses,
+            "coalesced": self.coalesced,
+            "evictions": self.evictions,
+            "hit_ratio": (self.hits + self.coalesced) / lookups if lookups else 0.0,
+        }
+
+    async def get_many(self, isin_list, fetch):
+        # fetch(isin_list) must return (available, unavailable, failed) like getProductDataHTML.
+        # Returns the same tuple, ordered like isin_list.
+        loop = asyncio.get_running_loop()
+        entries = {}
+        waiting = {}
+        missing = []
+
+        for isin in dict.fromkeys(isin_list):
+            entry = self.get(isin)
+            if entry is not None:
+                self.hits += 1
+                entries[isin] = entry[1:]
+            elif isin in self.inflight:
+                self.coalesced += 1
+                waiting[isin] = self.inflight[isin]
+            else:
+                self.misses += 1
+                future = loop.create_future()
+                self.inflight[isin] = future
+                waiting[isin] = future
+                missing.append(isin)
+
+        if missing:
+            await self._fetch(missing, fetch)
+
+        for isin, future in waiting.items():
+            try:
+                entries[isin] = await asyncio.shield(future)
+            except FetchError as e:
+                entries[isin] = (None, {"Isin": isin, "Error": str(e)})
+
+        results, results_unavailable, results_failed = [], [], []
+        for isin in dict.fromkeys(isin_list):
+            available, data = entries[isin]
+            if available is None:
+                results_failed.append(data)
+            elif available:
+                results.append(data)
+            else:
+                results_unavailable.append(data)
+
+        self.logger.debug("Quote cache: {}".format(self.stats()))
+        return results, results_unavailable, results_failed
+
+    async def _fetch(self, missing, fetch):
+        try:
+            available, unavailable, failed = await fetch(missing)
+
+            for item in available:
+                self.put(item["Isin"], True, item)
+                self._resolve(item["Isin"], (True, item))
+            for item in unavailable:
+                self.put(item["Isin"], False, item)
+                self._resolve(item["Isin"], (False, item))
+            for item in failed:
+                # Failures are not cached so the next request tries again
+                self._resolve(item["Isin"], (None, item))
+
+        except Exception as e:
+            self.logger.error("Fetching {} products failed: {!r}".format(len(missing), e))
+
+        finally:
+            # Never leave other requests waiting on a fetch that did not finish
+            for isin in missing:
+                future = self.inflight.pop(isin, None)
+                if future is not None and not future.done():
+                    future.set_exception(FetchError(isin, "fetch did not complete"))
+
+    def _resolve(self, isin, value):
+        future = self.inflight.pop(isin, None)
+        if future is not None and not future.done():
+            future.set_result(value)
+
+
+class PageState(NamedTuple):
+    etag: Optional[str]
+    last_modified: Optional[str]
+    fingerprint: Optional[bytes]
+    result: tuple           # (available, data) of the last parse
+    checked: float          # time.time() of the last successful fetch
+
+
+class ChangeTracker():
+    # Remembers how every product page looked when it was last parsed, so
+    # unchanged pages are neither parsed nor written again.
+    # Conditional requests use the ETag/Last-Modified validators when ING sends
+    # them, otherwise the Performance block fingerprint decides.
+    def __init__(self, max_size):
+        self.max_size = max_size
+        self.entries = OrderedDict()  # isin -> PageState
+
+        self.not_modified = 0   # 304 responses
+        self.unchanged = 0      # Same Performance block, parsing skipped
+        self.parsed = 0
+        self.changed = 0        # Parsed with different values than last time
+
+    def get(self, isin):
+        entry = self.entries.get(isin)
+        if entry is not None:
+            self.entries.move_to_end(isin)
+        return entry
+
+    def headers(self, isin):
+        # Request headers for a conditional GET
+        entry = self.entries.get(isin)
+        headers = {}
+        if entry is not None:
+            if entry.etag:
+                headers["If-None-Match"] = entry.etag
+            if entry.last_modified:
+                headers["If-Modified-Since"] = entry.last_modified
+        return headers
+
+    def put(self, isin, etag, last_modified, fingerprint, result):
+        previous = self.entries.get(isin)
+        self.parsed += 1
+        if previous is None or previous.result != result:
+            self.changed += 1
+
+        self.entries[isin] = PageState(etag, last_modified, fingerprint, result, time.time())
+        self.entries.move_to_end(isin)
+        while len(self.entries) > self.max_size:
+            self.entries.popitem(last=False)
+
+    def touch(self, isin, not_modified=False):
+        # The page did not change, returns the result of the last parse
+        entry = self.entries[isin]
+        self.entries[isin] = entry._replace(checked=time.time())
+        if not_modified:
+            self.not_modified += 1
+        else:
+            self.unchanged += 1
+        return entry.result
+
+    def checked(self, isin):
+        # When the quote of isin was last confirmed, 0 when unknown
+        entry = self.entries.get(isin)
+        return entry.checked if entry is not None else 0
+
+    def stats(self):
+        return {
+            "size": len(self.entries),
+            "not_modified": self.not_modified,
+            "unchanged": self.unchanged,
+            "parsed": self.parsed,
+            "changed": self.changed,
+        }
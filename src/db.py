@@ -2,225 +2,604 @@ import settings
 import logging
 import asyncio
 import aiosqlite
+import migrations
+import metrics
+import search
+import tradinghours
 import os
 import sys
+import time
+from contextlib import asynccontextmanager
+from typing import NamedTuple, Optional
+from collections import OrderedDict
+
+
+# Insert or update a scraped product, see market_row() and market_writes().
+# Rows whose values did not change are left alone, Updated is the time of the last change.
+UPSERT_MARKET = """
+    INSERT INTO Markets(Title, Isin, Market_url, Type, Bid, Ask, Day, Lever, Stoploss, Stoploss_dist, Reference, Ended, Updated, Checked)
+    VALUES (:Title, :Isin, :Market_url, :Type, :Bid, :Ask, :Day, :Lever, :Stoploss, :Stoploss_dist, :Reference, 0, :Updated, :Updated)
+    ON CONFLICT(Isin) DO UPDATE SET
+        Title=excluded.Title, Market_url=excluded.Market_url, Type=excluded.Type,
+        Bid=excluded.Bid, Ask=excluded.Ask, Day=excluded.Day, Lever=excluded.Lever,
+        Stoploss=excluded.Stoploss, Stoploss_dist=excluded.Stoploss_dist,
+        Reference=excluded.Reference, Ended=0, Updated=excluded.Updated, Checked=excluded.Checked
+    WHERE Markets.Ended = 1
+        OR Markets.Title IS NOT excluded.Title OR Markets.Market_url IS NOT excluded.Market_url
+        OR Markets.Type IS NOT excluded.Type OR Markets.Bid IS NOT excluded.Bid
+        OR Markets.Ask IS NOT excluded.Ask OR Markets.Day IS NOT excluded.Day
+        OR Markets.Lever IS NOT excluded.Lever OR Markets.Stoploss IS NOT excluded.Stoploss
+        OR Markets.Stoploss_dist IS NOT excluded.Stoploss_dist OR Markets.Reference IS NOT excluded.Reference
+"""
+
+# Every scrape confirms the quote, changed or not. Checked decides when it is scraped again.
+# It is only written once it is older than the cutoff of check_cutoff(), in between
+# webscraper.Changes knows when a product was last checked.
+CHECK_MARKET = "UPDATE Markets SET Checked=? WHERE Isin=? AND (Checked IS NULL OR Checked < ?)"
+
+# A page of a user's list with the total list size, see read_portfolio()
+READ_PORTFOLIO = """
+    SELECT m.Title, m.Isin, m.Market_url, m.Type, m.Bid, m.Ask, m.Day, m.Lever,
+           m.Stoploss, m.Stoploss_dist, m.Reference, m.Ended, m.Updated, m.Checked, c.mark_del,
+           COUNT(*) OVER () AS total
+    FROM client_markets AS c
+    JOIN Markets AS m ON m.Isin = c.object_id
+    WHERE c.user_id = ?
+    ORDER BY m.Title ASC
+    LIMIT ? OFFSET ?
+"""
+
+# Every product that some user still tracks, see read_tracked_isins()
+READ_TRACKED_ISINS = """
+    SELECT DISTINCT m.Isin
+    FROM Markets AS m
+    JOIN client_markets AS c ON c.object_id = m.Isin
+    WHERE m.Ended = 0
+"""
+
+# Tracked ISINs last scraped before a given time, see read_stale_isins()
+READ_STALE_ISINS = """
+    SELECT DISTINCT m.Isin
+    FROM Markets AS m
+    JOIN client_markets AS c ON c.object_id = m.Isin
+    WHERE m.Ended = 0 AND (m.Checked IS NULL OR m.Checked < ?)
+"""
+
+# Products with the most users, see stats()
+MOST_TRACKED = """
+    SELECT c.object_id, m.Title, COUNT(*) AS users
+    FROM client_markets AS c
+    JOIN Markets AS m ON m.Isin = c.object_id
+    GROUP BY c.object_id
+    ORDER BY users DESC, c.object_id
+    LIMIT ?
+"""
+
+# Tables the admin stats command can dump, see dump()
+DUMP_TABLES = ("Clients", "Settings", "Markets", "client_markets")
+
+# Queries that run on every button tap and must be served from an index.
+# Checked by benchmarks/query_plans.py
+HOT_QUERIES = {
+    "read_portfolio": (READ_PORTFOLIO, (1, 4, 0)),
+    "read_tracked_isins": (READ_TRACKED_ISINS, ()),
+    "read_stale_isins": (READ_STALE_ISINS, (0,)),
+    "read_settings": ("SELECT * FROM Settings WHERE user_id=?", (1,)),
+    "read_market": ("SELECT * FROM Markets WHERE Isin=?", ("NL0000000000",)),
+    "insert_client_market": (
+        "INSERT INTO client_markets(user_id, object_id) VALUES (?, ?) ON CONFLICT DO NOTHING", (1, "NL0000000000")),
+    "mark_client_market": (
+        "UPDATE client_markets SET mark_del=? WHERE user_id=? AND object_id=?", (1, 1, "NL0000000000")),
+    "delete_client_market": (
+        "DELETE FROM client_markets WHERE user_id=? AND object_id=?", (1, "NL0000000000")),
+    "users_of_product": ("SELECT user_id FROM client_markets WHERE object_id=?", ("NL0000000000",)),
+}
+
+# Columns of the Settings table that users can toggle
+SETTINGS_COLUMNS = ("Isin", "Type", "Bid", "Ask", "Day", "Lever", "StopLoss", "Reference")
+
+
+class PortfolioRow(NamedTuple):
+    # One tracked product of a user, as returned by Database.read_portfolio()
+    Title: str
+    Isin: str
+    Market_url: Optional[str]
+    Type: Optional[str]
+    Bid: Optional[float]
+    Ask: Optional[float]
+    Day: Optional[float]
+    Lever: Optional[float]
+    Stoploss: Optional[float]
+    Stoploss_dist: Optional[float]
+    Reference: Optional[float]
+    Ended: int
+    Updated: Optional[float]    # Last change of the values
+    Checked: Optional[float]    # Last scrape
+    mark_del: int
+
+
+def market_row(item, updated):
+    # Bound parameters for UPSERT_MARKET from a scraped product
+    return {
+        "Title": item['Title'] or item['Isin'],
+        "Isin": item['Isin'],
+        "Market_url": item['Market'],
+        "Type": item.get('Type'),
+        "Bid": item['Bid'],
+        "Ask": item['Ask'],
+        "Day": item['Day'],
+        "Lever": item['Lever'],
+        "Stoploss": item['Stoploss'],
+        "Stoploss_dist": item['Stoploss_dist'],
+        "Reference": item['Reference'],
+        "Updated": updated,
+    }
+
+
+def check_cutoff(checked):
+    # A stored Checked stays while it is less than half of QUOTE_MAX_AGE old and from after the
+    # last close, so it is fresh for at least that long without being rewritten on every scrape
+    return max(checked - settings.QUOTE_MAX_AGE / 2, tradinghours.Market.last_close(checked).timestamp())
+
+
+def market_writes(rows, checked):
+    # Statements that store market_row() rows scraped at checked
+    cutoff = check_cutoff(checked)
+    return [
+        (UPSERT_MARKET, rows, True),
+        (CHECK_MARKET, [(checked, row["Isin"], cutoff) for row in rows], True),
+    ]
+
+
+class SettingsCache():
+    # LRU cache of Settings rows, bounded by the number of users.
+    # Kept up to date by the Database methods that write Settings.
+    def __init__(self, max_size):
+        self.max_size = max_size
+        self.entries = OrderedDict()  # user_id -> settings dictionary
+        # Only users with a read or write in flight are tracked, see put()
+        self.reading = {}  # user_id -> reads of the Settings row in flight
+        self.versions = {}  # user_id -> updates and invalidations while reads were in flight
+        self.writing = {}  # user_id -> Settings writes that are not committed yet
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, user_id):
+        entry = self.entries.get(user_id)
+        if entry is None:
+            self.misses += 1
+            return None
+
+        self.hits += 1
+        self.entries.move_to_end(user_id)
+        # Callers get their own copy
+        return dict(entry)
+
+    def begin_read(self, user_id):
+        # Before reading the row after a miss, returns the version for put(), end_read() afterwards
+        self.reading[user_id] = self.reading.get(user_id, 0) + 1
+        return self.versions.get(user_id, 0)
+
+    def end_read(self, user_id):
+        self.reading[user_id] -= 1
+        if not self.reading[user_id]:
+            del self.reading[user_id]
+            self.versions.pop(user_id, None)
+
+    def _changed(self, user_id):
+        # Reads that started earlier may have read the old row
+        if user_id in self.reading:
+            self.versions[user_id] = self.versions.get(user_id, 0) + 1
+
+    def put(self, user_id, user_settings, version=None):
+        # version is the one begin_read() returned. A row read while the settings were
+        # updated or invalidated, or before a queued update was committed, may be
+        # outdated and is not cached.
+        if version is not None and (version != self.versions.get(user_id, 0) or user_id in self.writing):
+            return
+        self.entries[user_id] = dict(user_settings)
+        self.entries.move_to_end(user_id)
+
+        while len(self.entries) > self.max_size:
+            self.entries.popitem(last=False)
+            self.evictions += 1
+
+    def begin_write(self, user_id):
+        self.writing[user_id] = self.writing.get(user_id, 0) + 1
+
+    def end_write(self, user_id):
+        self._changed(user_id)
+        self.writing[user_id] -= 1
+        if not self.writing[user_id]:
+            del self.writing[user_id]
+
+    def update(self, user_id, values):
+        self._changed(user_id)
+        entry = self.entries.get(user_id)
+        if entry is not None:
+            entry.update(values)
+
+    def invalidate(self, user_id):
+        self._changed(user_id)
+        self.entries.pop(user_id, None)
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            "size": len(self.entries),
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "hit_ratio": self.hits / lookups if lookups else 0.0,
+        }
 
 
 class Database():
-    def __init__(self, project_dir):
+    def __init__(self, project_dir, write_behind=None, readers=None):
         self.logger = logging.getLogger('client.db')
         self.project_dir = project_dir
         self.database_file = self.project_dir + '/client.db'
+        self.settings_cache = SettingsCache(settings.SETTINGS_CACHE_SIZE)
+        # Every product in Markets that has not ended, for inline queries, see load_market_index()
+        self.market_index = search.PrefixIndex()
+
+        # Group commit: writes are queued and committed together by one writer task
+        self.write_behind = settings.DB_WRITE_BEHIND if write_behind is None else write_behind
+        self.write_queue = None
+        self.writer = None
+        # Transactions share the connection, only one may be open at a time
+        self.write_lock = None
+        self.commits = 0
+        self.grouped_writes = 0
+
+        # Read-only connections, reads do not queue behind the writer's thread
+        self.reader_count = settings.DB_READERS if readers is None else readers
+        self.readers = []
+        self.reader_pool = None
 
     async def _init(self):
         self.conn = await aiosqlite.connect(self.database_file)
         await self.conn.execute("PRAGMA foreign_keys = 1")
-        self.logger.debug("Database connection active")
+        # Readers do not block the writer and commits need fewer fsyncs
+        await self.conn.execute("PRAGMA journal_mode = WAL")
+        await self.conn.execute("PRAGMA synchronous = NORMAL")
+
+        self.write_lock = asyncio.Lock()
+        if self.write_behind:
+            self.write_queue = asyncio.Queue()
+            self.writer = asyncio.create_task(self._writer())
+
+        # WAL lets the readers see the last commit while the writer is busy
+        self.reader_pool = asyncio.Queue()
+        for _ in range(self.reader_count):
+            reader = await aiosqlite.connect("file:{}?mode=ro".format(self.database_file), uri=True)
+            await reader.execute("PRAGMA query_only = 1")
+            self.readers.append(reader)
+            self.reader_pool.put_nowait(reader)
+
+        self.logger.debug("Database connection active (%d readers)" % len(self.readers))
 
     async def _commit(self):
         await self.conn.commit()
+        self.commits += 1
 
     async def _close(self):
+        if self.writer is not None:
+            # Commit everything that is still queued
+            await self.flush()
+            self.writer.cancel()
+            try:
+                await self.writer
+            except asyncio.CancelledError:
+                pass
+            self.writer = None
+
+        for reader in self.readers:
+            await reader.close()
+        self.readers = []
+        self.reader_pool = None
+
         await self.conn.close()
         self.logger.debug("Database connection closed")
 
+    @asynccontextmanager
+    async def _reader(self):
+        # Borrow a read-only connection, use the writer when there is no pool.
+        # Fetch the results before leaving the block.
+        if not self.readers:
+            yield self.conn
+            return
+
+        reader = await self.reader_pool.get()
+        try:
+            yield reader
+        finally:
+            self.reader_pool.put_nowait(reader)
+
     async def create_database(self):
-        # Not sure how settings_id and list_id work
-        await self.conn.execute(
-            """
-            CREATE TABLE IF NOT EXISTS Clients (
-                user_id BIGINT UNIQUE PRIMARY KEY,
-                settings_id BIGINT,
-                list_id BIGINT
-            );
-            """
-        )
-
-        # Only one settings object per user (one-to-many)
-        await self.conn.execute("""CREATE TABLE IF NOT EXISTS Settings
-            (
-                user_id        INTEGER UNIQUE PRIMARY KEY,
-                Isin           BOOLEAN NOT NULL CHECK (Isin      IN (0,1)) DEFAULT 1,
-                Type           BOOLEAN NOT NULL CHECK (Type      IN (0,1)) DEFAULT 1,
-                Bid            BOOLEAN NOT NULL CHECK (Bid       IN (0,1)) DEFAULT 1,
-                Ask            BOOLEAN NOT NULL CHECK (Ask       IN (0,1)) DEFAULT 1,
-                Day            BOOLEAN NOT NULL CHECK (Day       IN (0,1)) DEFAULT 1,
-                Lever          BOOLEAN NOT NULL CHECK (Lever     IN (0,1)) DEFAULT 1,
-                StopLoss       BOOLEAN NOT NULL CHECK (StopLoss  IN (0,1)) DEFAULT 1,
-                Reference      BOOLEAN NOT NULL CHECK (Reference IN (0,1)) DEFAULT 1,
-                FOREIGN KEY(user_id) REFERENCES Clients(user_id) ON DELETE CASCADE
-            );
-        """)
-
-        await self.conn.execute(
-            """
-            CREATE TABLE IF NOT EXISTS Markets (
-            Title          TEXT NOT NULL,
-            Isin           TEXT UNIQUE PRIMARY KEY,
-            Market_url     TEXT,
-            Type           TEXT,
-            Bid            REAL,
-            Ask            REAL,
-            Day            TEXT,
-            Lever          REAL,
-            Stoploss       TEXT,
-            Stoploss_dist  TEXT,
-            Reference      TEXT,
-            Ended          BOOLEAN NOT NULL CHECK (Ended IN (0,1)) DEFAULT 0
-            );
-            """
-        )
-
-        await self.conn.execute(
-            """
-            CREATE TABLE IF NOT EXISTS client_markets (
-                user_id   BIGINT,
-                object_id BIGINT,
-                mark_del  BOOLEAN NOT NULL CHECK (mark_del IN (0,1)) DEFAULT 0,
-                FOREIGN KEY(user_id) REFERENCES Clients(user_id) ON DELETE CASCADE,
-                FOREIGN KEY(object_id) REFERENCES Markets(Isin) ON DELETE CASCADE
-            )
-            """
-        )
+        # Create the schema or bring it up to date
+        version = await migrations.migrate(self.conn)
+        self.logger.debug("Database schema version %d" % version)
+
+    #############################################
+    # Write path
+    #############################################
+
+    async def _write(self, statements, durable=True, on_error=None, on_done=None):
+        # Run [(sql, parameters, many), ...] in one transaction.
+        # Returns the row counts of the statements once committed, False once rolled back.
+        # In write-behind mode the statements are queued; with durable=False
+        # this returns None right away and errors are only logged.
+        # on_done() is called once the statements were committed or rolled back.
+        if self.writer is None:
+            try:
+                async with self.write_lock:
+                    return await self._transaction(statements, on_error)
+            finally:
+                if on_done is not None:
+                    on_done()
+
+        future = asyncio.get_running_loop().create_future()
+        if on_done is not None:
+            future.add_done_callback(lambda future: on_done())
+        self.write_queue.put_nowait((statements, future, on_error, durable))
+        if durable:
+            return await future
+        return None
+
+    async def flush(self):
+        # Wait until every write queued so far is committed
+        if self.writer is not None:
+            await self._write([])
+
+    async def _execute(self, statements):
+        # Returns the number of rows every statement changed
+        rowcounts = []
+        for sql, parameters, many in statements:
+            if many:
+                cursor = await self.conn.executemany(sql, parameters)
+            else:
+                cursor = await self.conn.execute(sql, parameters)
+            rowcounts.append(max(cursor.rowcount, 0))
+        return rowcounts
+
+    async def _transaction(self, statements, on_error=None):
+        try:
+            # Executing the SQL command
+            rowcounts = await self._execute(statements)
 
-    async def new_user(self, user):
-        user_id = user.user_id
+            # Commit your changes in the database
+            await self._commit()
+            return rowcounts
+
+        except Exception as e:
+            self.logger.error(e)
+            # Rolling back in case of error
+            await self.conn.rollback()
+            if on_error is not None:
+                on_error()
+            return False
+
+    async def _writer(self):
+        # Single writer task. Takes everything that queued up while the previous
+        # group was committing. Durable writes are committed right away, without
+        # waiters the group stays open for DB_GROUP_COMMIT_INTERVAL seconds.
+        # A group never exceeds DB_GROUP_COMMIT_MAX statements.
+        loop = asyncio.get_running_loop()
+        while True:
+            batch = [await self.write_queue.get()]
+            statements = len(batch[0][0])
+            deadline = loop.time() + settings.DB_GROUP_COMMIT_INTERVAL
+
+            while statements < settings.DB_GROUP_COMMIT_MAX:
+                if not self.write_queue.empty():
+                    item = self.write_queue.get_nowait()
+                else:
+                    timeout = deadline - loop.time()
+                    if timeout <= 0 or any(durable for *_, durable in batch):
+                        break
+                    try:
+                        item = await asyncio.wait_for(self.write_queue.get(), timeout)
+                    except asyncio.TimeoutError:
+                        break
+                batch.append(item)
+                statements += len(item[0])
+
+            # Nothing may end this task, the writes queued after this batch still need it
+            try:
+                results = await self._group_commit(batch)
+            except Exception as e:
+                # Even the rollback failed, the next group must not commit what is left of this one
+                self.logger.error("Group commit failed: {!r}".format(e))
+                results = [False] * len(batch)
+                try:
+                    if self.conn.in_transaction:
+                        await self.conn.rollback()
+                except Exception as e:
+                    self.logger.error("Rollback failed: {!r}".format(e))
+            for (statements, future, on_error, durable), result in zip(batch, results):
+                if result is False and on_error is not None:
+                    try:
+                        on_error()
+                    except Exception as e:
+                        self.logger.error("Error handler of a queued write failed: {!r}".format(e))
+                if not future.done():
+                    future.set_result(result)
+
+    async def _group_commit(self, batch):
+        # One transaction for the whole batch. Every queued write gets its own
+        # savepoint, so a failing write does not roll back the others.
+        results = []
+        try:
+            if not self.conn.in_transaction:
+                await self.conn.execute("BEGIN")
+
+            for statements, *_ in batch:
+                await self.conn.execute("SAVEPOINT queued_write")
+                try:
+                    results.append(await self._execute(statements))
+                except Exception as e:
+                    self.logger.error(e)
+                    await self.conn.execute("ROLLBACK TO queued_write")
+                    results.append(False)
+                await self.conn.execute("RELEASE queued_write")
+
+            await self._commit()
+            self.grouped_writes += len(batch)
+
+        except Exception as e:
+            self.logger.error(e)
+            await self.conn.rollback()
+            results = [False] * len(batch)
+
+        return results
 
-        # Add user
-        await self.conn.execute("""INSERT OR IGNORE INTO Clients (user_id) VALUES (%d)""" % (user_id))
+    def write_stats(self):
+        return {
+            "write_behind": self.write_behind,
+            "queued": self.write_queue.qsize() if self.write_queue is not None else 0,
+            "commits": self.commits,
+            "grouped_writes": self.grouped_writes,
+        }
 
-        # Enable all settings by default
-        await self.conn.execute(
-            """
-            INSERT OR IGNORE INTO SETTINGS (user_id)
-            VALUES ({user_id})
-            """
-            .format(user_id=user_id)
-        )
+    #############################################
+    # Writes
+    #############################################
+
+    async def new_user(self, user, durable=True):
+        user_id = user.user_id
+
+        await self._write([
+            # Add user
+            ("INSERT OR IGNORE INTO Clients (user_id) VALUES (?)", (user_id,), False),
+            # Enable all settings by default
+            ("INSERT OR IGNORE INTO Settings (user_id) VALUES (?)", (user_id,), False),
+        ], durable)
+        self.settings_cache.invalidate(user_id)
 
         self.logger.debug(
             "User with ID %d has been added to the database." % (user_id))
 
-        await self._commit()
-
-    async def delete_user(self, user):
+    async def delete_user(self, user, durable=True):
         user_id = user.user_id
 
-        await self.conn.execute("DELETE FROM Clients WHERE user_id=%s" % (user_id))
+        await self._write([("DELETE FROM Clients WHERE user_id=?", (user_id,), False)], durable)
+        self.settings_cache.invalidate(user_id)
 
         self.logger.debug(
             "User with ID %d has been deleted from the database." % (user_id))
 
-        await self._commit()
-
     # EG. add product
-    async def insert_to_database(self, user, table, payload):
+    async def insert_to_database(self, user, table, payload, durable=True):
+        # Payload is a single dictionary or a list of them, a list is inserted in one transaction
         user_id = user.user_id
+        items = payload if isinstance(payload, list) else [payload]
         self.logger.debug("Insert into database")
         self.logger.debug("User ID: %d" % user_id)
         self.logger.debug("Table: %s" % table)
         self.logger.debug("Payload: {}".format(payload))
 
+        statements = []
+        rows = []
         if table == "Markets":
-            # Should be insert or update actually
-            insert_market = (
-                """
-                INSERT INTO "{table}"(Title, Isin, Market_url, Bid, Ask, Day, Lever, Stoploss, Stoploss_dist, Reference)
-                SELECT "{Title}", "{Isin}", "{Market_url}", "{Bid}", "{Ask}", "{Day}", "{Lever}", "{Stoploss}", "{Stoploss_dist}", "{Reference}"
-                WHERE NOT EXISTS (SELECT * FROM "{table}" WHERE Isin="{Isin}")
-                """
-                .format(
-                    table=table,
-                    Title=payload['Title'],
-                    Isin=payload['Isin'],
-                    Market_url=payload['Market'],
-                    Bid=payload['Bid'],
-                    Ask=payload['Ask'],
-                    Day=payload['Day'],
-                    Lever=payload['Lever'],
-                    Stoploss=payload['Stoploss'],
-                    Stoploss_dist=payload['Stoploss_dist'],
-                    Reference=payload['Reference'])
-            )
-
+            checked = time.time()
+            rows = [market_row(item, checked) for item in items]
+            statements += market_writes(rows, checked)
         if table == "client_markets":
-            insert_client_market = (
-                """
-                INSERT INTO "{table}"(user_id, object_id)
-                SELECT "{user_id}", "{object_id}"
-                WHERE NOT EXISTS (SELECT * FROM "{table}" WHERE user_id="{user_id}" AND object_id="{object_id}")
-                """
-                .format(table=table, user_id=user_id, object_id=payload['Isin'])
-            )
-
-        if table == "SETTINGS":
-            insert_settings = (
-                """
-                REPLACE INTO "{table}"(User_ID, Isin, Bid, Ask, Day, Lever, StopLoss, Reference)
-                VALUES ("{user_id}", "{isin}", "{bid}", "{ask}", "{day}", "{lever}", "{stoploss}", "{reference}")
-                """
-                .format(
-                    table=table,
-                    user_id=user_id,
-                    isin=payload['Isin'],
-                    bid=payload['Bid'],
-                    ask=payload['ask'],
-                    day=payload['day'],
-                    lever=payload['lever'],
-                    stoploss=payload['stoploss'],
-                    reference=payload['reference']
-                )
-            )
-
-        try:
-            # Executing the SQL command
-            if table == "Markets":
-                await self.conn.execute(insert_market)
-            if table == "client_markets":
-                await self.conn.execute(insert_client_market)
-            if table == "Settings":
-                await self.conn.execute(insert_settings)
-
-            # Commit your changes in the database
-            await self._commit()
-
-        except Exception as e:
-            self.logger.error(e)
-            # Rolling back in case of error
-            await self.conn.rollback()
+            statements.append((
+                "INSERT INTO client_markets(user_id, object_id) VALUES (?, ?) ON CONFLICT DO NOTHING",
+                [(user_id, item['Isin']) for item in items],
+                True
+            ))
+
+        result = await self._write(statements, durable, self._index_on_error(durable))
+        if rows and result is not False:
+            self._index_markets(rows)
+
+    # EG. Track: the products and the user's rows for them in one transaction
+    async def add_products(self, user, items, durable=True):
+        # Returns the result of _write()
+        if not items:
+            return True
+        checked = time.time()
+        rows = [market_row(item, checked) for item in items]
+
+        result = await self._write(market_writes(rows, checked) + [
+            (
+                "INSERT INTO client_markets(user_id, object_id) VALUES (?, ?) ON CONFLICT DO NOTHING",
+                [(user.user_id, row["Isin"]) for row in rows],
+                True
+            ),
+        ], durable, self._index_on_error(durable))
+        if result is not False:
+            self._index_markets(rows)
+        self.logger.debug("User with ID %d added %d products" % (user.user_id, len(rows)))
+        return result
 
     # EG. remove product from user
-    async def delete_from_database(self, user, table, payload):
+    async def delete_from_database(self, user, table, payload, durable=True):
+        # Payload is a single dictionary or a list of them, a list is deleted in one transaction
         user_id = user.user_id
+        items = payload if isinstance(payload, list) else [payload]
         self.logger.debug("Delete from database")
         self.logger.debug("User ID: %d" % user_id)
         self.logger.debug("Table: %s" % table)
         self.logger.debug("Payload: {}".format(payload))
 
+        statements = []
         if table == "client_markets":
-            delete = (
-                """
-                DELETE FROM "{table}" WHERE user_id="{user_id}" AND object_id="{isin}"
-                """
-                .format(table=table, user_id=user_id, isin=payload['Isin'])
-            )
-
-        try:
-            # Executing the SQL command
-            if table == "client_markets":
-                await self.conn.execute(delete)
-
-            # Commit your changes in the database
-            await self._commit()
-
-        except Exception as e:
-            self.logger.error(e)
-            # Rolling back in case of error
-            await self.conn.rollback()
+            statements.append((
+                "DELETE FROM client_markets WHERE user_id=? AND object_id=?",
+                [(user_id, item['Isin']) for item in items],
+                True
+            ))
+
+        await self._write(statements, durable)
+
+    # EG. store freshly scraped quotes, used by the List handler and the refresher
+    async def update_markets(self, payload, durable=True):
+        # Payload is [[{product1}, {product2}], [{unavailable_product}]]
+        # Returns the result of upsert_markets()
+        return await self.upsert_markets(payload[0], payload[1] if len(payload) > 1 else [], durable)
+
+    async def upsert_markets(self, available, unavailable=(), durable=True):
+        # Insert or update all available products and mark the unavailable ones as ended.
+        # Everything is written in a single transaction, unchanged rows at most get a new Checked.
+        # Returns the number of rows written, False when the write failed and None
+        # when it was queued without durability.
+        updated = time.time()
+        rows = [market_row(item, updated) for item in available]
+
+        result = await self._write(market_writes(rows, updated) + [
+            (
+                "UPDATE Markets SET Ended=1, Updated=?, Checked=? WHERE Isin=? AND Ended=0",
+                [(updated, updated, item['Isin']) for item in unavailable],
+                True
+            ),
+        ], durable, self._index_on_error(durable))
+        if result is not False:
+            self._index_markets(rows, unavailable)
+        return sum(result) if result else result
+
+    def _index_markets(self, rows, unavailable=()):
+        # Apply a successful write of Markets to the inline query index
+        for row in rows:
+            self.market_index.add(row["Isin"], row["Title"], row["Type"])
+        for item in unavailable:
+            self.market_index.discard(item['Isin'])
+
+    def _index_on_error(self, durable):
+        # Writes without durability may be applied to the index before they are committed.
+        # When one fails, the index is rebuilt from the database.
+        if durable:
+            return None
+        return lambda: asyncio.get_running_loop().create_task(self.load_market_index())
 
     # EG. update user settings
     # Not completed
-    async def update_database(self, user, table, payload):
+    async def update_database(self, user, table, payload, durable=True):
         # Payload is a dictionary with the data that you want to update to the column(s).
         # Eg. [[{product1}, {product2}], [{unavailable_product}]]
         user_id = user.user_id
@@ -230,173 +609,184 @@ class Database():
         self.logger.debug("Payload: {}".format(payload))
 
         if table == "Markets":
-            # only active ones are updated
-            update_markets = []
-            for item in payload[0]:
-                update_markets.append(
-                    """
-                    UPDATE Markets SET Title="{Title}", Market_url="{Market_url}", Bid="{Bid}", Ask="{Ask}", Day="{Day}", Lever="{Lever}", Stoploss="{Stoploss}", Stoploss_dist="{Stoploss_dist}", Reference="{Reference}", Ended="{Ended}"  WHERE Isin="{Isin}"
-                    """
-                    .format(
-                        Title=item['Title'],
-                        Isin=item['Isin'],
-                        Market_url=item['Market'],
-                        Bid=item['Bid'],
-                        Ask=item['Ask'],
-                        Day=item['Day'],
-                        Lever=item['Lever'],
-                        Stoploss=item['Stoploss'],
-                        Stoploss_dist=item['Stoploss_dist'],
-                        Reference=item['Reference'],
-                        Ended=item['Ended'])
-                )
-            if len(payload) > 1:
-                for item in payload[1]:
-                    update_markets.append(
-                        """
-                        UPDATE Markets SET Ended="{Ended}"  WHERE Isin="{Isin}"
-                        """
-                        .format(Isin=item['Isin'], Ended=item['Ended'])
-                    )
+            await self.update_markets(payload, durable)
+            return
 
+        statements = []
+        on_error = on_done = None
         if table == "Settings":
-            settings = ""
-            for key, value in payload.items():
-                settings += '"{}"="{}" '.format(key, value)
-
-            update_settings = (
-                """
-                UPDATE Settings SET {settings} WHERE user_id="{user_id}"
-                """
-                .format(
-                    settings=settings,
-                    user_id=user_id
-                )
-            )
+            # Column names come from callback data, only accept known settings
+            columns = [key for key in payload if key in SETTINGS_COLUMNS]
+            if columns:
+                statements.append((
+                    "UPDATE Settings SET {} WHERE user_id=?".format(
+                        ", ".join('"{}"=?'.format(key) for key in columns)),
+                    [payload[key] for key in columns] + [user_id],
+                    False
+                ))
+            on_error = lambda: self.settings_cache.invalidate(user_id)
+            # Reads until the commit may still see the old row, see SettingsCache.put()
+            self.settings_cache.begin_write(user_id)
+            on_done = lambda: self.settings_cache.end_write(user_id)
 
         if table == "client_markets":
+            statements.append((
+                "UPDATE client_markets SET mark_del=? WHERE user_id=? AND object_id=?",
+                [(setting, user_id, isin) for isin, setting in payload.items()],
+                True
+            ))
 
-            # This is not good, but it should work for now
-            for key, value in payload.items():
-                isin = key
-                setting = value
-
-            update_client_markets = (
-                """
-                UPDATE client_markets SET mark_del={setting} WHERE user_id="{user_id}" AND object_id="{isin}"
-                """
-                .format(
-                    setting=setting,
-                    user_id=user_id,
-                    isin=isin
-                )
-            )
+        result = await self._write(statements, durable, on_error, on_done)
 
-        try:
-            # Executing the SQL command
-            if table == "Markets":
-                for item in update_markets:
-                    await self.conn.execute(item)
-            if table == "Settings":
-                await self.conn.execute(update_settings)
-            if table == "client_markets":
-                await self.conn.execute(update_client_markets)
+        # Write-through, the stored values are integers.
+        # Without durability the cache is updated before the commit, a failed
+        # write invalidates it again.
+        if table == "Settings" and result is not False:
+            self.settings_cache.update(user_id, {key: int(payload[key]) for key in columns})
 
-            # Commit your changes in the database
-            await self._commit()
-
-        except Exception as e:
-            self.logger.error(e)
-            # Rolling back in case of error
-            await self.conn.rollback()
-
-    # EG. get list of products
+    # EG. get the user's settings, the lists are read by read_portfolio()
     async def read_database(self, user, table, payload=None):
         user_id = user.user_id
         self.logger.debug("User ID: %d" % user_id)
         self.logger.debug("Table: %s" % table)
         self.logger.debug("Payload: {}".format(payload))
 
-        if table in ["client_markets"]:
-            read_client = (
-                """
-                SELECT *
-                FROM "{table}" AS c
-                JOIN Markets as m on m.Isin = c.object_id
-                WHERE c.user_id="{user_id}"
-                ORDER BY m.Title ASC
-                """
-                .format(table=table, user_id=user_id)
-            )
-
-        if table == "Markets":
-            read_markets = (
-                """
-                SELECT * FROM "{table}" WHERE Isin="{Isin}"
-                """
-                .format(table=table, Isin=payload)
-            )
-
         if table == "Settings":
-            read_settings = (
-                """
-                SELECT * FROM "{table}" WHERE user_id="{user_id}"
-                """
-                .format(table=table, user_id=user_id)
-            )
+            # Served from the settings cache when possible
+            cached = self.settings_cache.get(user_id)
+            if cached is not None:
+                return cached
+            version = self.settings_cache.begin_read(user_id)
 
         results = None
         try:
             # Executing the SQL command
-            if table == "client_markets":
-                data = await self.conn.execute(read_client)
-                user_data = await data.fetchall()
-                results = {}
-                for item in user_data:
-                    results[item[1]] = item[2]
-
-            if table == "Markets":
-                data = await self.conn.execute(read_markets)
-                column_data = await data.fetchone()
-                column_names = [col[0] for col in data.description]
-                results = dict(zip(column_names, column_data))
-
-            if table == "Settings":
-                data = await self.conn.execute(read_settings)
-                column_data = await data.fetchone()
-                column_names = [col[0] for col in data.description]
-                results = dict(zip(column_names, column_data))
-
+            async with self._reader() as conn:
+                if table == "Settings":
+                    data = await conn.execute("SELECT * FROM Settings WHERE user_id=?", (user_id,))
+                    column_data = await data.fetchone()
+                    column_names = [col[0] for col in data.description]
+                    results = dict(zip(column_names, column_data))
+                    self.settings_cache.put(user_id, results, version)
 
         except Exception as e:
             self.logger.error(e)
+        finally:
+            if table == "Settings":
+                self.settings_cache.end_read(user_id)
 
         return results
 
-    # For debugging purposes only
-    async def print_database(self):
-        self.logger.warning("Printing database")
-
-        self.logger.warning("Clients:")
-        cursor = await self.conn.execute("SELECT * from Clients")
-        results = await cursor.fetchall()
-        for row in results:
-            self.logger.warning(row)
-
-        self.logger.warning("Markets:")
-        cursor = await self.conn.execute("SELECT * from Markets")
-        results = await cursor.fetchall()
-        for row in results:
-            self.logger.warning(row)
-
-        self.logger.warning("Client_Markets:")
-        cursor = await self.conn.execute("SELECT * from client_markets")
-        results = await cursor.fetchall()
-        for row in results:
-            self.logger.warning(row)
-
-        self.logger.warning("Settings:")
-        cursor = await self.conn.execute("SELECT * from Settings")
-        results = await cursor.fetchall()
-        for row in results:
-            self.logger.warning(row)
+    # EG. render a page of the user's list in two queries
+    async def read_portfolio(self, user, offset=0, limit=None):
+        # Returns (rows, settings, total)
+        #   rows: list of PortfolioRow ordered by title, limited to the requested page
+        #   settings: the user's Settings row as a dictionary
+        #   total: the number of products the user tracks
+        user_id = user.user_id
+        self.logger.debug("Read portfolio of user ID %d (offset %d, limit %s)" % (user_id, offset, limit))
+
+        async with self._reader() as conn:
+            cursor = await conn.execute(READ_PORTFOLIO, (user_id, -1 if limit is None else limit, offset))
+            data = await cursor.fetchall()
+
+            if data:
+                total = data[0][-1]
+            elif offset:
+                # Page past the end, still report the size of the list
+                cursor = await conn.execute("SELECT COUNT(*) FROM client_markets WHERE user_id = ?", (user_id,))
+                total = (await cursor.fetchone())[0]
+            else:
+                total = 0
+
+        rows = [PortfolioRow(*item[:-1]) for item in data]
+
+        user_settings = await self.read_database(user, "Settings")
+
+        return rows, user_settings, total
+
+    # Build the inline query index at startup, the write methods keep it up to date
+    async def load_market_index(self):
+        async with self._reader() as conn:
+            cursor = await conn.execute("SELECT Isin, Title, Type FROM Markets WHERE Ended = 0")
+            self.market_index.load(await cursor.fetchall())
+        self.logger.debug("Market index: %d products" % len(self.market_index.entries))
+
+    # ISINs that some user still tracks, used by the background refresher
+    async def read_tracked_isins(self):
+        async with self._reader() as conn:
+            cursor = await conn.execute(READ_TRACKED_ISINS)
+            return [row[0] for row in await cursor.fetchall()]
+
+    # ISINs marked as ended since the given time, for a bot whose quote service writes Markets
+    async def read_ended_isins(self, since):
+        async with self._reader() as conn:
+            cursor = await conn.execute(
+                "SELECT Isin FROM Markets WHERE Ended = 1 AND Updated >= ?", (since,))
+            return [row[0] for row in await cursor.fetchall()]
+
+    # Tracked ISINs that were last scraped more than max_age seconds ago
+    async def read_stale_isins(self, max_age):
+        async with self._reader() as conn:
+            cursor = await conn.execute(READ_STALE_ISINS, (time.time() - max_age,))
+            return [row[0] for row in await cursor.fetchall()]
+
+    # Query plan of a statement as a list of strings, see HOT_QUERIES
+    async def explain(self, sql, parameters=()):
+        cursor = await self.conn.execute("EXPLAIN QUERY PLAN " + sql, parameters)
+        return [row[-1] for row in await cursor.fetchall()]
+
+    # Aggregates for the admin stats command, no table is read into memory
+    async def stats(self, top=10):
+        async with self._reader() as conn:
+            cursor = await conn.execute(
+                """
+                SELECT
+                    (SELECT COUNT(*) FROM Clients),
+                    (SELECT COUNT(*) FROM Markets),
+                    (SELECT COUNT(*) FROM Markets WHERE Ended = 1),
+                    (SELECT COUNT(*) FROM client_markets),
+                    (SELECT COUNT(DISTINCT object_id) FROM client_markets),
+                    (SELECT MIN(Checked) FROM Markets WHERE Ended = 0
+                        AND Isin IN (SELECT object_id FROM client_markets))
+                """
+            )
+            clients, markets, ended, tracked, distinct, oldest = await cursor.fetchone()
+
+            cursor = await conn.execute(MOST_TRACKED, (top,))
+            most_tracked = await cursor.fetchall()
+
+        size = 0
+        for path in (self.database_file, self.database_file + "-wal"):
+            if os.path.exists(path):
+                size += os.path.getsize(path)
+
+        return {
+            "clients": clients,
+            "markets": markets,
+            "ended": ended,
+            "tracked": tracked,
+            "distinct_isins": distinct,
+            "oldest_quote_age": time.time() - oldest if oldest is not None else None,
+            "most_tracked": most_tracked,
+            "file_size": size,
+        }
+
+    # Stream a whole table as (column names, rows) batches of batch_size rows
+    async def dump(self, table, batch_size=None):
+        if table not in DUMP_TABLES:
+            raise ValueError("Unknown table: %s" % table)
+        batch_size = batch_size or settings.DB_DUMP_BATCH_SIZE
+
+        async with self._reader() as conn:
+            async with conn.execute("SELECT * FROM %s" % table) as cursor:
+                columns = [column[0] for column in cursor.description]
+                while True:
+                    rows = await cursor.fetchmany(batch_size)
+                    if not rows:
+                        break
+                    yield columns, rows
+
+
+# Latency of every public Database method, when metrics are enabled
+metrics.instrument(Database, metrics.DB_SECONDS, metrics.DB_ERRORS)
@@ -1,5 +1,5 @@
 #! /usr/bin/env python3
-from telethon import TelegramClient, events, utils, Button
+from telethon import TelegramClient, events, utils, types, Button
 from emoji import emojize
 from enum import Enum, auto
 from tabulate import tabulate
@@ -8,11 +8,18 @@ import settings
 import logging
 import db
 import webscraper
+import refresher
+import quoteservice
+import providers
+import tradinghours
+import metrics
 import orjson
 import asyncio
 import os
 import re
 import ast
+import csv
+import tempfile
 import pprint as pp
 
 # Logger
@@ -58,47 +65,109 @@ mk_home = [
 # The amount of items to show before paging occures
 list_paging = 4
 
+# Telegram user IDs allowed to use the stats command, read from credentials.json
+admins = set()
 
-async def generate_message(user, value):
-    data = await Database.read_database(user, "Markets", value)
-    settings = await Database.read_database(user, "Settings")
 
-    day = "{day}%".format(day=data["Day"])
-    if "-" in data["Day"]:
+def fmt_value(value):
+    # Quote values are floats or None, formatted only when rendering
+    return "-" if value is None else f"{value:.2f}"
+
+
+def generate_message(data, user_settings):
+    # data is a db.PortfolioRow, user_settings the user's Settings row
+    day = "{day}%".format(day=fmt_value(data.Day))
+    if data.Day is None:
+        day = "-"
+    elif data.Day < 0:
         day = "{} {}".format(emojize(':down_arrow:'), day)  # ⬇️
-    elif float(data["Day"].replace(",", ".").replace(" %", "")) > 0.01:
+    elif data.Day > 0.01:
         day = "{} {}".format(emojize(':up_arrow:'), day)  # ⬆️
 
     stoploss = "€{sl1}  {sl2}%".format(
-        sl1=data["Stoploss"], sl2=data["Stoploss_dist"])
+        sl1=fmt_value(data.Stoploss), sl2=fmt_value(data.Stoploss_dist))
 
-    ref = "€{ref}".format(ref=data["Reference"])
+    ref = "€{ref}".format(ref=fmt_value(data.Reference))
 
    # Need a more elegant solution. Perhaps with tabulate
-   # Currently only from ING
-    message = "[{product}](https://www.ingmarkets.nl{market_url})\n".format(
-        product=data["Title"], market_url=data["Market_url"])
-
-    if settings["Isin"]:
-        message += "**ISIN**             [{Isin}](https://www.ingmarkets.nl/producten/{Isin})\n".format(
-            Isin=data["Isin"])
-    if settings["Bid"]:
-        message += "**Bid**               __{Bid}__\n".format(Bid=data["Bid"])
-    if settings["Ask"]:
-        message += "**Ask**               __{Ask}__\n".format(Ask=data["Ask"])
-    if settings["Day"]:
+    provider = providers.route(data.Isin) or providers.Default
+    message = "[{product}]({market_link})\n".format(
+        product=data.Title, market_link=provider.market_link(data.Market_url))
+
+    if user_settings["Isin"]:
+        message += "**ISIN**             [{Isin}]({link})\n".format(
+            Isin=data.Isin, link=provider.product_url(data.Isin))
+    if user_settings["Bid"]:
+        message += "**Bid**               __{Bid}__\n".format(Bid=fmt_value(data.Bid))
+    if user_settings["Ask"]:
+        message += "**Ask**               __{Ask}__\n".format(Ask=fmt_value(data.Ask))
+    if user_settings["Day"]:
         message += "**%1 Day**       __{Day}__\n".format(Day=day)
-    if settings["Lever"]:
+    if user_settings["Lever"]:
         message += "**Lever**            __{Lever}__\n".format(
-            Lever=data["Lever"])
-    if settings["StopLoss"]:
+            Lever=fmt_value(data.Lever))
+    if user_settings["StopLoss"]:
         message += "**StopLoss**    __{Stoploss}__\n".format(Stoploss=stoploss)
-    if settings["Reference"]:
+    if user_settings["Reference"]:
         message += "**Reference**  __{Reference}__".format(Reference=ref)
 
     return message
 
 
+async def read_list_page(user, offset, limit):
+    # Read a page of the user's list, scraping only products whose stored
+    # quote is stale, see tradinghours.TradingCalendar.is_fresh().
+    # Everything else is kept fresh by the background refresher.
+    rows, user_settings, total = await Database.read_portfolio(user, offset, limit)
+
+    try:
+        stale = await Quotes.refresh([(row.Isin, row.Checked) for row in rows if not row.Ended])
+    except quoteservice.QuoteServiceError as e:
+        # Show the stored quotes until the quote service is back
+        logger.warning("Could not refresh the list: {}".format(e))
+        stale = 0
+    if stale:
+        rows, user_settings, total = await Database.read_portfolio(user, offset, limit)
+
+    return rows, user_settings, total
+
+
+def market_closed_note():
+    # Shown above the List outside trading hours, the quotes are from the last close
+    if tradinghours.Market.is_open():
+        return ""
+    last_close = tradinghours.Market.last_close()
+    return "{} __Market closed, last close {}__\n\n".format(
+        emojize(':locked:'), last_close.strftime("%a %d %b %H:%M"))
+
+
+def create_remove_buttons(offset, rows, total):
+    # Buttons to mark the products on one page of the Remove list
+    remove_paging = (list_paging * 2)
+    pages = int((total/remove_paging) + (total % remove_paging > 0))
+
+    mk = [ [
+        Button.inline(emojize(":cross_mark:") + " Cancel", b'Cancel_del'),
+        Button.inline(emojize(":check_mark:") + " Confirm", b'Confirm_del')
+    ] ]
+    paged_buttons = create_paged_buttons(offset, pages, "Remove")
+    if paged_buttons:
+        mk.insert(0, paged_buttons)
+
+    # Create buttons of all ISINs
+    for row in rows:
+        if row.mark_del:
+            item = "{} {} {}".format(emojize(":cross_mark:"), row.Title, row.Isin)
+        else:
+            item = "{} {}".format(row.Title, row.Isin)
+        mk.insert(0, [Button.inline(item, "{}_Remove_{}".format(offset, row.Isin))])
+
+    message = "📦 I'm ready. Tap on the products that you would like to delete.\nPage %d of %d" % (
+        offset, pages)
+
+    return message, mk
+
+
 def create_paged_buttons(offset, list_length, cb):
     mk = []
     if offset <= list_length and offset > 1:
@@ -115,37 +184,45 @@ async def main():
         API_HASH = data["API_HASH"]
         TOKEN = data["TOKEN"]
         NAME = data["NAME"]
+        admins.update(data.get("ADMINS", []))
 
     await Database._init()
     await Database.create_database()
+    await Database.load_market_index()
+    await Quotes._init()
 
     client = TelegramClient(NAME, API_ID, API_HASH)
 
     # Handlers
-    client.add_event_handler(start)
-    client.add_event_handler(stop)
-    #client.add_event_handler(welcome_back) # Disabled due to annoyance
-    client.add_event_handler(track)
-    client.add_event_handler(current_list)
-    client.add_event_handler(remove)
-    client.add_event_handler(user_settings)
-    client.add_event_handler(callback_confirm)
-    client.add_event_handler(callback_cancel)
-    client.add_event_handler(callback_close)
-    client.add_event_handler(callback_remove)
-    client.add_event_handler(callback_current_list)
-    client.add_event_handler(callback_settings)
-
-    # remove once complete
-    client.add_event_handler(database)
+    for handler in HANDLERS:
+        client.add_event_handler(handler)
     client.parse_mode = 'md'
 
     # Make a try except with ConnectionError
     await client.start(bot_token=TOKEN)
     # await client.catch_up()  # Broken
+
+    # With a quote service the service refreshes the quotes
+    Refresher = None
+    if isinstance(Quotes, quoteservice.LocalQuotes):
+        Refresher = refresher.QuoteRefresher(Database)
+        Refresher.start()
+
+    # Optional /metrics endpoint, see settings.METRICS_ENABLED
+    Metrics = metrics.MetricsServer()
+    if Refresher is not None:
+        metrics.collect("quote_cache", webscraper.Quotes.stats)
+    metrics.collect("settings_cache", Database.settings_cache.stats)
+    metrics.collect("db_writes", Database.write_stats)
+    metrics.collect("market_index", Database.market_index.stats)
+    await Metrics._init()
     try:
         await client.run_until_disconnected()
     finally:
+        await Metrics._close()
+        if Refresher is not None:
+            await Refresher.stop()
+        await Quotes._close()
         await Database._close()
 
 #############################################
@@ -154,12 +231,14 @@ async def main():
 
 
 @events.register(events.NewMessage(pattern=r'(?i).*\b(start)\b', incoming=True))
+@metrics.handler
 async def start(event):
     sender = await event.get_sender()
     name = utils.get_display_name(sender)
     user = utils.get_input_user(sender)
-    message = "Hi %s,\nI will update you on the stock exchange market with data from [ING Markets](https://www.ingmarkets.nl/)!\nAdd your first product by tapping the 'Track' button on your keyboard." % (
-        name)
+    sources = ", ".join("[{}]({}/)".format(provider.label, provider.base_url) for provider in providers.Enabled)
+    message = "Hi %s,\nI will update you on the stock exchange market with data from %s!\nAdd your first product by tapping the 'Track' button on your keyboard." % (
+        name, sources)
 
     await Database.new_user(user)
 
@@ -167,8 +246,14 @@ async def start(event):
 
     await event.reply(message, buttons=markup)
 
+    # "/start track_<isin>", the deep link of an inline search in another chat
+    match = re.fullmatch(r"(?i)\s*/start\s+track_([a-z]{2}[0-9a-z]{10})\s*", event.raw_text)
+    if match:
+        await add_product(event.client, user, match.group(1))
+
 
 @events.register(events.NewMessage(pattern=r'(?i).*\b(stop)\b', incoming=True))
+@metrics.handler
 async def stop(event):
     sender = await event.get_sender()
     name = utils.get_display_name(sender)
@@ -185,6 +270,7 @@ async def stop(event):
 #############################################
 
 @events.register(events.CallbackQuery(pattern=r'(?i)(Cancel)'))
+@metrics.handler
 async def callback_cancel(event):
     sender = await event.get_sender()
     user = utils.get_input_user(sender)
@@ -200,12 +286,10 @@ async def callback_cancel(event):
         pass
 
     if cb_type == "del":
-        isin_dict = await Database.read_database(user, "client_markets")
-
-        for key, val in isin_dict.items():
-            if not val:
-                continue
-            await Database.update_database(user, "client_markets", {key: 0})
+        rows, user_settings, total = await Database.read_portfolio(user)
+        marked = {row.Isin: 0 for row in rows if row.mark_del}
+        if marked:
+            await Database.update_database(user, "client_markets", marked)
 
     elif cb_type == "conv":
         await event.client.conversation(user.user_id).cancel_all()
@@ -214,6 +298,7 @@ async def callback_cancel(event):
 
 
 @events.register(events.CallbackQuery(pattern=r'(?i).*\b(Close)\b'))
+@metrics.handler
 async def callback_close(event):
     sender = await event.get_sender()
     user = utils.get_input_user(sender)
@@ -226,6 +311,7 @@ async def callback_close(event):
 
 
 @events.register(events.CallbackQuery(pattern=r'(?i)(Confirm)'))
+@metrics.handler
 async def callback_confirm(event):
     sender = await event.get_sender()
     user = utils.get_input_user(sender)
@@ -237,15 +323,16 @@ async def callback_confirm(event):
     # Try deleting marked ISINs
     try:
         if regex_data[1][1] == "del":
-            isin_dict = await Database.read_database(user, "client_markets")
+            rows, user_settings, total = await Database.read_portfolio(user)
+            marked = [row for row in rows if row.mark_del]
             message += "Deleted:\n"
-            for key, val in isin_dict.items():
-                if val:
-                    # Currently only from ING
-                    message += "[{product}](https://www.ingmarkets.nl{product_url})\n".format(
-                            product=key, product_url=key.replace(" ", "-"))
-                    payload = {"Isin": key}
-                    await Database.delete_from_database(user, "client_markets", payload)
+            for row in marked:
+                provider = providers.route(row.Isin) or providers.Default
+                message += "[{product}]({link})\n".format(
+                        product=row.Title, link=provider.product_url(row.Isin))
+            if marked:
+                payload = [{"Isin": row.Isin} for row in marked]
+                await Database.delete_from_database(user, "client_markets", payload)
     except IndexError:
         pass
 
@@ -253,63 +340,35 @@ async def callback_confirm(event):
 
 
 @events.register(events.CallbackQuery(pattern=r"(?i)([0-9]+)(_Remove)"))
+@metrics.handler
 async def callback_remove(event):
     sender = await event.get_sender()
     user = utils.get_input_user(sender)
     callback_data = event.data.decode("utf-8")
-    regex_data = re.findall(r"(?i)([0-9]+)(_Remove)|((nl|de)[0-9, A-Z]{10})", callback_data)
-    offset = int(regex_data[0][0])
+    regex_data = re.match(r"(?i)([0-9]+)_Remove(?:_(.*))?", callback_data)
+    offset = int(regex_data.group(1))
     remove_paging = (list_paging * 2)
 
     # Read database
-    isin_dict = await Database.read_database(user, "client_markets")
-    isin_list = list(isin_dict.keys())
-    paged_list = list(webscraper.chunks(isin_list, remove_paging))
+    rows, user_settings, total = await Database.read_portfolio(
+        user, (offset - 1) * remove_paging, remove_paging)
 
+    # Try marking the deletion of an ISIN, of any enabled provider
+    isin = providers.find_isin(regex_data.group(2) or "")
+    if isin is not None:
+        for index, row in enumerate(rows):
+            if row.Isin == isin:
+                rows[index] = row._replace(mark_del=int(not bool(row.mark_del)))
+                await Database.update_database(user, "client_markets", {isin: rows[index].mark_del})
 
-    # Create buttons
-    mk = [ [
-        Button.inline(emojize(":cross_mark:") + " Cancel", b'Cancel_del'),
-        Button.inline(emojize(":check_mark:") + " Confirm", b'Confirm_del')
-    ] ]
-    mk.insert(0, create_paged_buttons(offset, len(paged_list), "Remove"))
-
-    # Try marking the deletion of an ISIN
-    try:
-        isin = regex_data[1][2]
-        isin_dict[isin] = int(not bool(isin_dict[isin]))
-        await Database.update_database(user, "client_markets", {isin: isin_dict[isin]})
-    except IndexError:
-        pass
-
-    title_list = []
-    # Could eventually optimize this by including the title in the return of client_markets read
-    async def iterations(index):
-        data = await Database.read_database(user, "Markets", isin_list[index])
-        title_list.append(data["Title"])
-        return
-
-    coros = [iterations(index) for index in range(len(isin_list))]
-    await asyncio.gather(*coros)
-
-    # Create buttons of all ISINs
-    for index, value in enumerate(paged_list[offset - 1]):
-        if isin_dict[value]:
-            item = "{} {} {}".format(emojize(":cross_mark:"), title_list[index], value)
-        else:
-            item = "{} {}".format( title_list[index], value)
-        mk.insert(0, [Button.inline(item, "{}_Remove_{}".format(offset, value))])
-
-    pages = int((len(isin_list)/remove_paging) +
-                (len(isin_list) % remove_paging > 0))
-    message = "📦 I'm ready. Tap on the products that you would like to delete.\nPage %d of %d" % (
-        offset, pages)
+    message, mk = create_remove_buttons(offset, rows, total)
 
     markup = event.client.build_reply_markup(mk)
     await event.edit(message, buttons=markup, link_preview=False)
 
 
 @events.register(events.CallbackQuery(pattern=r"(?i)([0-9]+)(_List)"))
+@metrics.handler
 async def callback_current_list(event):
     sender = await event.get_sender()
     user = utils.get_input_user(sender)
@@ -317,23 +376,20 @@ async def callback_current_list(event):
     offset = int(re.search(r"(?i)([0-9]+)(_List)", callback_data).group(1))
     mk = []
 
-    isin_dict = await Database.read_database(user, "client_markets")
-    isin_list = list(isin_dict.keys())
-    paged_list = list(webscraper.chunks(isin_list, list_paging))
-    results = []
+    rows, user_settings, total = await read_list_page(user, (offset - 1) * list_paging, list_paging)
+    pages = int((total/list_paging) + (total % list_paging > 0))
 
-    coros = [generate_message(user, value) for value in paged_list[offset-1]]
-    messages = await asyncio.gather(*coros)
-    message = ''.join(map(str, messages))
+    message = market_closed_note() + ''.join(generate_message(row, user_settings) for row in rows)
 
     # Create buttons
-    mk.append(create_paged_buttons(offset, len(paged_list), "List"))
+    mk.append(create_paged_buttons(offset, pages, "List"))
 
     markup = event.client.build_reply_markup(mk)
     await event.edit(message, buttons=markup, link_preview=False)
 
 
 @events.register(events.CallbackQuery(pattern=r"(?i)([0-9]+)(_Settings)"))
+@metrics.handler
 async def callback_settings(event):
     sender = await event.get_sender()
     user = utils.get_input_user(sender)
@@ -373,7 +429,8 @@ async def callback_settings(event):
 # Main keyboard functions
 #############################################
 # Case insensitive matching with all other patterns
-@events.register(events.NewMessage(pattern=r'(?i)^(?!Cancel|Close|Track|List|Remove|Settings|database|db|Confirm|NL).+', incoming=True))
+@events.register(events.NewMessage(pattern=r'(?i)^(?!Cancel|Close|Track|List|Remove|Settings|stats|database|db|Confirm|NL).+', incoming=True))
+@metrics.handler
 async def welcome_back(event):
     sender = await event.get_sender()
     user = utils.get_input_user(sender)
@@ -383,11 +440,17 @@ async def welcome_back(event):
     await event.client.send_message(user.user_id, message, buttons=markup)
 
 @events.register(events.NewMessage(pattern=r'(?i).*\b(Track)\b', incoming=True))
+@metrics.handler
 async def track(event):
     sender = await event.get_sender()
     user = utils.get_input_user(sender)
-    message = "📦 I'm ready. Tell me the product's isin."
-    markup = event.client.build_reply_markup(mk_home)
+    message = "📦 I'm ready. Tell me the product's isin, or send a list or CSV file of them."
+
+    # "Track <isin>", as sent by the inline query results
+    match = re.fullmatch(r"(?i)\s*track\s+([a-z]{2}[0-9a-z]{10})\s*", event.raw_text)
+    if match:
+        await add_product(event.client, user, match.group(1))
+        return
 
     async with event.client.conversation(user.user_id) as conv:
         cancelButton = Button.inline(
@@ -399,101 +462,164 @@ async def track(event):
         # Remove the button
         await event.client.edit_message(msg, message)
 
-        # Check if isin is valid
-        valid = await webscraper.isValidIsin(response.text)
-        try:
-            isin = re.search(
-                r"(?i)((nl|de)[0-9, A-Z]{10})", response.text).group(0)
-        except AttributeError:
-            isin = response.text
+        if response.document is not None or len(providers.find_isins(response.text or "")) > 1:
+            await import_products(event.client, user, response)
+        else:
+            await add_product(event.client, user, response.text)
 
-        results, unavailable = await webscraper.getProductDataHTML([isin])
 
-        if valid:
-            await Database.insert_to_database(user, "Markets", results[0])
-            await Database.insert_to_database(user, "client_markets", results[0])
-            message = "Product added!"
-        else:
-            message = "Invalid isin."
+async def add_product(client, user, text):
+    markup = client.build_reply_markup(mk_home)
+
+    # Validate and scrape the product in one request
+    isin, valid, data = await Quotes.resolve(text)
+
+    if valid and data:
+        await Database.add_products(user, [data])
+        message = "Product added!"
+    elif valid:
+        message = "This product is no longer available."
+    elif valid is None:
+        provider = providers.route(isin) or providers.Default
+        message = "%s could not be reached, please try again later." % provider.label
+    else:
+        message = "Invalid isin."
+
+    await client.send_message(user.user_id, message, buttons=markup)
+
+
+async def import_products(client, user, response):
+    # Bulk Track: every ISIN in a pasted list or an uploaded CSV/text file.
+    # The products are checked through the scheduler while one message shows the progress,
+    # then added in a single transaction.
+    markup = client.build_reply_markup(mk_home)
+
+    text = response.text or ""
+    if response.document is not None:
+        if response.file.size > settings.IMPORT_MAX_FILE_SIZE:
+            message = "This file is too large, send at most %d kB." % (settings.IMPORT_MAX_FILE_SIZE // 1024)
+            await client.send_message(user.user_id, message, buttons=markup)
+            return
+        content = await client.download_media(response, file=bytes)
+        text = content.decode("utf-8-sig", errors="replace")
 
-        await event.client.send_message(user.user_id, message, buttons=markup)
+    isins = providers.find_isins(text)
+    if not isins:
+        await client.send_message(user.user_id, "No isins found.", buttons=markup)
+        return
+    if len(isins) > settings.IMPORT_MAX_PRODUCTS:
+        message = "Found %d isins, please send at most %d at a time." % (len(isins), settings.IMPORT_MAX_PRODUCTS)
+        await client.send_message(user.user_id, message, buttons=markup)
+        return
+
+    status = await client.send_message(user.user_id, "Checking %d products..." % len(isins))
+    progress = {"done": 0, "shown": 0}
+
+    def update(done, total):
+        progress["done"] = done
+
+    async def show_progress():
+        while True:
+            await asyncio.sleep(settings.IMPORT_PROGRESS_INTERVAL)
+            if progress["done"] != progress["shown"]:
+                progress["shown"] = progress["done"]
+                try:
+                    await client.edit_message(status, "Checking products... %d/%d" % (progress["done"], len(isins)))
+                except Exception as e:
+                    logger.debug("Could not show the import progress: {!r}".format(e))
+
+    ticker = asyncio.create_task(show_progress())
+    try:
+        results = await Quotes.resolve_many(isins, update)
+    finally:
+        ticker.cancel()
+
+    added = [data for isin, valid, data in results if valid and data]
+    saved = await Database.add_products(user, added)
+    await client.edit_message(status, "Checked %d products." % len(isins))
+    if saved is False:
+        await client.send_message(user.user_id, "The products could not be saved, please try again.", buttons=markup)
+        return
+
+    message = "Added %d of %d products." % (len(added), len(isins))
+    for title, wanted in (
+            ("No longer available", lambda valid, data: valid and not data),
+            ("Could not be reached", lambda valid, data: valid is None),
+            ("Invalid", lambda valid, data: valid is False)):
+        skipped = [isin for isin, valid, data in results if wanted(valid, data)]
+        if skipped:
+            message += "\n{}: {}".format(title, ", ".join(skipped))
+
+    await client.send_message(user.user_id, message, buttons=markup)
+
+
+@events.register(events.InlineQuery())
+@metrics.handler
+async def inline_search(event):
+    # @bot <prefix>: products that are already in the database, by ISIN or title.
+    # Answered from Database.market_index. In the bot's own chat picking one sends "Track <isin>".
+    # In other chats the bot would not see that message, those only get a button that
+    # opens the bot's chat with a deep link to the best match, see start().
+    matches = Database.market_index.lookup(event.text, settings.INLINE_RESULTS)
+    if not isinstance(event.query.peer_type, types.InlineQueryPeerTypeSameBotPM):
+        if not matches:
+            await event.answer([], cache_time=settings.INLINE_CACHE_TIME, private=True)
+            return
+        isin, title, product_type = matches[0]
+        await event.answer(
+            [], cache_time=settings.INLINE_CACHE_TIME, private=True,
+            switch_pm="Track {} ({})".format(title, isin), switch_pm_param="track_" + isin)
+        return
+
+    builder = event.builder
+    results = [
+        builder.article(
+            title, description="{} · {}".format(isin, product_type or "-"), id=isin, text="Track " + isin)
+        for isin, title, product_type in matches
+    ]
+    await event.answer(results, cache_time=settings.INLINE_CACHE_TIME, private=True)
 
 
 @events.register(events.NewMessage(pattern=r'(?i).*\b(List)\b', incoming=True))
+@metrics.handler
 async def current_list(event):
-    available_products = []
     sender = await event.get_sender()
     user = utils.get_input_user(sender)
     mk = None  # Initialize markup
     async with event.client.action(user.user_id, 'typing'):
 
-        isin_dict = await Database.read_database(user, "client_markets")
-        isin_list = list(isin_dict.keys())
-
-        if isin_list:
-            available_products, unavailable_products = await webscraper.getProductDataHTML(isin_list)
-            # Only update the data from the first four products
-            await Database.update_database(user, "Markets", [available_products[:list_paging], unavailable_products])
+        rows, user_settings, total = await read_list_page(user, 0, list_paging)
 
-            if len(isin_list) > list_paging:
+        if rows:
+            if total > list_paging:
                 mk = Button.inline("Next", "2_List")  # Keyboard
             else:
                 mk = mk_home
-            coros = [generate_message(user, value)
-                    for value in isin_list[:list_paging]]
-            messages = await asyncio.gather(*coros)
-            message = ''.join(map(str, messages))
+            message = market_closed_note() + ''.join(generate_message(row, user_settings) for row in rows)
         else:
             message = "Your list is empty."
             mk = mk_home
 
         markup = event.client.build_reply_markup(mk)
         await event.client.send_message(user.user_id, message, buttons=markup, link_preview=False)
-    # Update the rest of the products
-    await Database.update_database(user, "Markets", [available_products[list_paging:]])
 
 
 @events.register(events.NewMessage(pattern=r'(?i).*\b(Remove)\b', incoming=True))
+@metrics.handler
 async def remove(event):
     sender = await event.get_sender()
     user = utils.get_input_user(sender)
-    mk = [ [
-        Button.inline(emojize(":cross_mark:") + " Cancel", b'Cancel_del'),
-        Button.inline(emojize(":check_mark:") + " Confirm", b'Confirm_del')
-    ] ]
-
-    isin_dict = await Database.read_database(user, "client_markets")
-    isin_list = list(isin_dict.keys())
-    title_list = []
-
-    async def iterations(index):
-        data = await Database.read_database(user, "Markets", isin_list[index])
-        title_list.append(data["Title"])
-        return
-
-    coros = [iterations(index) for index in range(len(isin_list))]
-    await asyncio.gather(*coros)
-
     remove_paging = (list_paging * 2)
 
-    if len(isin_list) > remove_paging:
-        mk.insert(0, [Button.inline("Next", "2_Remove")])  # Keyboard
+    rows, user_settings, total = await Database.read_portfolio(user, 0, remove_paging)
 
-    for index, value in enumerate(isin_list[:remove_paging]):
-        if isin_dict[value]:
-            item = "{} {} {}".format(emojize(":cross_mark:"), title_list[index], value)
-        else:
-            item = "{} {}".format( title_list[index], value)
-        mk.insert(0, [Button.inline(item, "1_Remove_{}".format(value))])
-
-    pages = int((len(isin_list)/remove_paging) +
-                (len(isin_list) % remove_paging > 0))
-    message = "📦 I'm ready. Tap on the products that you would like to delete.\nPage 1 of %d" % pages
+    message, mk = create_remove_buttons(1, rows, total)
     markup = event.client.build_reply_markup(mk)
     await event.client.send_message(user.user_id, message, buttons=markup)
 
 
 @events.register(events.NewMessage(pattern=r'(?i).*\b(Settings)\b', incoming=True))
+@metrics.handler
 async def user_settings(event):
     sender = await event.get_sender()
     user = utils.get_input_user(sender)
@@ -517,14 +643,94 @@ async def user_settings(event):
     await event.client.send_message(user.user_id, message, buttons=markup)
 
 
-@events.register(events.NewMessage(pattern=r'(?i).*\b(database|db)\b', incoming=True))
-async def database(event):
-    # For debugging purposes only
-    await Database.print_database()
-    await event.reply("Check the console output")
+@events.register(events.NewMessage(pattern=r'(?i)^/?(stats|database|db)\b', incoming=True))
+@metrics.handler
+async def stats(event):
+    # Admins only, see ADMINS in credentials.json
+    # "stats" shows aggregates, "stats dump <table>" sends a table as CSV
+    sender = await event.get_sender()
+    user = utils.get_input_user(sender)
+    if user.user_id not in admins:
+        logger.warning("User ID %d is not allowed to use the stats command" % user.user_id)
+        return
+
+    args = event.raw_text.split()[1:]
+    if len(args) == 2 and args[0].lower() == "dump":
+        await send_dump(event, user, args[1])
+        return
+
+    data = await Database.stats()
+    try:
+        quotes = await Quotes.stats()
+    except quoteservice.QuoteServiceError as e:
+        logger.warning("Could not read the quote service stats: {}".format(e))
+        quotes = {"size": 0, "hit_ratio": 0.0}
+    cached_settings = Database.settings_cache.stats()
+
+    oldest = "-"
+    if data["oldest_quote_age"] is not None:
+        oldest = "%d s ago" % data["oldest_quote_age"]
+
+    message = "**Database**\n"
+    message += "Users: %d\n" % data["clients"]
+    message += "Products: %d (%d ended)\n" % (data["markets"], data["ended"])
+    message += "Tracked: %d by users, %d distinct ISINs\n" % (data["tracked"], data["distinct_isins"])
+    message += "Oldest quote: %s\n" % oldest
+    message += "File size: %.1f MB\n" % (data["file_size"] / 1024 / 1024)
+    message += "Quote cache: %d entries, %.0f%% hits\n" % (quotes["size"], quotes["hit_ratio"] * 100)
+    message += "Settings cache: %d entries, %.0f%% hits\n" % (cached_settings["size"], cached_settings["hit_ratio"] * 100)
+
+    if data["most_tracked"]:
+        table = tabulate(data["most_tracked"], headers=["ISIN", "Title", "Users"])
+        message += "\n**Most tracked**\n```\n%s\n```" % table
+
+    await event.reply(message, link_preview=False)
+
+
+async def send_dump(event, user, name):
+    # Rows are written to a CSV file batch by batch and sent as a document
+    tables = {table.lower(): table for table in db.DUMP_TABLES}
+    table = tables.get(name.lower())
+    if table is None:
+        await event.reply("Unknown table, choose from: %s" % ", ".join(db.DUMP_TABLES))
+        return
+
+    rows = 0
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, table + ".csv")
+        with open(path, "w", newline="", encoding="utf-8") as f:
+            writer = csv.writer(f)
+            async for columns, batch in Database.dump(table):
+                if not rows:
+                    writer.writerow(columns)
+                writer.writerows(batch)
+                rows += len(batch)
+
+        await event.client.send_file(user.user_id, path, caption="%s: %d rows" % (table, rows))
+
+
+# Registered by main(), in this order
+HANDLERS = [
+    start,
+    stop,
+    #welcome_back, # Disabled due to annoyance
+    track,
+    current_list,
+    remove,
+    user_settings,
+    callback_confirm,
+    callback_cancel,
+    callback_close,
+    callback_remove,
+    callback_current_list,
+    callback_settings,
+    stats,
+    inline_search,
+]
 
 if __name__ == '__main__':
     Database = db.Database(project_dir)
+    Quotes = quoteservice.connect(Database, project_dir)
     if loop is not None:
         loop.install()
 
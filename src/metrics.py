@@ -0,0 +1,187 @@
+import settings
+import logging
+import functools
+import inspect
+import time
+from bisect import bisect_left
+from collections import defaultdict
+from aiohttp import web
+
+# Logging
+logger = logging.getLogger('client.metrics')
+
+# Read once at import. When disabled, timed() and instrument() leave the
+# functions untouched and nothing is recorded.
+ENABLED = settings.METRICS_ENABLED
+
+
+class Counter():
+    def __init__(self, name, description, labels=()):
+        self.name = name
+        self.description = description
+        self.labels = labels
+        self.values = defaultdict(float)  # label values -> count
+
+    def inc(self, *label_values, amount=1):
+        self.values[label_values] += amount
+
+    def render(self):
+        lines = ["# HELP {} {}".format(self.name, self.description), "# TYPE {} counter".format(self.name)]
+        for label_values, value in sorted(self.values.items()):
+            lines.append("{}{} {}".format(self.name, format_labels(self.labels, label_values), format_value(value)))
+        return lines
+
+
+class Histogram():
+    def __init__(self, name, description, labels=(), buckets=None):
+        self.name = name
+        self.description = description
+        self.labels = labels
+        self.buckets = tuple(buckets or settings.METRICS_BUCKETS)
+        self.counts = {}  # label values -> count per bucket, the last one is +Inf
+        self.sums = defaultdict(float)
+
+    def observe(self, value, *label_values):
+        counts = self.counts.get(label_values)
+        if counts is None:
+            counts = self.counts[label_values] = [0] * (len(self.buckets) + 1)
+        counts[bisect_left(self.buckets, value)] += 1
+        self.sums[label_values] += value
+
+    def render(self):
+        lines = ["# HELP {} {}".format(self.name, self.description), "# TYPE {} histogram".format(self.name)]
+        for label_values, counts in sorted(self.counts.items()):
+            total = 0
+            for bound, count in zip(self.buckets + (float("inf"),), counts):
+                total += count
+                labels = format_labels(self.labels + ("le",), label_values + (format_value(bound),))
+                lines.append("{}_bucket{} {}".format(self.name, labels, total))
+            labels = format_labels(self.labels, label_values)
+            lines.append("{}_sum{} {}".format(self.name, labels, format_value(self.sums[label_values])))
+            lines.append("{}_count{} {}".format(self.name, labels, total))
+        return lines
+
+
+def format_labels(names, values):
+    if not names:
+        return ""
+    escaped = (str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n") for value in values)
+    return "{" + ",".join('{}="{}"'.format(name, value) for name, value in zip(names, escaped)) + "}"
+
+
+def format_value(value):
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value))
+
+
+# Everything recorded by the bot
+HANDLER_SECONDS = Histogram("bot_handler_duration_seconds", "Telegram handler latency", ("handler",))
+HANDLER_ERRORS = Counter("bot_handler_errors_total", "Telegram handlers that raised", ("handler",))
+FETCH_SECONDS = Histogram("scrape_fetch_duration_seconds", "Page fetches including retries", ("status",))
+FETCH_BYTES = Counter("scrape_fetch_bytes_total", "Bytes of fetched pages")
+PARSE_SECONDS = Histogram("scrape_parse_duration_seconds", "Page parsing including the executor queue", ("engine",))
+FETCH_PAGE_BYTES = Histogram(
+    "scrape_page_bytes", "Bytes read per product page", ("mode",),
+    (4096, 16384, 65536, 131072, 262144, 524288, 1048576))
+FETCH_FIELDS_SECONDS = Histogram(
+    "scrape_fields_duration_seconds", "Time until the fields of a product page were read", ("mode",))
+DB_SECONDS = Histogram("db_call_duration_seconds", "db.Database calls", ("method",))
+DB_ERRORS = Counter("db_call_errors_total", "db.Database calls that raised", ("method",))
+
+METRICS = [
+    HANDLER_SECONDS, HANDLER_ERRORS, FETCH_SECONDS, FETCH_BYTES, FETCH_PAGE_BYTES, FETCH_FIELDS_SECONDS,
+    PARSE_SECONDS, DB_SECONDS, DB_ERRORS]
+
+# (prefix, function returning a dict of numbers), exported as gauges, see collect()
+COLLECTORS = []
+
+
+def collect(prefix, function):
+    # Export the numbers of an existing stats() method, e.g. QuoteCache.stats
+    COLLECTORS.append((prefix, function))
+
+
+def timed(histogram, label, errors=None):
+    # Records the duration of an async function under `label`
+    def decorator(function):
+        if not ENABLED:
+            return function
+
+        @functools.wraps(function)
+        async def wrapper(*args, **kwargs):
+            started = time.perf_counter()
+            try:
+                return await function(*args, **kwargs)
+            except Exception:
+                if errors is not None:
+                    errors.inc(label)
+                raise
+            finally:
+                histogram.observe(time.perf_counter() - started, label)
+
+        return wrapper
+    return decorator
+
+
+def handler(function):
+    # Decorator for the Telethon handlers in main.py, below @events.register
+    return timed(HANDLER_SECONDS, function.__name__, HANDLER_ERRORS)(function)
+
+
+def instrument(cls, histogram, errors=None):
+    # Time every public async method of a class
+    if not ENABLED:
+        return cls
+    for name, attribute in list(vars(cls).items()):
+        if not name.startswith("_") and inspect.iscoroutinefunction(attribute):
+            setattr(cls, name, timed(histogram, name, errors)(attribute))
+    return cls
+
+
+def render():
+    lines = []
+    for metric in METRICS:
+        lines += metric.render()
+
+    for prefix, function in COLLECTORS:
+        try:
+            values = function()
+        except Exception as e:
+            logger.error("Collecting {} failed: {!r}".format(prefix, e))
+            continue
+        for key, value in values.items():
+            if isinstance(value, (bool, int, float)):
+                name = "{}_{}".format(prefix, key)
+                lines += ["# TYPE {} gauge".format(name), "{} {}".format(name, format_value(value))]
+
+    return "\n".join(lines) + "\n"
+
+
+class MetricsServer():
+    # Optional /metrics endpoint in the Prometheus text format.
+    # Opened and closed by main.main(), does nothing when METRICS_ENABLED is off.
+    def __init__(self):
+        self.logger = logging.getLogger('client.metrics')
+        self.runner = None
+
+    async def _init(self):
+        if not ENABLED or self.runner is not None:
+            return
+
+        app = web.Application()
+        app.router.add_get("/metrics", self.handle)
+        self.runner = web.AppRunner(app, access_log=None)
+        await self.runner.setup()
+        await web.TCPSite(self.runner, settings.METRICS_HOST, settings.METRICS_PORT).start()
+        self.logger.info("Metrics on http://%s:%d/metrics" % (settings.METRICS_HOST, settings.METRICS_PORT))
+
+    async def _close(self):
+        if self.runner is None:
+            return
+        await self.runner.cleanup()
+        self.runner = None
+        self.logger.debug("Metrics endpoint closed")
+
+    async def handle(self, request):
+        return web.Response(text=render(), content_type="text/plain", charset="utf-8")
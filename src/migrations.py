@@ -0,0 +1,229 @@
+import logging
+
+# Logging
+logger = logging.getLogger('client.migrations')
+
+
+# Schema migrations, applied in order at startup by Database.create_database().
+# The applied version is stored in PRAGMA user_version.
+# Every migration must also work on databases created before this framework
+# existed, those start at version 0 with some tables already present.
+
+
+async def baseline(conn):
+    # The original schema
+    # Not sure how settings_id and list_id work
+    await conn.execute(
+        """
+        CREATE TABLE IF NOT EXISTS Clients (
+            user_id BIGINT UNIQUE PRIMARY KEY,
+            settings_id BIGINT,
+            list_id BIGINT
+        );
+        """
+    )
+
+    # Only one settings object per user (one-to-many)
+    await conn.execute("""CREATE TABLE IF NOT EXISTS Settings
+        (
+            user_id        INTEGER UNIQUE PRIMARY KEY,
+            Isin           BOOLEAN NOT NULL CHECK (Isin      IN (0,1)) DEFAULT 1,
+            Type           BOOLEAN NOT NULL CHECK (Type      IN (0,1)) DEFAULT 1,
+            Bid            BOOLEAN NOT NULL CHECK (Bid       IN (0,1)) DEFAULT 1,
+            Ask            BOOLEAN NOT NULL CHECK (Ask       IN (0,1)) DEFAULT 1,
+            Day            BOOLEAN NOT NULL CHECK (Day       IN (0,1)) DEFAULT 1,
+            Lever          BOOLEAN NOT NULL CHECK (Lever     IN (0,1)) DEFAULT 1,
+            StopLoss       BOOLEAN NOT NULL CHECK (StopLoss  IN (0,1)) DEFAULT 1,
+            Reference      BOOLEAN NOT NULL CHECK (Reference IN (0,1)) DEFAULT 1,
+            FOREIGN KEY(user_id) REFERENCES Clients(user_id) ON DELETE CASCADE
+        );
+    """)
+
+    await conn.execute(
+        """
+        CREATE TABLE IF NOT EXISTS Markets (
+        Title          TEXT NOT NULL,
+        Isin           TEXT UNIQUE PRIMARY KEY,
+        Market_url     TEXT,
+        Type           TEXT,
+        Bid            REAL,
+        Ask            REAL,
+        Day            TEXT,
+        Lever          REAL,
+        Stoploss       TEXT,
+        Stoploss_dist  TEXT,
+        Reference      TEXT,
+        Ended          BOOLEAN NOT NULL CHECK (Ended IN (0,1)) DEFAULT 0
+        );
+        """
+    )
+
+    await conn.execute(
+        """
+        CREATE TABLE IF NOT EXISTS client_markets (
+            user_id   BIGINT,
+            object_id BIGINT,
+            mark_del  BOOLEAN NOT NULL CHECK (mark_del IN (0,1)) DEFAULT 0,
+            FOREIGN KEY(user_id) REFERENCES Clients(user_id) ON DELETE CASCADE,
+            FOREIGN KEY(object_id) REFERENCES Markets(Isin) ON DELETE CASCADE
+        )
+        """
+    )
+
+
+async def markets_updated(conn):
+    # Timestamp of the last scrape, used by the background refresher
+    if "Updated" not in await columns(conn, "Markets"):
+        await conn.execute("ALTER TABLE Markets ADD COLUMN Updated REAL")
+
+
+async def client_markets_keys(conn):
+    # Composite primary key instead of a full table scan for every per-user read.
+    # WITHOUT ROWID stores the rows in key order, so the primary key covers
+    # every per-user query. object_id holds ISINs and becomes TEXT.
+    await conn.execute(
+        """
+        CREATE TABLE client_markets_new (
+            user_id   BIGINT NOT NULL,
+            object_id TEXT NOT NULL,
+            mark_del  BOOLEAN NOT NULL CHECK (mark_del IN (0,1)) DEFAULT 0,
+            PRIMARY KEY (user_id, object_id),
+            FOREIGN KEY(user_id) REFERENCES Clients(user_id) ON DELETE CASCADE,
+            FOREIGN KEY(object_id) REFERENCES Markets(Isin) ON DELETE CASCADE
+        ) WITHOUT ROWID
+        """
+    )
+    # Drop duplicates, keep a product marked when any duplicate was
+    await conn.execute(
+        """
+        INSERT INTO client_markets_new (user_id, object_id, mark_del)
+        SELECT user_id, object_id, MAX(mark_del)
+        FROM client_markets
+        WHERE user_id IS NOT NULL AND object_id IS NOT NULL
+        GROUP BY user_id, object_id
+        """
+    )
+    await conn.execute("DROP TABLE client_markets")
+    await conn.execute("ALTER TABLE client_markets_new RENAME TO client_markets")
+
+    # Products to their users: refresher, cascading deletes from Markets
+    await conn.execute("CREATE INDEX client_markets_object_id ON client_markets (object_id, user_id)")
+
+
+async def clients_unused_columns(conn):
+    # settings_id and list_id were never used
+    await conn.execute(
+        """
+        CREATE TABLE Clients_new (
+            user_id BIGINT UNIQUE PRIMARY KEY
+        )
+        """
+    )
+    await conn.execute("INSERT INTO Clients_new (user_id) SELECT user_id FROM Clients")
+    await conn.execute("DROP TABLE Clients")
+    await conn.execute("ALTER TABLE Clients_new RENAME TO Clients")
+
+
+async def markets_numeric(conn):
+    # Quote values were stored as formatted TEXT ("1.23", older rows "1,23 %").
+    # Store them as REAL so SQL can sort, filter and aggregate on them.
+    await conn.execute(
+        """
+        CREATE TABLE Markets_new (
+        Title          TEXT NOT NULL,
+        Isin           TEXT UNIQUE PRIMARY KEY,
+        Market_url     TEXT,
+        Type           TEXT,
+        Bid            REAL,
+        Ask            REAL,
+        Day            REAL,
+        Lever          REAL,
+        Stoploss       REAL,
+        Stoploss_dist  REAL,
+        Reference      REAL,
+        Ended          BOOLEAN NOT NULL CHECK (Ended IN (0,1)) DEFAULT 0,
+        Updated        REAL
+        )
+        """
+    )
+    await conn.execute(
+        """
+        INSERT INTO Markets_new
+        SELECT Title, Isin, Market_url, Type, {}, {}, {}, {}, {}, {}, {}, Ended, Updated
+        FROM Markets
+        """
+        .format(*[to_real(column) for column in
+                  ("Bid", "Ask", "Day", "Lever", "Stoploss", "Stoploss_dist", "Reference")])
+    )
+    await conn.execute("DROP TABLE Markets")
+    await conn.execute("ALTER TABLE Markets_new RENAME TO Markets")
+
+
+async def markets_checked(conn):
+    # Updated only moves when the values change, Checked is the time of the last scrape
+    if "Checked" not in await columns(conn, "Markets"):
+        await conn.execute("ALTER TABLE Markets ADD COLUMN Checked REAL")
+    await conn.execute("UPDATE Markets SET Checked = Updated")
+
+
+def to_real(column):
+    # SQL expression converting a formatted TEXT value to REAL, NULL when it holds no number
+    cleaned = "REPLACE(REPLACE(REPLACE(REPLACE(REPLACE({0}, '%', ''), '€', ''), ' ', ''), char(160), ''), ',', '.')"
+    return (
+        "CASE WHEN typeof({0}) = 'text' THEN "
+        "CASE WHEN {1} GLOB '*[0-9]*' THEN CAST({1} AS REAL) END "
+        "ELSE {0} END"
+    ).format(column, cleaned.format(column))
+
+
+MIGRATIONS = [
+    baseline,
+    markets_updated,
+    client_markets_keys,
+    clients_unused_columns,
+    markets_numeric,
+    markets_checked,
+]
+
+
+async def columns(conn, table):
+    cursor = await conn.execute("PRAGMA table_info({})".format(table))
+    return [row[1] for row in await cursor.fetchall()]
+
+
+async def schema_version(conn):
+    cursor = await conn.execute("PRAGMA user_version")
+    return (await cursor.fetchone())[0]
+
+
+async def migrate(conn):
+    # Apply every pending migration, each in its own transaction
+    version = await schema_version(conn)
+    if version >= len(MIGRATIONS):
+        return version
+
+    # Tables are rebuilt, foreign keys can only be toggled outside a transaction
+    await conn.commit()
+    await conn.execute("PRAGMA foreign_keys = 0")
+    try:
+        for index, migration in enumerate(MIGRATIONS[version:], start=version + 1):
+            logger.info("Applying migration %d: %s" % (index, migration.__name__))
+            await conn.execute("BEGIN")
+            try:
+                await migration(conn)
+
+                cursor = await conn.execute("PRAGMA foreign_key_check")
+                violations = await cursor.fetchall()
+                if violations:
+                    raise RuntimeError("Migration %d broke foreign keys: %s" % (index, violations))
+
+                await conn.execute("PRAGMA user_version = %d" % index)
+                await conn.commit()
+            except Exception:
+                await conn.rollback()
+                raise
+            version = index
+    finally:
+        await conn.execute("PRAGMA foreign_keys = 1")
+
+    return version
@@ -0,0 +1,575 @@
+import settings
+import logging
+import asyncio
+import concurrent.futures
+import multiprocessing
+import hashlib
+import metrics
+import os
+import signal
+import threading
+import time
+from bs4 import BeautifulSoup
+from lxml import etree
+from typing import NamedTuple, Optional
+import re
+
+# Logging
+logger = logging.getLogger('client.parsing')
+
+
+class Quote(NamedTuple):
+    # Numeric values of the Performance block, formatted by main.generate_message()
+    Bid: Optional[float] = None
+    Ask: Optional[float] = None
+    Day: Optional[float] = None             # % 1 Dag
+    Lever: Optional[float] = None           # Hefboom
+    Stoploss: Optional[float] = None        # Stop-loss niveau
+    Stoploss_dist: Optional[float] = None   # Afstand tot stop loss-niveau, in %
+    Reference: Optional[float] = None       # Referentiekoers*
+
+
+class ParseTimeout(Exception):
+    # A page took longer than PARSE_TIMEOUT to parse
+    pass
+
+
+class ParserPool():
+    # Runs page parsing outside of the event loop.
+    # Uses a process pool so parsing scales over multiple cores and falls back
+    # to a thread pool where processes are unavailable.
+    # Pages wait in the event loop until a worker is free, so PARSE_TIMEOUT only
+    # counts the time a worker spends on the page. Process workers stop a page
+    # themselves after PARSE_TIMEOUT (run_bounded); a worker that is still busy
+    # PARSE_RECYCLE_AFTER seconds later is stuck and its pool is replaced.
+    # Opened and closed by main.main().
+    def __init__(self):
+        self.logger = logging.getLogger('client.parsing')
+        self.executor = None
+        self.kind = None
+        self.workers = None
+        self.slots = None
+
+    def _init(self, kind=None):
+        if self.executor is not None:
+            return
+
+        self.workers = settings.PARSER_WORKERS or os.cpu_count() or 1
+        kind = kind or settings.PARSER_EXECUTOR
+        if kind == "process":
+            try:
+                context = multiprocessing.get_context(settings.PARSER_START_METHOD)
+                self.executor = concurrent.futures.ProcessPoolExecutor(
+                    max_workers=self.workers, mp_context=context)
+                self.kind = "process"
+            except (ImportError, NotImplementedError, OSError, ValueError) as e:
+                self.logger.warning("Process pool unavailable, parsing in threads: {!r}".format(e))
+
+        if self.executor is None:
+            self.executor = concurrent.futures.ThreadPoolExecutor(
+                max_workers=self.workers, thread_name_prefix="parser")
+            self.kind = "thread"
+
+        if self.slots is None:
+            self.slots = asyncio.Semaphore(self.workers)
+        self.logger.debug("Parser pool active ({}, {} workers)".format(self.kind, self.workers))
+
+    def _close(self):
+        if self.executor is None:
+            return
+        self.executor.shutdown(wait=False, cancel_futures=True)
+        self.executor = None
+        self.slots = None
+        self.logger.debug("Parser pool closed")
+
+    def _recycle(self, executor, isin):
+        # Replace a pool whose worker overran PARSE_TIMEOUT, the other pages on it are parsed again
+        if executor is not self.executor:
+            return
+        self.logger.error("Parsing %s did not stop after %d s, replacing the %s pool" % (
+            isin, settings.PARSE_TIMEOUT + settings.PARSE_RECYCLE_AFTER, self.kind))
+        processes = list((getattr(executor, "_processes", None) or {}).values())
+        executor.shutdown(wait=False, cancel_futures=True)
+        for process in processes:
+            process.terminate()
+        self.executor = None
+        self._init(self.kind)
+
+    async def parse(self, isin, html, function=None):
+        # Returns the result of function (parse_product_page by default), raises ParseTimeout
+        function = function or parse_product_page
+        self._init()
+        loop = asyncio.get_running_loop()
+
+        while True:
+            async with self.slots:
+                executor = self.executor
+                started = time.perf_counter()
+                try:
+                    result = await asyncio.wait_for(
+                        loop.run_in_executor(executor, run_bounded, function, isin, html, settings.PARSE_TIMEOUT),
+                        settings.PARSE_TIMEOUT + settings.PARSE_RECYCLE_AFTER)
+                except asyncio.TimeoutError:
+                    self._recycle(executor, isin)
+                    raise ParseTimeout(isin)
+                except concurrent.futures.BrokenExecutor:
+                    if executor is self.executor:
+                        # A worker died, parse in threads from now on
+                        self.logger.error("Process pool broke, falling back to threads")
+                        executor.shutdown(wait=False, cancel_futures=True)
+                        self.executor = None
+                        self._init("thread")
+                    # Otherwise the pool was recycled while this page was on it
+                    continue
+
+            if metrics.ENABLED:
+                metrics.PARSE_SECONDS.observe(time.perf_counter() - started, settings.PARSER_ENGINE)
+            return result
+
+
+def run_bounded(function, isin, html, timeout):
+    # Runs function(isin, html) in a worker and raises ParseTimeout after timeout seconds.
+    # Needs SIGALRM and the worker's main thread, so it only bounds process workers;
+    # ParserPool recycles the pool when a page cannot be stopped this way.
+    if not hasattr(signal, "setitimer") or threading.current_thread() is not threading.main_thread():
+        return function(isin, html)
+
+    def overrun(signum, frame):
+        raise ParseTimeout(isin)
+
+    previous = signal.signal(signal.SIGALRM, overrun)
+    signal.setitimer(signal.ITIMER_REAL, timeout)
+    try:
+        return function(isin, html)
+    finally:
+        signal.setitimer(signal.ITIMER_REAL, 0)
+        signal.signal(signal.SIGALRM, previous)
+
+
+def parse_product_page(isin, html):
+    # Parse a product page into (available, data).
+    # Module level and working on plain strings and dicts so it can run in a worker process.
+    if settings.PARSER_ENGINE == "lxml":
+        result = parse_product_page_lxml(isin, html)
+    else:
+        result = parse_product_page_bs4(isin, html)
+
+    if settings.PARSER_COMPARE:
+        differences = compare_engines(isin, html)
+        if differences:
+            logger.warning("Parser engines disagree on %s: %s" % (isin, differences))
+
+    return result
+
+
+def compare_engines(isin, html):
+    # Returns {key: (bs4 value, lxml value)} for every field the engines disagree on
+    bs4_result = parse_product_page_bs4(isin, html)
+    lxml_result = parse_product_page_lxml(isin, html)
+
+    differences = {}
+    if bs4_result[0] != lxml_result[0]:
+        differences["available"] = (bs4_result[0], lxml_result[0])
+    for key in bs4_result[1].keys() | lxml_result[1].keys():
+        if bs4_result[1].get(key) != lxml_result[1].get(key):
+            differences[key] = (bs4_result[1].get(key), lxml_result[1].get(key))
+    return differences
+
+
+def parse_product_page_bs4(isin, html):
+    # Reference implementation on a full BeautifulSoup tree
+    soup = BeautifulSoup(html, 'lxml')
+    try:
+        name = []
+        # Find name
+        for h1_tag in soup.find_all('h1'):
+            name.append(h1_tag.get_text(strip=True))
+        product_name = name[-1]
+        # Unknown if this still works
+        if "Beëindigd" in name:
+            return False, {"Isin": isin, "Ended": 1}
+    except (IndexError, TypeError, KeyError, AttributeError) as e:
+        return False, {"Isin": isin, "Ended": 1}
+
+    market_url = None
+    product_type = None
+
+    dt = soup.find('dt', string=lambda txt: txt and 'Onderliggende' in txt)
+    if dt:
+        dd = dt.find_next_sibling('dd')
+        product_name = dd.get_text(strip=True) if dd else None
+        a = dd.find('a') if dd else None
+        market_url = a['href'] if a and a.has_attr('href') else None
+
+    dt = soup.find('dt', string=lambda txt: txt and 'Positie' in txt)
+    if dt:
+        dd = dt.find_next_sibling('dd')
+        product_type = dd.get_text(strip=True) if dd else None
+
+    quote = extract_performance_block(soup)
+    temp_dict = {}
+    temp_dict["Title"] = product_name
+    temp_dict["Market"] = market_url
+    temp_dict["Isin"] = isin
+    temp_dict.update(quote._asdict())
+    temp_dict["Type"] = product_type
+    temp_dict["Ended"] = 0
+
+    return True, temp_dict
+
+
+def extract_performance_block(soup):
+    perf = soup.find("div", {"aria-label": "Performance"})
+    if not perf:
+        logger.debug("[extract_performance_block] No <aria-label Performance> found")
+        return Quote()
+
+    def get_dt_dd(perf, label):
+        # Find <dt> that starts with the label, ignoring nested spans
+        for dt in perf.find_all("dt"):
+            # Extract only the text nodes, ignoring spans
+            dt_text = "".join(dt.find_all(string=True, recursive=False)).strip()
+            if label in dt_text:
+                dd = dt.find_next("dd")
+                if not dd:
+                    return None
+
+                val = dd.find("span", class_="value")
+                if not val:
+                    val = dd.find("span", class_=lambda c: c and "value" in c)
+
+                return val.text.strip() if val else None
+
+        return None
+
+    # Raw values
+    raw_day = get_dt_dd(perf, "% 1 Dag")
+    raw_bid = get_dt_dd(perf, "Bied")
+    raw_ask = get_dt_dd(perf, "Laat")
+    raw_lever = get_dt_dd(perf, "Hefboom")
+    raw_stoploss = get_dt_dd(perf, "Stop-loss niveau")
+    raw_dist = get_dt_dd(perf, "Afstand tot stop loss-niveau")
+    raw_reference = get_dt_dd(perf, "Referentiekoers")
+
+    return make_quote(raw_bid, raw_ask, raw_day, raw_lever, raw_stoploss, raw_dist, raw_reference)
+
+
+def make_quote(raw_bid, raw_ask, raw_day, raw_lever, raw_stoploss, raw_dist, raw_reference):
+    return Quote(
+        Bid=parse_number(raw_bid),
+        Ask=parse_number(raw_ask),
+        Day=parse_percent(raw_day),
+        Lever=parse_number(raw_lever),
+        Stoploss=parse_number(raw_stoploss),
+        Stoploss_dist=parse_percent(raw_dist),
+        Reference=parse_number(raw_reference),
+    )
+
+
+# Percentage as a float, "1,23 %" -> 1.23
+def parse_percent(raw):
+    if raw is None:
+        return None
+    cleaned = (
+        str(raw)
+        .replace(",", ".")
+        .replace("%", "")
+    )
+    try:
+        return float(cleaned)
+    except ValueError:
+        return None
+
+# Plain numeric value as a float, "€ 1.234,56" -> 1234.56
+def parse_number(raw):
+    if raw is None:
+        return None
+    s = str(raw)
+    # Normalize formatting
+    s = s.replace("\xa0", "")      # remove NBSP
+    s = s.replace("€", "")         # remove euro symbol
+    s = s.replace(" ", "")         # remove normal spaces
+    s = re.sub(r"\.(?=\d{3}(,|$))", "", s) # Remove thousands separators (dots before commas)
+    s = s.replace(",", ".") # Convert decimal comma → dot
+    s = re.sub(r"[^0-9.\-]", "", s) # Strip everything except digits, dot, minus
+
+    try:
+        return float(s)
+    except ValueError:
+        return None
+
+
+# Raw Performance block, see performance_fingerprint()
+PERFORMANCE_MARKER = 'aria-label="Performance"'
+DIV_TAG = re.compile(r"<(/?)div\b", re.IGNORECASE)
+
+
+def performance_fingerprint(html):
+    # Hash of the Performance block as sent by ING, without parsing the page.
+    # None when the block is missing or unbalanced, such pages are always parsed.
+    if not html:
+        return None
+    marker = html.find(PERFORMANCE_MARKER)
+    start = html.rfind("<div", 0, marker) if marker >= 0 else -1
+    if start < 0:
+        return None
+
+    depth = 0
+    for match in DIV_TAG.finditer(html, start):
+        depth += -1 if match.group(1) else 1
+        if depth == 0:
+            return hashlib.blake2b(html[start:match.end()].encode("utf-8"), digest_size=16).digest()
+    return None
+
+
+#############################################
+# lxml engine
+#############################################
+
+# Precompiled expressions, every field is collected in one pass over the <dt>s
+XPATH_H1 = etree.XPath("//h1")
+XPATH_DT = etree.XPath("//dt")
+XPATH_PERFORMANCE = etree.XPath('(//div[@aria-label="Performance"])[1]')
+XPATH_PERFORMANCE_DT = etree.XPath(".//dt")
+XPATH_NEXT_SIBLING_DD = etree.XPath("following-sibling::dd[1]")
+XPATH_NEXT_DD = etree.XPath("(descendant::dd | following::dd)[1]")
+XPATH_FIRST_A = etree.XPath("(.//a)[1]")
+XPATH_VALUE_SPAN = etree.XPath(
+    "(.//span[contains(concat(' ', normalize-space(@class), ' '), ' value ')])[1]")
+XPATH_LOOSE_VALUE_SPAN = etree.XPath("(.//span[contains(@class, 'value')])[1]")
+
+PERFORMANCE_LABELS = (
+    ("Day", "% 1 Dag"),
+    ("Bid", "Bied"),
+    ("Ask", "Laat"),
+    ("Lever", "Hefboom"),
+    ("Stoploss", "Stop-loss niveau"),
+    ("Stoploss_dist", "Afstand tot stop loss-niveau"),
+    ("Reference", "Referentiekoers"),
+)
+
+
+def parse_product_page_lxml(isin, html):
+    # Same result as parse_product_page_bs4, without building a BeautifulSoup tree
+    return parse_product_tree(isin, parse_html(html))
+
+
+def parse_product_tree(isin, root):
+    if root is None:
+        return False, {"Isin": isin, "Ended": 1}
+
+    name = [get_text(h1, strip=True) for h1 in XPATH_H1(root)]
+    if not name or "Beëindigd" in name:
+        return False, {"Isin": isin, "Ended": 1}
+    product_name = name[-1]
+
+    market_url = None
+    product_type = None
+    underlying_dt = None
+    position_dt = None
+
+    # Equivalent of soup.find('dt', string=...), for both labels at once
+    for dt in XPATH_DT(root):
+        text = get_string(dt)
+        if text is None:
+            continue
+        if underlying_dt is None and 'Onderliggende' in text:
+            underlying_dt = dt
+        if position_dt is None and 'Positie' in text:
+            position_dt = dt
+        if underlying_dt is not None and position_dt is not None:
+            break
+
+    if underlying_dt is not None:
+        dd = first(XPATH_NEXT_SIBLING_DD(underlying_dt))
+        product_name = get_text(dd, strip=True) if dd is not None else None
+        a = first(XPATH_FIRST_A(dd)) if dd is not None else None
+        market_url = a.get('href') if a is not None else None
+
+    if position_dt is not None:
+        dd = first(XPATH_NEXT_SIBLING_DD(position_dt))
+        product_type = get_text(dd, strip=True) if dd is not None else None
+
+    quote = extract_performance_block_lxml(root)
+    temp_dict = {}
+    temp_dict["Title"] = product_name
+    temp_dict["Market"] = market_url
+    temp_dict["Isin"] = isin
+    temp_dict.update(quote._asdict())
+    temp_dict["Type"] = product_type
+    temp_dict["Ended"] = 0
+
+    return True, temp_dict
+
+
+def extract_performance_block_lxml(root):
+    perf = first(XPATH_PERFORMANCE(root))
+    if perf is None:
+        logger.debug("[extract_performance_block_lxml] No <aria-label Performance> found")
+        return Quote()
+
+    # Single pass: the first <dt> containing a label decides its value
+    raw = {}
+    for dt in XPATH_PERFORMANCE_DT(perf):
+        dt_text = get_own_text(dt).strip()
+        for key, label in PERFORMANCE_LABELS:
+            if key in raw or label not in dt_text:
+                continue
+
+            dd = first(XPATH_NEXT_DD(dt))
+            val = None
+            if dd is not None:
+                val = first(XPATH_VALUE_SPAN(dd))
+                if val is None:
+                    val = first(XPATH_LOOSE_VALUE_SPAN(dd))
+            raw[key] = get_text(val).strip() if val is not None else None
+
+        if len(raw) == len(PERFORMANCE_LABELS):
+            break
+
+    return make_quote(
+        raw.get("Bid"), raw.get("Ask"), raw.get("Day"), raw.get("Lever"),
+        raw.get("Stoploss"), raw.get("Stoploss_dist"), raw.get("Reference"))
+
+
+class PageStream():
+    # Incremental parse of a product page while it is downloading, see FETCH_STREAMING.
+    # feed() returns True once the <h1>, the "Onderliggende" and "Positie" values and
+    # the Performance block were read, or the page says Beëindigd. The rest of the page
+    # is not needed, the parser pool extracts the fields from html, what was read so far.
+    # feed() runs on the event loop, it raises ParseTimeout once it took PARSE_TIMEOUT in total.
+    def __init__(self, isin):
+        self.isin = isin
+        self.parser = etree.HTMLPullParser(events=("end",), encoding="utf-8")
+        self.chunks = []
+        self.bytes = 0
+        self.seconds = 0
+        self.complete = False
+
+        self.h1 = False
+        self.ended = False
+        self.underlying_dt = None
+        self.position_dt = None
+        self.underlying = False
+        self.position = False
+        self.performance = False
+
+    def feed(self, chunk):
+        started = time.perf_counter()
+        self.chunks.append(chunk)
+        self.bytes += len(chunk)
+        self.parser.feed(chunk)
+        for _, element in self.parser.read_events():
+            self._end(element)
+        self.seconds += time.perf_counter() - started
+        if self.seconds > settings.PARSE_TIMEOUT:
+            raise ParseTimeout(self.isin)
+        return self.complete
+
+    def _end(self, element):
+        # Mirrors the lookups of parse_product_tree(), on every closed element
+        tag = element.tag
+        if tag == "h1":
+            self.h1 = True
+            self.ended = self.ended or get_text(element, strip=True) == "Beëindigd"
+        elif tag == "dt":
+            text = get_string(element)
+            if text is not None:
+                if self.underlying_dt is None and 'Onderliggende' in text:
+                    self.underlying_dt = element
+                if self.position_dt is None and 'Positie' in text:
+                    self.position_dt = element
+        elif tag == "dd":
+            if not self.underlying and self.underlying_dt is not None:
+                self.underlying = first(XPATH_NEXT_SIBLING_DD(self.underlying_dt)) is element
+            if not self.position and self.position_dt is not None:
+                self.position = first(XPATH_NEXT_SIBLING_DD(self.position_dt)) is element
+        elif tag == "div" and element.get("aria-label") == "Performance":
+            self.performance = True
+
+        self.complete = self.ended or (self.h1 and self.underlying and self.position and self.performance)
+
+    @property
+    def html(self):
+        # The part of the page that was read, for performance_fingerprint() and the parser pool
+        return b"".join(self.chunks).decode("utf-8", "ignore")
+
+
+def parse_html(html):
+    if not html:
+        return None
+    if isinstance(html, str):
+        html = html.encode("utf-8")
+    try:
+        return etree.fromstring(html, etree.HTMLParser(encoding="utf-8"))
+    except (etree.ParserError, ValueError):
+        return None
+
+
+def first(elements):
+    return elements[0] if elements else None
+
+
+def get_text(element, strip=False):
+    # Tag.get_text(), comments are skipped by itertext()
+    if strip:
+        return "".join(text.strip() for text in element.itertext())
+    return "".join(element.itertext())
+
+
+def get_own_text(element):
+    # "".join(tag.find_all(string=True, recursive=False))
+    texts = [element.text or ""]
+    for child in element:
+        texts.append(child.tail or "")
+    return "".join(texts)
+
+
+def get_string(element):
+    # Tag.string: the only string inside the element, following single children
+    children = []
+    if element.text:
+        children.append(element.text)
+    for child in element:
+        children.append(child)
+        if child.tail:
+            children.append(child.tail)
+
+    if len(children) != 1:
+        return None
+    if isinstance(children[0], str):
+        return children[0]
+    if not isinstance(children[0].tag, str):
+        # Comment or processing instruction
+        return children[0].text
+    return get_string(children[0])
+
+
+if __name__ == '__main__':
+    # Compare both engines on recorded pages:
+    #   python parsing.py --compare page1.html page2.html
+    import argparse
+    import os
+
+    arg_parser = argparse.ArgumentParser(description="Parse recorded product pages")
+    arg_parser.add_argument("pages", nargs="+", help="HTML files, named after their ISIN")
+    arg_parser.add_argument("--compare", action="store_true", help="Compare the lxml engine against BeautifulSoup")
+    args = arg_parser.parse_args()
+
+    mismatches = 0
+    for path in args.pages:
+        isin = os.path.splitext(os.path.basename(path))[0]
+        with open(path, encoding="utf-8") as f:
+            html = f.read()
+
+        if args.compare:
+            differences = compare_engines(isin, html)
+            if differences:
+                mismatches += 1
+                logger.warning("%s: %s" % (path, differences))
+            else:
+                logger.info("%s: identical" % path)
+        else:
+            logger.info("%s: %s" % (path, parse_product_page(isin, html)))
+
+    raise SystemExit(1 if mismatches else 0)
@@ -0,0 +1,177 @@
+import settings
+import logging
+import asyncio
+import random
+import re
+import parsing
+
+# Logging
+logger = logging.getLogger('client.providers')
+
+
+class Interstitial(Exception):
+    # Raised by Provider.on_response() when the response is a page in between, like a
+    # disclaimer, instead of the requested page. webscraper.fetchPage() prepares again and retries once.
+    pass
+
+
+class Provider():
+    # A website quotes are scraped from.
+    # Products are routed to the first enabled provider whose ISIN prefixes match, see route().
+    # Page providers fetch one product page per ISIN through webscraper.fetchProduct() and
+    # parse it with `parser` in the parser pool. Bulk providers (bulk_size > 0) implement
+    # fetch_many() and are asked for up to bulk_size quotes per call.
+    name = None
+    label = None            # Shown to users
+    prefixes = ()           # ISIN prefixes, e.g. ("NL", "DE")
+    concurrency = None      # Parallel requests, None uses FETCH_CONCURRENCY_PER_HOST
+    rate = None             # Requests per second, None uses FETCH_RATE
+    burst = None            # None uses FETCH_BURST
+    bulk_size = 0
+    parser = None           # Module level function(isin, html) -> (available, data), runs in a worker
+    stream = None           # Function(isin) -> parsing.PageStream, used with FETCH_STREAMING
+
+    @property
+    def base_url(self):
+        raise NotImplementedError
+
+    def matches(self, isin):
+        isin = isin.upper()
+        return any(isin.startswith(prefix) for prefix in self.prefixes)
+
+    def product_url(self, isin):
+        raise NotImplementedError
+
+    def market_link(self, market_url):
+        # Link to the underlying, market_url is the Market column
+        return self.base_url + (market_url or "")
+
+    async def prepare(self, session_manager):
+        # Called before every page request, e.g. to accept a disclaimer
+        pass
+
+    def on_response(self, response, session_manager):
+        # Called with every page response, before the body is read, may raise Interstitial
+        pass
+
+    async def fetch_many(self, isin_list, scheduler):
+        # Bulk providers: returns {isin: (available, data)}, ISINs left out have failed.
+        # HTTP requests go through scheduler.request(..., provider=self).
+        raise NotImplementedError
+
+
+class IngProvider(Provider):
+    name = "ing"
+    label = "ING Markets"
+    prefixes = ("NL", "DE")
+    parser = staticmethod(parsing.parse_product_page)
+    stream = parsing.PageStream
+
+    @property
+    def base_url(self):
+        return settings.ING_BASE_URL
+
+    def product_url(self, isin):
+        return f"{settings.ING_BASE_URL}/producten/{isin}"
+
+    async def prepare(self, session_manager):
+        # ING Markets disclaimer bypass, accepted once per session
+        await session_manager.ensure_disclaimer()
+
+    def on_response(self, response, session_manager):
+        if "disclaimer" in response.url.path:
+            # Cookie expired early, the page is the disclaimer. Accept it again and retry.
+            session_manager.invalidate_disclaimer()
+            raise Interstitial(str(response.url))
+
+
+class FakeProvider(Provider):
+    # Made up quotes for ISINs starting with XX, without any network.
+    # Deterministic per ISIN (FAKE_PROVIDER_ENDED of them have ended), for the
+    # benchmarks and load tests. Only has the bulk method.
+    name = "fake"
+    label = "Fake Markets"
+    prefixes = ("XX",)
+    bulk_size = 100
+    base_url = "https://fake.invalid"
+
+    def __init__(self):
+        self.calls = 0
+
+    def product_url(self, isin):
+        return f"{self.base_url}/products/{isin}"
+
+    async def fetch_many(self, isin_list, scheduler):
+        self.calls += 1
+        if settings.FAKE_PROVIDER_LATENCY:
+            await asyncio.sleep(settings.FAKE_PROVIDER_LATENCY)
+        return {isin: self.quote(isin) for isin in isin_list}
+
+    def quote(self, isin):
+        rng = random.Random(isin)
+        if rng.random() < settings.FAKE_PROVIDER_ENDED:
+            return False, {"Isin": isin, "Ended": 1}
+
+        bid = round(rng.uniform(0.5, 2000), 2)
+        data = {
+            "Title": "Fake underlying %s" % isin[-4:],
+            "Market": "/underlyings/%s" % isin[-4:],
+            "Isin": isin,
+        }
+        data.update(parsing.Quote(
+            bid, round(bid * 1.002, 2), round(rng.uniform(-10, 10), 2), round(rng.uniform(1, 20), 2),
+            round(bid * 0.8, 2), round(rng.uniform(-30, 0), 2), round(bid * 1.1, 2))._asdict())
+        data["Type"] = rng.choice(("Long", "Short"))
+        data["Ended"] = 0
+        return True, data
+
+
+PROVIDERS = {provider.name: provider for provider in (IngProvider, FakeProvider)}
+
+Enabled = []            # In routing order, see enable()
+Default = None          # The first enabled provider, for links of unrouted ISINs
+ISIN_PATTERN = None     # Everything that looks like an ISIN of an enabled provider
+ISIN_LIST_PATTERN = None
+
+
+def enable(names):
+    # Called at import with settings.QUOTE_PROVIDERS
+    global Enabled, Default, ISIN_PATTERN, ISIN_LIST_PATTERN
+    Enabled = [PROVIDERS[name]() for name in names]
+    Default = Enabled[0]
+    prefixes = "|".join(re.escape(prefix) for provider in Enabled for prefix in provider.prefixes)
+    # https://regex101.com/r/xxPxLe/1
+    ISIN_PATTERN = re.compile(r"(?i)((%s)[0-9, A-Z]{10})" % prefixes)
+    # Without spaces and commas, which would run into the neighbouring ISINs of a list
+    ISIN_LIST_PATTERN = re.compile(r"(?i)\b((?:%s)[0-9A-Z]{10})\b" % prefixes)
+    logger.debug("Quote providers: %s" % ", ".join(provider.name for provider in Enabled))
+
+
+def find_isin(text):
+    # The first ISIN in a user's message, None when there is none
+    match = ISIN_PATTERN.search(text)
+    return match.group(0) if match else None
+
+
+def find_isins(text):
+    # Every distinct ISIN in a pasted list or file, upper case and in order
+    return list(dict.fromkeys(isin.upper() for isin in ISIN_LIST_PATTERN.findall(text)))
+
+
+def route(isin):
+    # The provider of an ISIN, None when no enabled provider serves it
+    for provider in Enabled:
+        if provider.matches(isin):
+            return provider
+    return None
+
+
+def group(isin_list):
+    # {provider: [isin, ...]} in the order of isin_list, unrouted ISINs under None
+    groups = {}
+    for isin in isin_list:
+        groups.setdefault(route(isin), []).append(isin)
+    return groups
+
+
+enable(settings.QUOTE_PROVIDERS)
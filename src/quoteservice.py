@@ -0,0 +1,492 @@
+#! /usr/bin/env python3
+# Optional quote service: fetching, parsing and the quote writes to Markets in a
+# process of their own, so a parsing burst does not delay Telegram updates.
+# The bot talks to it over a Unix socket (settings.QUOTE_SERVICE):
+#
+#   python src/quoteservice.py --workers 4
+#
+# Without QUOTE_SERVICE the bot uses LocalQuotes and does everything itself.
+import settings
+import logging
+import argparse
+import asyncio
+import math
+import os
+import struct
+import time
+import db
+import metrics
+import refresher
+import tradinghours
+import webscraper
+from parsing import Quote
+
+# Logging
+logger = logging.getLogger('client.quoteservice')
+
+# Frames: request id, op, payload length, payload. Replies repeat the id and op, or OP_ERROR.
+HEADER = struct.Struct("!IBI")
+COUNT = struct.Struct("!I")
+LENGTH = struct.Struct("!H")
+NUMBER = struct.Struct("!d")
+BYTE = struct.Struct("!B")
+VALUES = struct.Struct("!%dd" % len(Quote._fields))
+NONE = 0xFFFF  # Length of a None string
+
+OP_REFRESH = 1  # [(isin, checked)] -> number of stale products, [ended isin], see LocalQuotes.refresh_products()
+OP_RESOLVE = 2  # [text] -> [(isin, valid, data)], see webscraper.resolveProducts()
+OP_STATS = 3    # -> [(name, number)] of the quote cache
+OP_ERROR = 255  # -> message
+
+VALID = {False: 0, True: 1, None: 2}
+VALID_CODES = {code: valid for valid, code in VALID.items()}
+
+
+def request_timeout():
+    # Longer than the service may take itself, so its own timeouts are the ones that fire
+    return (settings.FETCH_TOTAL_TIMEOUT + settings.PARSE_TIMEOUT + settings.PARSE_RECYCLE_AFTER
+            + settings.QUOTE_SERVICE_MARGIN)
+
+
+class QuoteServiceError(Exception):
+    # The quote service could not be reached or failed to answer
+    pass
+
+
+class Encoder():
+    def __init__(self):
+        self.buffer = bytearray()
+
+    def count(self, value):
+        self.buffer += COUNT.pack(value)
+
+    def byte(self, value):
+        self.buffer += BYTE.pack(value)
+
+    def number(self, value):
+        self.buffer += NUMBER.pack(math.nan if value is None else value)
+
+    def string(self, value):
+        if value is None:
+            self.buffer += LENGTH.pack(NONE)
+            return
+        data = value.encode("utf-8")[:NONE - 1]
+        self.buffer += LENGTH.pack(len(data)) + data
+
+    def product(self, data):
+        # A scraped product as returned by the parser, see parsing.parse_product_tree()
+        for key in ("Title", "Isin", "Market", "Type"):
+            self.string(data.get(key))
+        self.buffer += VALUES.pack(*(
+            math.nan if data.get(key) is None else data[key] for key in Quote._fields))
+        self.byte(data.get("Ended", 0))
+
+
+class Decoder():
+    def __init__(self, payload):
+        self.view = memoryview(payload)
+        self.offset = 0
+
+    def _unpack(self, layout):
+        values = layout.unpack_from(self.view, self.offset)
+        self.offset += layout.size
+        return values
+
+    def count(self):
+        return self._unpack(COUNT)[0]
+
+    def byte(self):
+        return self._unpack(BYTE)[0]
+
+    def number(self):
+        value = self._unpack(NUMBER)[0]
+        return None if math.isnan(value) else value
+
+    def string(self):
+        length = self._unpack(LENGTH)[0]
+        if length == NONE:
+            return None
+        value = bytes(self.view[self.offset:self.offset + length]).decode("utf-8")
+        self.offset += length
+        return value
+
+    def product(self):
+        data = {}
+        for key in ("Title", "Isin", "Market", "Type"):
+            data[key] = self.string()
+        for key, value in zip(Quote._fields, self._unpack(VALUES)):
+            data[key] = None if math.isnan(value) else value
+        data["Ended"] = self.byte()
+        return data
+
+
+class LocalQuotes():
+    # Quotes fetched and parsed in this process, the default.
+    # The quote service runs the same class behind its socket.
+    def __init__(self, database):
+        self.database = database
+
+    async def _init(self):
+        await webscraper.Session._init()
+        webscraper.Parser._init()
+
+    async def _close(self):
+        await webscraper.Session._close()
+        webscraper.Parser._close()
+
+    async def refresh(self, products):
+        # Scrape and store the stale ones of [(isin, checked)], Checked as read from Markets.
+        # Returns the number of stale products, 0 when Markets did not need to change.
+        return (await self.refresh_products(products))[0]
+
+    async def refresh_products(self, products):
+        # refresh(), also returning the ISINs that turned out to have ended
+        now = time.time()
+        # webscraper.Changes also knows about scrapes whose write is still queued
+        stale = [
+            isin for isin, checked in products
+            if not tradinghours.Market.is_fresh(
+                max(checked or 0, webscraper.Changes.checked(isin)), settings.QUOTE_MAX_AGE, now)
+        ]
+        ended = []
+        if stale:
+            available, unavailable, failed = await webscraper.getProductDataHTML(stale)
+            await self.database.update_markets([available, unavailable])
+            ended = [item["Isin"] for item in unavailable]
+        return len(stale), ended
+
+    async def resolve(self, text):
+        return await webscraper.resolveProduct(text)
+
+    async def resolve_many(self, isin_list, progress=None):
+        return await webscraper.resolveProducts(isin_list, progress)
+
+    async def stats(self):
+        return webscraper.Quotes.stats()
+
+
+class QuoteClient():
+    # The bot's side of the quote service, with the methods of LocalQuotes.
+    # Requests are multiplexed over one connection, opened on first use.
+    # Products the service marks as ended are dropped from the database's inline query index.
+    def __init__(self, path, database=None):
+        self.logger = logging.getLogger('client.quoteservice')
+        self.path = path
+        self.database = database
+        self.syncer = None
+        self.reader = None
+        self.writer = None
+        self.listener = None
+        self.lock = None
+        self.pending = {}  # request id -> future
+        self.next_id = 0
+
+    async def _init(self):
+        if self.lock is None:
+            self.lock = asyncio.Lock()
+        if self.database is not None and self.syncer is None:
+            self.syncer = asyncio.create_task(self._sync_index())
+
+    async def _close(self):
+        if self.syncer is not None:
+            self.syncer.cancel()
+            try:
+                await self.syncer
+            except asyncio.CancelledError:
+                pass
+            self.syncer = None
+        if self.listener is not None:
+            self.listener.cancel()
+            try:
+                await self.listener
+            except asyncio.CancelledError:
+                pass
+            self.listener = None
+        self._disconnect(QuoteServiceError("closed"))
+
+    async def _connect(self):
+        await self._init()
+        async with self.lock:
+            if self.writer is not None:
+                return
+            try:
+                self.reader, self.writer = await asyncio.open_unix_connection(self.path)
+            except OSError as e:
+                raise QuoteServiceError("{}: {!r}".format(self.path, e))
+            self.listener = asyncio.create_task(self._listen(self.reader))
+            self.logger.debug("Connected to the quote service on %s" % self.path)
+
+    def _disconnect(self, error):
+        if self.writer is not None:
+            self.writer.close()
+        self.reader = self.writer = None
+        pending, self.pending = self.pending, {}
+        for future in pending.values():
+            if not future.done():
+                future.set_exception(error)
+
+    async def _listen(self, reader):
+        try:
+            while True:
+                request_id, op, length = HEADER.unpack(await reader.readexactly(HEADER.size))
+                payload = await reader.readexactly(length)
+                future = self.pending.pop(request_id, None)
+                if future is None or future.done():
+                    continue
+                if op == OP_ERROR:
+                    future.set_exception(QuoteServiceError(Decoder(payload).string()))
+                else:
+                    future.set_result(Decoder(payload))
+        except (asyncio.IncompleteReadError, ConnectionError) as e:
+            self.logger.warning("Lost the quote service: {!r}".format(e))
+            if self.reader is reader:
+                self.listener = None
+                self._disconnect(QuoteServiceError("connection lost"))
+
+    async def _sync_index(self):
+        # The service's refresher ends products in its own process, pick them up from Markets
+        since = time.time()
+        while True:
+            await asyncio.sleep(settings.REFRESH_INTERVAL)
+            now = time.time()
+            try:
+                ended = await self.database.read_ended_isins(since)
+            except Exception:
+                self.logger.exception("Could not read the ended products")
+                continue
+            self._discard(ended)
+            since = now
+
+    def _discard(self, ended):
+        for isin in ended:
+            self.database.market_index.discard(isin)
+
+    async def _request(self, op, request):
+        if self.writer is None:
+            await self._connect()
+
+        self.next_id = (self.next_id + 1) % 2 ** 32
+        request_id = self.next_id
+        future = asyncio.get_running_loop().create_future()
+        self.pending[request_id] = future
+        try:
+            self.writer.write(HEADER.pack(request_id, op, len(request.buffer)) + request.buffer)
+            await self.writer.drain()
+            return await asyncio.wait_for(future, request_timeout())
+        except (ConnectionError, asyncio.TimeoutError) as e:
+            raise QuoteServiceError(repr(e))
+        finally:
+            self.pending.pop(request_id, None)
+
+    async def refresh(self, products):
+        # Products whose Checked is fresh are not sent, the service decides about the others
+        now = time.time()
+        products = [
+            (isin, checked) for isin, checked in products
+            if not tradinghours.Market.is_fresh(checked, settings.QUOTE_MAX_AGE, now)
+        ]
+        if not products:
+            return 0
+
+        request = Encoder()
+        request.count(len(products))
+        for isin, checked in products:
+            request.string(isin)
+            request.number(checked)
+        reply = await self._request(OP_REFRESH, request)
+        stale = reply.count()
+        ended = [reply.string() for _ in range(reply.count())]
+        if self.database is not None:
+            self._discard(ended)
+        return stale
+
+    async def resolve(self, text):
+        return (await self.resolve_many([text]))[0]
+
+    async def resolve_many(self, isin_list, progress=None):
+        # QUOTE_SERVICE_CHUNK ISINs per request, all sent at once, progress after every reply.
+        # A failed request counts as unreachable, like a failed fetch.
+        chunks = list(webscraper.chunks(isin_list, settings.QUOTE_SERVICE_CHUNK))
+        done = 0
+
+        async def resolve_chunk(chunk):
+            nonlocal done
+            request = Encoder()
+            request.count(len(chunk))
+            for text in chunk:
+                request.string(text)
+            try:
+                reply = await self._request(OP_RESOLVE, request)
+                results = []
+                for _ in range(reply.count()):
+                    isin = reply.string()
+                    valid = VALID_CODES[reply.byte()]
+                    results.append((isin, valid, reply.product() if reply.byte() else None))
+            except QuoteServiceError as e:
+                self.logger.warning("Could not resolve %d products: %s" % (len(chunk), e))
+                results = [(text, None, None) for text in chunk]
+
+            done += len(chunk)
+            if progress is not None:
+                progress(done, len(isin_list))
+            return results
+
+        results = []
+        for chunk_results in await asyncio.gather(*[resolve_chunk(chunk) for chunk in chunks]):
+            results += chunk_results
+        return results
+
+    async def stats(self):
+        reply = await self._request(OP_STATS, Encoder())
+        return {reply.string(): reply.number() for _ in range(reply.count())}
+
+
+class QuoteServer():
+    # The quote service: LocalQuotes behind a Unix socket, see serve()
+    def __init__(self, quotes, path):
+        self.logger = logging.getLogger('client.quoteservice')
+        self.quotes = quotes
+        self.path = path
+        self.server = None
+        self.connections = set()  # Writers of the connected bots
+
+    async def _init(self):
+        if os.path.exists(self.path):
+            os.unlink(self.path)  # Left behind by a service that did not shut down
+        self.server = await asyncio.start_unix_server(self.handle, path=self.path)
+        self.logger.info("Quote service on %s" % self.path)
+
+    async def _close(self):
+        if self.server is None:
+            return
+        self.server.close()
+        for writer in list(self.connections):
+            writer.close()
+        await self.server.wait_closed()
+        self.server = None
+        if os.path.exists(self.path):
+            os.unlink(self.path)
+        self.logger.debug("Quote service closed")
+
+    async def handle(self, reader, writer):
+        # Every request is answered in a task of its own, replies may come out of order
+        tasks = set()
+        drain_lock = asyncio.Lock()
+        self.connections.add(writer)
+        try:
+            while True:
+                request_id, op, length = HEADER.unpack(await reader.readexactly(HEADER.size))
+                payload = await reader.readexactly(length)
+                task = asyncio.create_task(self.answer(writer, drain_lock, request_id, op, payload))
+                tasks.add(task)
+                task.add_done_callback(tasks.discard)
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        finally:
+            for task in tasks:
+                task.cancel()
+            self.connections.discard(writer)
+            writer.close()
+
+    async def answer(self, writer, drain_lock, request_id, op, payload):
+        try:
+            reply = await self.dispatch(op, Decoder(payload))
+        except Exception as e:
+            self.logger.error("Request %d failed: %r" % (op, e))
+            op = OP_ERROR
+            reply = Encoder()
+            reply.string(repr(e))
+
+        writer.write(HEADER.pack(request_id, op, len(reply.buffer)) + reply.buffer)
+        async with drain_lock:
+            await writer.drain()
+
+    async def dispatch(self, op, request):
+        reply = Encoder()
+        if op == OP_REFRESH:
+            products = [(request.string(), request.number()) for _ in range(request.count())]
+            stale, ended = await self.quotes.refresh_products(products)
+            reply.count(stale)
+            reply.count(len(ended))
+            for isin in ended:
+                reply.string(isin)
+        elif op == OP_RESOLVE:
+            texts = [request.string() for _ in range(request.count())]
+            results = await self.quotes.resolve_many(texts)
+            reply.count(len(results))
+            for isin, valid, data in results:
+                reply.string(isin)
+                reply.byte(VALID[valid])
+                reply.byte(1 if data else 0)
+                if data:
+                    reply.product(data)
+        elif op == OP_STATS:
+            stats = await self.quotes.stats()
+            reply.count(len(stats))
+            for name, value in stats.items():
+                reply.string(name)
+                reply.number(value)
+        else:
+            raise ValueError("Unknown op {}".format(op))
+        return reply
+
+
+def connect(database, project_dir):
+    # LocalQuotes, or a client of the quote service when QUOTE_SERVICE is set
+    if not settings.QUOTE_SERVICE:
+        return LocalQuotes(database)
+    return QuoteClient(os.path.join(project_dir, settings.QUOTE_SERVICE), database)
+
+
+async def serve(project_dir, path):
+    database = db.Database(project_dir)
+    await database._init()
+    await database.create_database()
+
+    quotes = LocalQuotes(database)
+    await quotes._init()
+    Refresher = refresher.QuoteRefresher(database)
+    Refresher.start()
+    server = QuoteServer(quotes, path)
+    await server._init()
+
+    Metrics = metrics.MetricsServer()
+    metrics.collect("quote_cache", webscraper.Quotes.stats)
+    metrics.collect("db_writes", database.write_stats)
+    await Metrics._init()
+    try:
+        await server.server.serve_forever()
+    finally:
+        await Metrics._close()
+        await server._close()
+        await Refresher.stop()
+        await quotes._close()
+        await database._close()
+
+
+if __name__ == '__main__':
+    # Same project directory and database as the bot
+    project_dir = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
+
+    parser = argparse.ArgumentParser(description="Quote service of the ISIN Tracker Bot")
+    parser.add_argument("--socket", default=settings.QUOTE_SERVICE or "quotes.sock",
+                        help="Unix socket, relative to the project directory")
+    parser.add_argument("--workers", type=int, help="Parser processes, overrides PARSER_WORKERS")
+    parser.add_argument("--metrics-port", type=int, help="Overrides METRICS_PORT, the bot may use that one")
+    args = parser.parse_args()
+
+    if args.workers:
+        settings.PARSER_WORKERS = args.workers
+    if args.metrics_port:
+        settings.METRICS_PORT = args.metrics_port
+
+    try:
+        import uvloop
+        uvloop.install()
+    except ModuleNotFoundError:
+        logger.info("uvloop not available.")
+
+    try:
+        asyncio.run(serve(project_dir, os.path.join(project_dir, args.socket)))
+    except KeyboardInterrupt:
+        pass
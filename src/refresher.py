@@ -0,0 +1,77 @@
+import settings
+import logging
+import asyncio
+import time
+import webscraper
+import tradinghours
+
+
+class QuoteRefresher():
+    # Background task that keeps the Markets table fresh, so the List
+    # handlers can be served from the database.
+    # Started and stopped by main.main().
+    def __init__(self, database):
+        self.logger = logging.getLogger('client.refresher')
+        self.database = database
+        self.task = None
+
+    def start(self):
+        if self.task is None:
+            self.task = asyncio.create_task(self.run())
+            self.logger.debug("Quote refresher started")
+
+    async def stop(self):
+        if self.task is None:
+            return
+        self.task.cancel()
+        try:
+            await self.task
+        except asyncio.CancelledError:
+            pass
+        self.task = None
+        self.logger.debug("Quote refresher stopped")
+
+    async def run(self):
+        while True:
+            started = time.monotonic()
+            try:
+                await self.refresh_once()
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                self.logger.error("Refresh failed: {!r}".format(e))
+
+            elapsed = time.monotonic() - started
+            await asyncio.sleep(max(0, settings.REFRESH_INTERVAL - elapsed))
+
+    async def refresh_once(self):
+        if tradinghours.Market.is_open():
+            isin_list = await self.database.read_tracked_isins()
+        else:
+            # Quotes do not move outside trading hours, only fetch the ones from before the last close
+            last_close = tradinghours.Market.last_close().timestamp()
+            isin_list = [
+                isin for isin in await self.database.read_stale_isins(time.time() - last_close)
+                if webscraper.Changes.checked(isin) < last_close
+            ]
+            self.logger.debug("Market closed, %d products predate the last close" % len(isin_list))
+
+        if not isin_list:
+            return
+
+        available, unavailable, failed = [], [], []
+        for index in range(0, len(isin_list), settings.REFRESH_BATCH_SIZE):
+            batch = isin_list[index:index + settings.REFRESH_BATCH_SIZE]
+            results = await webscraper.getProductDataHTML(batch)
+            available += results[0]
+            unavailable += results[1]
+            failed += results[2]
+
+        # One transaction for the whole cycle, waited for to report the rows it wrote.
+        # Rows whose values did not change are skipped by the upsert.
+        written = await self.database.update_markets([available, unavailable])
+        if written is False:
+            self.logger.error("Refreshed %d products, but they could not be saved" % len(available))
+            return
+        self.logger.info("Refreshed %d products (%d ended, %d failed), %d rows written" % (
+            len(available), len(unavailable), len(failed), written))
@@ -0,0 +1,148 @@
+import settings
+import logging
+import aiohttp
+import asyncio
+import random
+import time
+from aiohttp.helpers import URL
+
+
+class FetchError(Exception):
+    # Raised when a request keeps failing after all retries.
+    # This is a transient failure, not a discontinued product.
+    def __init__(self, url, reason):
+        super().__init__("{}: {}".format(url, reason))
+        self.url = url
+        self.reason = reason
+
+
+class TokenBucket():
+    # Allows `rate` requests per second with bursts up to `capacity`
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+        self.lock = asyncio.Lock()
+
+    async def acquire(self):
+        async with self.lock:
+            while True:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+
+                await asyncio.sleep((1 - self.tokens) / self.rate)
+
+
+class FetchScheduler():
+    # Bounded, rate-limited and retrying front-end for the shared HTTP session
+    def __init__(self, session_manager):
+        self.logger = logging.getLogger('client.scheduler')
+        self.session_manager = session_manager
+        self.semaphores = {}
+        self.buckets = {}
+
+    def _host_limits(self, url, provider=None):
+        # Per host, with the limits of the provider where it sets them
+        host = URL(url).host
+        if host not in self.semaphores:
+            concurrency = getattr(provider, "concurrency", None) or settings.FETCH_CONCURRENCY_PER_HOST
+            rate = getattr(provider, "rate", None) or settings.FETCH_RATE
+            burst = getattr(provider, "burst", None) or settings.FETCH_BURST
+            self.semaphores[host] = asyncio.Semaphore(concurrency)
+            self.buckets[host] = TokenBucket(rate, burst)
+        return self.semaphores[host], self.buckets[host]
+
+    def _backoff(self, attempt):
+        # Full jitter exponential backoff
+        delay = min(settings.FETCH_BACKOFF_MAX, settings.FETCH_BACKOFF_BASE * (2 ** attempt))
+        return random.uniform(0, delay)
+
+    async def _read(self, response, requested_format, stream=None):
+        if requested_format is None:
+            return None
+        if requested_format == "stream":
+            return await self._stream(response, stream())
+        if requested_format in ("text", "html"):
+            return await response.text()
+        if requested_format == "json":
+            return await response.json()
+        if requested_format == "bytes":
+            return await response.read()
+        raise ValueError(f"Unknown requested_format: {requested_format}")
+
+    async def _stream(self, response, consumer):
+        # Feeds the body to consumer.feed() until it returns True and skips the rest.
+        # A connection with an unread body cannot be reused, so it is closed.
+        async for chunk in response.content.iter_chunked(settings.FETCH_CHUNK_SIZE):
+            if consumer.feed(chunk):
+                response.close()
+                break
+        return consumer
+
+    async def request(
+            self, url, requested_format="html", allow_redirects=True, on_response=None, headers=None, stream=None,
+            provider=None):
+        # Returns (status, body). Raises FetchError once the retries are used up.
+        # A 304 Not Modified is returned like any other status, with an empty body.
+        # With requested_format "stream", stream() creates a new consumer for every attempt
+        # (see _stream) and the body is that consumer.
+        # provider is the providers.Provider of the url, for its concurrency and rate limits.
+        semaphore, bucket = self._host_limits(url, provider)
+        timeout = aiohttp.ClientTimeout(total=settings.FETCH_REQUEST_TIMEOUT)
+        reason = None
+
+        for attempt in range(settings.FETCH_RETRIES + 1):
+            if attempt:
+                await asyncio.sleep(self._backoff(attempt - 1))
+
+            await bucket.acquire()
+            async with semaphore:
+                client = await self.session_manager.get()
+                try:
+                    async with client.get(
+                            url, allow_redirects=allow_redirects, timeout=timeout, headers=headers) as response:
+                        if on_response is not None:
+                            on_response(response)
+
+                        if response.status == 429 or response.status >= 500:
+                            reason = "HTTP {}".format(response.status)
+                            self.logger.debug("Retrying {} ({})".format(url, reason))
+                            continue
+
+                        return response.status, await self._read(response, requested_format, stream)
+
+                except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                    reason = repr(e)
+                    self.logger.debug("Retrying {} ({})".format(url, reason))
+
+        self.logger.warning("Giving up on {} ({})".format(url, reason))
+        raise FetchError(url, reason)
+
+    async def gather(self, coros):
+        # Run all coroutines within the overall timeout.
+        # Returns a list with either the result or the exception for every coroutine.
+        tasks = [asyncio.ensure_future(coro) for coro in coros]
+        if not tasks:
+            return []
+
+        done, pending = await asyncio.wait(tasks, timeout=settings.FETCH_TOTAL_TIMEOUT)
+        for task in pending:
+            task.cancel()
+        if pending:
+            await asyncio.wait(pending)
+
+        results = []
+        for task in tasks:
+            if task.cancelled():
+                results.append(FetchError("", "overall timeout exceeded"))
+            elif task.exception() is not None:
+                results.append(task.exception())
+            else:
+                results.append(task.result())
+        return results
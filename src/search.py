@@ -0,0 +1,85 @@
+import logging
+import re
+from bisect import bisect_left, insort
+
+# Logging
+logger = logging.getLogger('client.search')
+
+# Title words, "Turbo Long Goud (XAU)" is found by "turbo", "goud" and "xau"
+WORD = re.compile(r"\w+")
+
+
+class PrefixIndex():
+    # Products by prefix of their ISIN, title or any word of the title, for inline queries.
+    # Sorted (key, isin) pairs: a lookup is a binary search and a scan of the matches,
+    # without database access. Kept up to date by the Database methods that write Markets.
+    def __init__(self):
+        self.keys = []      # Sorted (key, isin)
+        self.entries = {}   # isin -> (title, type, keys)
+
+    def load(self, rows):
+        # Replace the index with (isin, title, type) rows, sorted once
+        self.entries = {}
+        keys = []
+        for isin, title, product_type in rows:
+            entry = self._entry(isin, title, product_type)
+            self.entries[isin] = entry
+            keys += [(key, isin) for key in entry[2]]
+        keys.sort()
+        self.keys = keys
+
+    def add(self, isin, title, product_type=None):
+        entry = self.entries.get(isin)
+        if entry is not None:
+            if entry[:2] == (title, product_type):
+                return
+            self.discard(isin)
+
+        entry = self._entry(isin, title, product_type)
+        for key in entry[2]:
+            insort(self.keys, (key, isin))
+        self.entries[isin] = entry
+
+    def discard(self, isin):
+        # E.g. ended products, which can no longer be added
+        entry = self.entries.pop(isin, None)
+        if entry is None:
+            return
+        for key in entry[2]:
+            index = bisect_left(self.keys, (key, isin))
+            if index < len(self.keys) and self.keys[index] == (key, isin):
+                del self.keys[index]
+
+    def lookup(self, prefix, limit):
+        # [(isin, title, type)] of at most limit products, in key order
+        prefix = prefix.strip().casefold()
+        if not prefix:
+            return []
+
+        results = []
+        seen = set()
+        index = bisect_left(self.keys, (prefix,))
+        while index < len(self.keys) and len(results) < limit:
+            key, isin = self.keys[index]
+            if not key.startswith(prefix):
+                break
+            if isin not in seen:
+                seen.add(isin)
+                title, product_type, _ = self.entries[isin]
+                results.append((isin, title, product_type))
+            index += 1
+        return results
+
+    def _entry(self, isin, title, product_type):
+        keys = {isin.casefold()}
+        if title:
+            title_key = title.casefold()
+            keys.add(title_key)
+            keys.update(WORD.findall(title_key))
+        return title, product_type, tuple(keys)
+
+    def stats(self):
+        return {
+            "products": len(self.entries),
+            "keys": len(self.keys),
+        }
@@ -0,0 +1,94 @@
+import settings
+import logging
+import aiohttp
+import asyncio
+import time
+from aiohttp.helpers import URL
+
+
+class SessionManager():
+    # Long-lived HTTP session shared by every scraper call.
+    # Owned by the bot's lifecycle: main.main() calls _init() and _close().
+    def __init__(self):
+        self.logger = logging.getLogger('client.session')
+        self.session = None
+        self.disclaimer_expires = 0
+        self.disclaimer_lock = None
+
+    async def _init(self):
+        if self.session is not None and not self.session.closed:
+            return
+
+        connector = aiohttp.TCPConnector(
+            limit=settings.HTTP_POOL_SIZE,
+            ttl_dns_cache=settings.HTTP_DNS_CACHE_TTL,
+            keepalive_timeout=settings.HTTP_KEEPALIVE_TIMEOUT,
+            enable_cleanup_closed=True
+        )
+        self.session = aiohttp.ClientSession(
+            connector=connector,
+            headers={"User-Agent": settings.HTTP_USER_AGENT}
+        )
+        # Created here, inside the running loop (Python 3.9 binds locks on creation)
+        self.disclaimer_lock = asyncio.Lock()
+        self.disclaimer_expires = 0
+        self.logger.debug("HTTP session active")
+
+    async def _close(self):
+        if self.session is None:
+            return
+        await self.session.close()
+        self.session = None
+        self.logger.debug("HTTP session closed")
+
+    async def get(self):
+        # Lazily open the session so scripts can use the scraper without main()
+        if self.session is None or self.session.closed:
+            await self._init()
+        return self.session
+
+    def invalidate_disclaimer(self):
+        # Called when ING redirects us back to the disclaimer page
+        self.disclaimer_expires = 0
+
+    async def ensure_disclaimer(self):
+        # Accept the ING disclaimer once per session, refresh when it expires
+        if time.monotonic() < self.disclaimer_expires:
+            return
+
+        session = await self.get()
+        async with self.disclaimer_lock:
+            # Another task may have refreshed it while we were waiting
+            if time.monotonic() < self.disclaimer_expires:
+                return
+
+            base_url = URL(settings.ING_BASE_URL + "/")
+            session.cookie_jar.update_cookies({"disclaimer": "true"}, response_url=base_url)
+
+            try:
+                async with session.post(
+                    settings.ING_BASE_URL + "/disclaimer",
+                    data={"redirect": settings.ING_BASE_URL + "/producten"}
+                ) as response:
+                    await response.read()
+                    status = response.status
+            except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                status = repr(e)
+
+            if not isinstance(status, int) or status >= 400:
+                # The cookie above is usually enough, retry the POST a bit later
+                self.logger.warning("Could not accept disclaimer: {}".format(status))
+                self.disclaimer_expires = time.monotonic() + settings.ING_DISCLAIMER_RETRY
+                return
+
+            self.disclaimer_expires = time.monotonic() + self._disclaimer_ttl(session, base_url)
+            self.logger.debug("Disclaimer accepted")
+
+    def _disclaimer_ttl(self, session, base_url):
+        # Use the shortest max-age ING hands out, fall back to the configured TTL
+        ttl = settings.ING_DISCLAIMER_TTL
+        for cookie in session.cookie_jar.filter_cookies(base_url).values():
+            max_age = cookie.get("max-age")
+            if max_age and max_age.isdigit():
+                ttl = min(ttl, int(max_age))
+        return ttl
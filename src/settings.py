@@ -4,3 +4,107 @@ import logging
 logging.basicConfig(format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
                     level=logging.INFO)
 logger = logging.getLogger('client')
+
+#############################################
+# Scraper settings
+#############################################
+
+ING_BASE_URL = "https://www.ingmarkets.nl"
+
+# Seconds before the disclaimer is accepted again (unless ING sets a shorter max-age)
+ING_DISCLAIMER_TTL = 3600
+ING_DISCLAIMER_RETRY = 30       # Seconds to wait before retrying a failed disclaimer POST
+
+# Quote providers (see providers.py), ISINs are routed to the first one whose prefix matches
+QUOTE_PROVIDERS = ("ing",)      # "fake" serves made up quotes for XX ISINs, for testing
+FAKE_PROVIDER_LATENCY = 0       # Seconds per fake bulk request
+FAKE_PROVIDER_ENDED = 0.05      # Fraction of fake products that have ended
+
+# Shared HTTP session
+HTTP_POOL_SIZE = 20             # Max open connections
+HTTP_DNS_CACHE_TTL = 300        # Seconds
+HTTP_KEEPALIVE_TIMEOUT = 30     # Seconds an idle connection is kept open
+HTTP_USER_AGENT = "Mozilla/5.0 (compatible; ISIN_Tracker_Bot)"
+
+# Fetch scheduler
+FETCH_CONCURRENCY_PER_HOST = 8  # Parallel requests per host
+FETCH_RATE = 10                 # Requests per second per host (token bucket)
+FETCH_BURST = 10                # Token bucket size
+FETCH_REQUEST_TIMEOUT = 10      # Seconds per request
+FETCH_TOTAL_TIMEOUT = 60        # Seconds for a whole batch
+FETCH_RETRIES = 3               # Retries on timeouts, connection errors, 429 and 5xx
+FETCH_BACKOFF_BASE = 0.5        # Seconds, doubled on every retry (with jitter)
+FETCH_BACKOFF_MAX = 8           # Seconds
+
+# Parse product pages while they download and stop reading once every field was found.
+# Saves bandwidth, but the connection is closed instead of reused. The incremental parse that
+# finds the end runs on the event loop (at most PARSE_TIMEOUT per page), the part that was read
+# is parsed a second time in the parser pool to extract the fields.
+FETCH_STREAMING = False
+FETCH_CHUNK_SIZE = 8192         # Bytes per read when streaming
+
+# Quote cache
+QUOTE_CACHE_TTL = 60            # Seconds a scraped quote is reused
+QUOTE_CACHE_SIZE = 5000         # Max cached ISINs (least recently used are evicted)
+
+# Background quote refresher
+REFRESH_INTERVAL = 300          # Seconds between refresh cycles
+REFRESH_BATCH_SIZE = 50         # Products scraped per batch within a cycle
+QUOTE_MAX_AGE = 120             # Seconds before List scrapes a product on demand
+
+# Trading hours, quotes only move while the market is open.
+# Outside trading hours quotes are served from the database once they are from after the last close.
+MARKET_TIMEZONE = "Europe/Amsterdam"
+MARKET_OPEN = "08:00"
+MARKET_CLOSE = "22:00"
+# Days without trading: "MM-DD" every year, "YYYY-MM-DD" once, "Easter+N"/"Easter-N" around Easter Sunday
+MARKET_HOLIDAYS = ("01-01", "Easter-2", "Easter+1", "05-01", "12-25", "12-26")
+
+# Quote service (quoteservice.py), fetching, parsing and the refresher in a process of their own.
+# Unix only: the bot connects to a running service instead of scraping itself.
+QUOTE_SERVICE = None            # Unix socket, relative to the project directory, e.g. "quotes.sock"
+# A request waits for the service's fetches (FETCH_TOTAL_TIMEOUT) and parses (PARSE_TIMEOUT, plus
+# PARSE_RECYCLE_AFTER for a stuck worker), QUOTE_SERVICE_MARGIN seconds more before it fails.
+QUOTE_SERVICE_MARGIN = 10
+QUOTE_SERVICE_CHUNK = 10        # ISINs per request of a bulk Track, the progress moves per reply
+
+# Inline queries (@bot <prefix>), answered from the products in the database
+INLINE_RESULTS = 20             # Max results per answer, Telegram allows 50
+INLINE_CACHE_TIME = 30          # Seconds Telegram may reuse an answer
+
+# Bulk Track, a pasted list or an uploaded CSV/text file of ISINs
+IMPORT_MAX_PRODUCTS = 200       # ISINs per import
+IMPORT_MAX_FILE_SIZE = 262144   # Bytes
+IMPORT_PROGRESS_INTERVAL = 2    # Seconds between edits of the progress message
+
+# HTML parsing
+PARSER_EXECUTOR = "process"     # "process" or "thread"
+PARSER_WORKERS = None           # None uses the number of CPUs
+PARSER_START_METHOD = "spawn"   # Safe with the threads aiosqlite and aiohttp start
+PARSE_TIMEOUT = 5               # Seconds per page, from the moment a worker starts on it
+PARSE_RECYCLE_AFTER = 5         # Seconds past PARSE_TIMEOUT before a stuck worker's pool is replaced
+PARSER_ENGINE = "lxml"          # "lxml" (XPath extractor) or "bs4" (BeautifulSoup)
+PARSER_COMPARE = False          # Run both engines and log differences
+
+#############################################
+# Database settings
+#############################################
+
+SETTINGS_CACHE_SIZE = 10000     # Users whose settings are kept in memory
+DB_DUMP_BATCH_SIZE = 500        # Rows per batch when the stats command dumps a table
+DB_READERS = 4                  # Read-only connections next to the writer, 0 reads on the writer
+
+# Group commit (write-behind) mode
+DB_WRITE_BEHIND = False         # Queue writes and commit them in groups
+DB_GROUP_COMMIT_INTERVAL = 0.05 # Seconds a group stays open
+DB_GROUP_COMMIT_MAX = 500       # Statements per group
+
+#############################################
+# Metrics
+#############################################
+
+METRICS_ENABLED = False         # Record metrics and serve them, read at startup
+METRICS_HOST = "127.0.0.1"      # Keep the endpoint local
+METRICS_PORT = 9100
+# Histogram buckets in seconds
+METRICS_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
@@ -0,0 +1,95 @@
+import settings
+import logging
+from datetime import date, datetime, time, timedelta
+from zoneinfo import ZoneInfo
+
+# Logging
+logger = logging.getLogger('client.tradinghours')
+
+
+class TradingCalendar():
+    # Trading sessions of the exchange: weekdays between open and close in the
+    # exchange's timezone, except on holidays.
+    # Holidays are "MM-DD" (every year), "YYYY-MM-DD" (once) or "Easter+N"/"Easter-N"
+    # (days relative to Easter Sunday, Good Friday is "Easter-2").
+    def __init__(self, timezone, opens, closes, holidays):
+        self.timezone = ZoneInfo(timezone)
+        self.opens = time.fromisoformat(opens)
+        self.closes = time.fromisoformat(closes)
+        self.holidays = holidays
+        self.years = {}  # year -> set of holiday dates
+
+    def localize(self, now=None):
+        # None, a time.time() timestamp or a datetime, in the exchange's timezone
+        if now is None:
+            return datetime.now(self.timezone)
+        if isinstance(now, (int, float)):
+            return datetime.fromtimestamp(now, self.timezone)
+        return now.astimezone(self.timezone)
+
+    def holidays_in(self, year):
+        if year not in self.years:
+            days = set()
+            for holiday in self.holidays:
+                if holiday.lower().startswith("easter"):
+                    days.add(easter_sunday(year) + timedelta(days=int(holiday[6:] or 0)))
+                elif len(holiday) == 5:
+                    try:
+                        days.add(date(year, int(holiday[:2]), int(holiday[3:])))
+                    except ValueError:
+                        # 02-29 outside leap years
+                        continue
+                else:
+                    day = date.fromisoformat(holiday)
+                    if day.year == year:
+                        days.add(day)
+            self.years[year] = days
+        return self.years[year]
+
+    def is_trading_day(self, day):
+        return day.weekday() < 5 and day not in self.holidays_in(day.year)
+
+    def is_open(self, now=None):
+        now = self.localize(now)
+        return self.is_trading_day(now.date()) and self.opens <= now.time() < self.closes
+
+    def last_close(self, now=None):
+        # End of the last session that closed at or before now
+        now = self.localize(now)
+        day = now.date()
+        if not (self.is_trading_day(day) and now.time() >= self.closes):
+            day -= timedelta(days=1)
+            while not self.is_trading_day(day):
+                day -= timedelta(days=1)
+        return datetime.combine(day, self.closes, self.timezone)
+
+    def is_fresh(self, updated, max_age, now=None):
+        # Whether a quote scraped at `updated` (time.time()) can still be shown.
+        # While the market is open it may be max_age seconds old, outside trading
+        # hours it only has to be from after the last close.
+        if not updated:
+            return False
+        now = self.localize(now)
+        if self.is_open(now):
+            return now.timestamp() - updated < max_age
+        return updated >= self.last_close(now).timestamp()
+
+
+def easter_sunday(year):
+    # Anonymous Gregorian algorithm
+    a = year % 19
+    b, c = divmod(year, 100)
+    d, e = divmod(b, 4)
+    f = (b + 8) // 25
+    g = (b - f + 1) // 3
+    h = (19 * a + b - d - g + 15) % 30
+    i, k = divmod(c, 4)
+    l = (32 + 2 * e + 2 * i - h - k) % 7
+    m = (a + 11 * h + 22 * l) // 451
+    month, day = divmod(h + l - 7 * m + 114, 31)
+    return date(year, month, day + 1)
+
+
+# Consulted by the List handlers and the background refresher
+Market = TradingCalendar(
+    settings.MARKET_TIMEZONE, settings.MARKET_OPEN, settings.MARKET_CLOSE, settings.MARKET_HOLIDAYS)
@@ -1,16 +1,32 @@
 import settings
 import logging
-import aiohttp
+import session
+import scheduler
+import cache
 import asyncio
 # import reprlib
-from aiohttp.helpers import URL
 from operator import itemgetter
-from bs4 import BeautifulSoup
-import re
+import parsing
+import providers
+import metrics
+import time
 
 # Logging
 logger = logging.getLogger('client.webscraper')
 
+# Shared HTTP session, opened and closed by main.main()
+Session = session.SessionManager()
+Scheduler = scheduler.FetchScheduler(Session)
+
+# Parsing runs in worker processes, opened and closed by main.main()
+Parser = parsing.ParserPool()
+
+# Shared quote cache, so users tracking the same product share one fetch
+Quotes = cache.QuoteCache(settings.QUOTE_CACHE_TTL, settings.QUOTE_CACHE_SIZE)
+
+# Validators and fingerprints of the scraped pages, skips parsing unchanged products
+Changes = cache.ChangeTracker(settings.QUOTE_CACHE_SIZE)
+
 
 def chunks(l, n):
     """Yield successive n-sized chunks from l."""
@@ -25,205 +41,260 @@ def parseProductData(data):
     return data_paged
 
 
-async def isValidIsin(isin, allow_redirects=False):
-    # Checks if a product is valid
-    # Checks wether it's an actual ISIN. Starts with DE, NL OR NLING and has 7 numbers
-    try:
-        # https://regex101.com/r/xxPxLe/1
-        isin = re.search(r"(?i)((nl|de)[0-9, A-Z]{10})", isin).group(0)
-    except AttributeError:
-        return False
-
-    url = 'https://www.ingmarkets.nl/producten/' + isin
-
-    async with aiohttp.ClientSession() as session:
-        async with session.get(url, allow_redirects=allow_redirects) as response:
-            status = response.status
-
-    if status != 404:  # 200 or 302
-        return True
-
-    return False
-
-
-async def fetchURL(session, url, requested_format, allow_redirects=False):
-
-    # --- ING Markets disclaimer bypass (real fix) ---
-    if "ingmarkets.nl/producten" in url:
-        await session.post(
-            "https://www.ingmarkets.nl/disclaimer",
-            data={"redirect": url}
-        )
+async def fetchPage(
+        url, requested_format, allow_redirects=False, headers=None, on_response=None, stream=None, provider=None):
+    # Returns (status, body), raises scheduler.FetchError when the page could not be fetched after retrying.
+    # provider is the providers.Provider of the url, for its limits, disclaimer and such.
+    if not metrics.ENABLED:
+        return await requestPage(url, requested_format, allow_redirects, headers, on_response, stream, provider)
 
+    started = time.perf_counter()
+    status = "error"
     try:
-        async with session.get(url, allow_redirects=True) as response:
-            if requested_format in ("text", "html"):
-                return await response.text()
-            elif requested_format == "json":
-                return await response.json()
-            elif requested_format == "bytes":
-                return await response.read()
-            else:
-                raise ValueError(f"Unknown requested_format: {requested_format}")
+        status, body = await requestPage(url, requested_format, allow_redirects, headers, on_response, stream, provider)
+        if isinstance(body, parsing.PageStream):
+            metrics.FETCH_BYTES.inc(amount=body.bytes)
+        elif isinstance(body, str):
+            metrics.FETCH_BYTES.inc(amount=len(body.encode("utf-8")))
+        elif isinstance(body, bytes):
+            metrics.FETCH_BYTES.inc(amount=len(body))
+        return status, body
+    finally:
+        metrics.FETCH_SECONDS.observe(time.perf_counter() - started, str(status))
+
+
+async def requestPage(url, requested_format, allow_redirects, headers, on_response, stream, provider):
+    # The request of fetchPage. When the provider gets a page in between (providers.Interstitial,
+    # e.g. ING's disclaimer) it is prepared again and the request is repeated once.
+    # A second one raises scheduler.FetchError, the page in between is never returned.
+    def check_response(response):
+        if provider is not None:
+            provider.on_response(response, Session)
+        if on_response is not None:
+            on_response(response)
+
+    for attempt in range(2):
+        if provider is not None:
+            await provider.prepare(Session)
+        try:
+            return await Scheduler.request(
+                url, requested_format, allow_redirects=allow_redirects, on_response=check_response, headers=headers,
+                stream=stream, provider=provider)
+        except providers.Interstitial as e:
+            logger.debug("Got %s instead of %s" % (e, url))
+            reason = "redirected to {}".format(e)
+    raise scheduler.FetchError(url, reason)
+
+
+async def resolveProduct(text):
+    # Validate and scrape a product with a single page fetch.
+    # Returns (isin, valid, data):
+    #   valid is True, False or None when the provider could not be reached
+    #   data is the parsed quote, or None when the product is invalid or has ended
+    # The result seeds the quote cache, so the next List does not fetch again.
+    isin = providers.find_isin(text)
+    if isin is None:
+        return text, False, None
+
+    entry = Quotes.get(isin)
+    if entry is not None:
+        return isin, True, entry[2] if entry[1] else None
+
+    provider = providers.route(isin)
+    try:
+        if provider.bulk_size:
+            quotes = await fetchMany(provider, [isin])
+            if isin not in quotes:
+                return isin, False, None
+            available, data = quotes[isin]
+        else:
+            status, page, etag, last_modified = await fetchProduct(isin, provider)
+            if status == 404:
+                return isin, False, None
+
+            available, data = await parseProduct(isin, status, page, etag, last_modified, provider)
+    except (scheduler.FetchError, parsing.ParseTimeout):
+        return isin, None, None
+
+    Quotes.put(isin, available, data)
+    return isin, True, data if available else None
+
+
+async def resolveProducts(isin_list, progress=None):
+    # resolveProduct for many ISINs through the bounded scheduler, in the order of isin_list.
+    # progress(done, total) is called after every product.
+    # Products of bulk providers are fetched in bulk first, then resolved from the quote cache.
+    bulk = [isin for isin in isin_list if (providers.route(isin) or providers.Default).bulk_size]
+    if bulk:
+        await getProductDataHTML(bulk)
+
+    done = 0
+
+    async def resolve(isin):
+        nonlocal done
+        try:
+            return await resolveProduct(isin)
+        finally:
+            done += 1
+            if progress is not None:
+                progress(done, len(isin_list))
+
+    results = await Scheduler.gather([resolve(isin) for isin in isin_list])
+    return [
+        (isin, None, None) if isinstance(result, Exception) else result
+        for isin, result in zip(isin_list, results)
+    ]
 
-    except Exception as e:
-        print(f"Error fetching URL {url}: {e}")
-        return None
 
 async def getProductDataHTML(isin_list):
-    tasks = []
+    # Returns (available, unavailable, failed).
+    # Failed products could not be fetched right now and are not marked as ended.
+    # Served from the quote cache; only missing or expired ISINs are scraped.
+    return await Quotes.get_many(isin_list, scrapeProductData)
+
+
+async def fetchProduct(isin, provider=None):
+    # Conditional GET of a product page of a page provider.
+    # Returns (status, page, etag, last_modified), status 304 when the page did not change.
+    # The page is the html, or a parsing.PageStream with FETCH_STREAMING.
+    provider = provider or providers.route(isin)
+    validators = {}
+
+    def remember(response):
+        validators["etag"] = response.headers.get("ETag")
+        validators["last_modified"] = response.headers.get("Last-Modified")
+
+    url = provider.product_url(isin)
+    started = time.perf_counter()
+    if settings.FETCH_STREAMING and provider.stream is not None:
+        status, page = await fetchPage(
+            url, "stream", allow_redirects=True, headers=Changes.headers(isin), on_response=remember,
+            stream=lambda: provider.stream(isin), provider=provider)
+    else:
+        status, page = await fetchPage(
+            url, "html", allow_redirects=True, headers=Changes.headers(isin), on_response=remember,
+            provider=provider)
+    reportPage(isin, status, page, time.perf_counter() - started)
+    return status, page, validators.get("etag"), validators.get("last_modified")
+
+
+def reportPage(isin, status, page, elapsed):
+    # Bytes read and the time until the fields were available, to compare streaming with full reads.
+    # "stream_eof" pages were streamed, but the fields were not found before the end of the page.
+    if status != 200 or not (metrics.ENABLED or logger.isEnabledFor(logging.DEBUG)):
+        return
+    if isinstance(page, parsing.PageStream):
+        mode = "stream" if page.complete else "stream_eof"
+        size = page.bytes
+    else:
+        mode = "full"
+        size = len(page.encode("utf-8")) if page else 0
+
+    if metrics.ENABLED:
+        metrics.FETCH_PAGE_BYTES.observe(size, mode)
+        metrics.FETCH_FIELDS_SECONDS.observe(elapsed, mode)
+    logger.debug("Fetched %s: %d bytes, fields after %.1f ms (%s)" % (isin, size, elapsed * 1000, mode))
+
+
+async def parseProduct(isin, status, page, etag, last_modified, provider=None):
+    # Returns (available, data) of a page from fetchProduct.
+    # Unchanged pages return the result of the last parse without parsing again.
+    provider = provider or providers.route(isin)
+    previous = Changes.get(isin)
+
+    if status == 304:
+        if previous is None:
+            # Forgotten while the request was running
+            raise scheduler.FetchError(isin, "not modified, no previous page")
+        return Changes.touch(isin, not_modified=True)
+
+    # A streamed page is parsed again from what was read, in the parser pool like any other page
+    html = page.html if isinstance(page, parsing.PageStream) else page
+    fingerprint = parsing.performance_fingerprint(html)
+    if previous is not None and fingerprint is not None and fingerprint == previous.fingerprint:
+        return Changes.touch(isin)
+
+    result = await Parser.parse(isin, html, provider.parser)
+    Changes.put(isin, etag, last_modified, fingerprint, result)
+    return result
+
+
+async def fetchMany(provider, isin_list):
+    # One request of a bulk provider, returns {isin: (available, data)}
+    quotes = await provider.fetch_many(isin_list, Scheduler)
+    for isin, result in quotes.items():
+        Changes.put(isin, None, None, None, result)
+    return quotes
+
+
+async def scrapeProductData(isin_list):
+    # Scrape the products without consulting the cache.
+    # The ISINs are grouped by provider: page providers get a request per product,
+    # bulk providers one per bulk_size products.
+    # Pages that did not change since the last scrape are not parsed again.
     results = []
     results_unavailable = []
+    results_failed = []
+
+    def collect(available, data):
+        if available:
+            results.append(data)
+        else:
+            results_unavailable.append(data)
+
+    page_isins = []
+    bulk = []  # (provider, isin_list) per bulk request
+    for provider, isins in providers.group(isin_list).items():
+        if provider is None:
+            results_failed += [{"Isin": isin, "Error": "no provider"} for isin in isins]
+        elif provider.bulk_size:
+            bulk += [(provider, chunk) for chunk in chunks(isins, provider.bulk_size)]
+        else:
+            page_isins += isins
+
+    # Asynchronically get HTML pages and bulk quotes through the bounded scheduler
+    tasks = [fetchProduct(isin) for isin in page_isins]
+    tasks += [fetchMany(provider, chunk) for provider, chunk in bulk]
+
+    responses = await Scheduler.gather(tasks)
+    pages = responses[:len(page_isins)]
+
+    # Parse the pages in the parser pool, in parallel
+    async def iterations(isin, value):
+        if isinstance(value, parsing.ParseTimeout):
+            # A streamed page whose incremental parse took too long
+            logger.warning("Parsing %s timed out" % isin)
+            results_failed.append({"Isin": isin, "Error": "parse timeout"})
+            return
+        if isinstance(value, Exception):
+            results_failed.append({"Isin": isin, "Error": str(value)})
+            return
 
-    # Asynchronically get HTML pages
-    async with aiohttp.ClientSession() as session:
-
-        # --- ING Markets disclaimer bypass (correct placement) ---
-        session.cookie_jar.update_cookies(
-            {"disclaimer": "true"},
-            response_url=URL("https://www.ingmarkets.nl/")
-        )
-
-        # --- Schedule parallel fetches ---
-        for value in isin_list:
-            url = f"https://www.ingmarkets.nl/producten/{value}"
-            tasks.append(fetchURL(session, url, "html", allow_redirects=True))
-
-        htmls = await asyncio.gather(*tasks)
-
-    # Asynchronically scrape data
-    async def iterations(index, value):
-        temp_unavailable = {}
-        soup = BeautifulSoup(value, 'lxml')
         try:
-            name = []
-            # Find name
-            for h1_tag in soup.find_all('h1'):
-                name.append(h1_tag.get_text(strip=True))
-            product_name = name[-1]
-            # Unknown if this still works
-            if "Beëindigd" in name:
-                temp_unavailable["Isin"] = isin_list[index]
-                temp_unavailable["Ended"] = 1
-                results_unavailable.append(temp_unavailable)
-                return
-        except (IndexError, TypeError, KeyError, AttributeError) as e:
-            temp_unavailable["Isin"] = isin_list[index]
-            temp_unavailable["Ended"] = 1
-            results_unavailable.append(temp_unavailable)
+            available, data = await parseProduct(isin, *value)
+        except parsing.ParseTimeout:
+            logger.warning("Parsing %s timed out" % isin)
+            results_failed.append({"Isin": isin, "Error": "parse timeout"})
+            return
+        except scheduler.FetchError as e:
+            results_failed.append({"Isin": isin, "Error": str(e)})
             return
 
-        dt = soup.find('dt', string=lambda txt: txt and 'Onderliggende' in txt)
-        if dt:
-            dd = dt.find_next_sibling('dd')
-            product_name = dd.get_text(strip=True) if dd else None
-
-        dt = soup.find('dt', string=lambda txt: txt and 'Onderliggende' in txt)
-        if dt:
-            dd = dt.find_next_sibling('dd')
-            a = dd.find('a') if dd else None
-            market_url = a['href'] if a and a.has_attr('href') else None
-
-
-        dt = soup.find('dt', string=lambda txt: txt and 'Positie' in txt)
-        if dt:
-            dd = dt.find_next_sibling('dd')
-            product_type = dd.get_text(strip=True) if dd else None
-
-        perf_data = extract_performance_block(soup)
-        temp_dict = {}
-        temp_dict["Title"] = product_name
-        temp_dict["Market"] = market_url
-        temp_dict["Isin"] = isin_list[index]
-        temp_dict["Bid"] = perf_data.get("Bid")
-        temp_dict["Ask"] = perf_data.get("Ask")
-        temp_dict["Day"] = perf_data.get("Day")
-        temp_dict["Lever"] = perf_data.get("Lever")
-        temp_dict["Stoploss"] = perf_data.get("Stoploss")
-        temp_dict["Stoploss_dist"] = perf_data.get("Stoploss_distance")
-        temp_dict["Reference"] = perf_data.get("Reference")
-        temp_dict["Type"] = product_type
-        temp_dict["Ended"] = 0
-
-        results.append(temp_dict)
-
-    coros = [iterations(index, value) for index, value in enumerate(htmls)]
+        collect(available, data)
+
+    coros = [iterations(isin, value) for isin, value in zip(page_isins, pages)]
     await asyncio.gather(*coros)
 
-    return results, results_unavailable
-
-def extract_performance_block(soup):
-    perf = soup.find("div", {"aria-label": "Performance"})
-    if not perf:
-        logger.debug("[extract_performance_block] No <aria-label Performance> found")
-        return {}
-
-    def get_dt_dd(perf, label):
-        # Find <dt> that starts with the label, ignoring nested spans
-        for dt in perf.find_all("dt"):
-            # Extract only the text nodes, ignoring spans
-            dt_text = "".join(dt.find_all(string=True, recursive=False)).strip()
-            if label in dt_text:
-                dd = dt.find_next("dd")
-                if not dd:
-                    return None
-
-                val = dd.find("span", class_="value")
-                if not val:
-                    val = dd.find("span", class_=lambda c: c and "value" in c)
-
-                return val.text.strip() if val else None
-
-        return None
-
-    # Raw values
-    raw_day = get_dt_dd(perf, "% 1 Dag")
-    raw_bid = get_dt_dd(perf, "Bied")
-    raw_ask = get_dt_dd(perf, "Laat")
-    raw_lever = get_dt_dd(perf, "Hefboom")
-    raw_stoploss = get_dt_dd(perf, "Stop-loss niveau")
-    raw_dist = get_dt_dd(perf, "Afstand tot stop loss-niveau")
-    raw_reference = get_dt_dd(perf, "Referentiekoers")
-
-
-    # Convert fractional → percentage and format with 2 decimals
-    def fmt_percent(raw):
-        if raw is None:
-            return None
-        cleaned = (
-            str(raw)
-            .replace(",", ".")
-            .replace("%", "")
-        )
-        try:
-            return f"{float(cleaned):.2f}"
-        except ValueError:
-            return None
-
-    # Format plain numeric values with 2 decimals
-    def fmt_number(raw):
-        if raw is None:
-            return None
-        s = str(raw)
-        # Normalize formatting
-        s = s.replace("\xa0", "")      # remove NBSP
-        s = s.replace("€", "")         # remove euro symbol
-        s = s.replace(" ", "")         # remove normal spaces
-        s = re.sub(r"\.(?=\d{3}(,|$))", "", s) # Remove thousands separators (dots before commas)
-        s = s.replace(",", ".") # Convert decimal comma → dot
-        s = re.sub(r"[^0-9.\-]", "", s) # Strip everything except digits, dot, minus
+    for (provider, chunk), quotes in zip(bulk, responses[len(page_isins):]):
+        for isin in chunk:
+            if isinstance(quotes, Exception):
+                results_failed.append({"Isin": isin, "Error": str(quotes)})
+            elif isin not in quotes:
+                results_failed.append({"Isin": isin, "Error": "missing from %s" % provider.name})
+            else:
+                collect(*quotes[isin])
 
-        try:
-            return f"{float(s):.2f}"
-        except ValueError:
-            return None
-
-    return {
-        "Bid": fmt_number(raw_bid),
-        "Ask": fmt_number(raw_ask),
-        "Day": fmt_percent(raw_day),                     # % 1 Dag
-        "Lever": fmt_number(raw_lever),                  # Hefboom
-        "Stoploss": fmt_number(raw_stoploss),            # Stop-loss niveau
-        "Stoploss_distance": fmt_percent(raw_dist),      # Afstand tot stop loss-niveau
-        "Reference": fmt_number(raw_reference),          # Referentiekoers*
-    }
+    if results_failed:
+        logger.warning("Could not fetch %d of %d products" % (len(results_failed), len(isin_list)))
+
+    return results, results_unavailable, results_failed
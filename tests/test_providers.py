@@ -0,0 +1,119 @@
+# Routing of mixed ING and fake ISINs through webscraper, without any network.
+# The fake provider answers XX ISINs in bulk, ING pages come from fetch_product below.
+#
+#   python -m pytest -q tests
+import asyncio
+
+import pytest
+
+import providers
+import settings
+import webscraper
+
+PAGE = """<!DOCTYPE html>
+<html lang="nl"><head><meta charset="utf-8"><title>Sprinter Long</title></head>
+<body><main>
+<h1>Sprinter Long ASML <span>{isin}</span></h1>
+<dl>
+  <dt>Onderliggende waarde</dt><dd><a href="/onderliggende-waarden/asml-holding">ASML Holding</a></dd>
+  <dt>Positie</dt><dd>Long</dd>
+</dl>
+<div aria-label="Performance"><dl>
+  <dt>Bied</dt><dd><span class="value">1.234,56</span></dd>
+  <dt>Laat</dt><dd><span class="value">1.235,06</span></dd>
+  <dt>% 1 Dag</dt><dd><span class="value">2,51 %</span></dd>
+  <dt>Hefboom</dt><dd><span class="value">4,12</span></dd>
+  <dt>Stop-loss niveau</dt><dd><span class="value">512,30</span></dd>
+  <dt>Afstand tot stop loss-niveau</dt><dd><span class="value">-18,40%</span></dd>
+  <dt>Referentiekoers*</dt><dd><span class="value">628,10</span></dd>
+</dl></div>
+</main></body></html>
+"""
+
+
+def nl(index):
+    return "NL%010d" % index
+
+
+def xx(index):
+    return "XX%010d" % index
+
+
+@pytest.fixture
+def fetched(monkeypatch):
+    # ING and fake enabled, ING pages served from PAGE. Returns the ISINs whose page was fetched.
+    fetched = []
+
+    async def fetch_product(isin, provider=None):
+        fetched.append(isin)
+        return 200, PAGE.format(isin=isin), None, None
+
+    monkeypatch.setattr(webscraper, "fetchProduct", fetch_product)
+    monkeypatch.setattr(settings, "PARSER_EXECUTOR", "thread")
+    monkeypatch.setattr(settings, "FAKE_PROVIDER_LATENCY", 0)
+    providers.enable(("ing", "fake"))
+    webscraper.Quotes.entries.clear()
+    webscraper.Changes.entries.clear()
+    yield fetched
+    webscraper.Parser._close()
+    providers.enable(settings.QUOTE_PROVIDERS)
+
+
+def provider(name):
+    return next(provider for provider in providers.Enabled if provider.name == name)
+
+
+def test_group(fetched):
+    groups = providers.group([nl(1), xx(1), "ZZ0000000001", nl(2), xx(2)])
+
+    assert groups == {provider("ing"): [nl(1), nl(2)], provider("fake"): [xx(1), xx(2)], None: ["ZZ0000000001"]}
+
+
+def test_scrape_mixed(fetched):
+    isin_list = [xx(index) for index in range(250)] + [nl(1), nl(2), "ZZ0000000001"]
+
+    available, unavailable, failed = asyncio.run(webscraper.scrapeProductData(isin_list))
+
+    # 250 fake ISINs in bulks of 100, the ING ISINs a page each
+    assert provider("fake").calls == 3
+    assert sorted(fetched) == [nl(1), nl(2)]
+    assert failed == [{"Isin": "ZZ0000000001", "Error": "no provider"}]
+    assert sorted(item["Isin"] for item in available + unavailable) == sorted(isin_list[:-1])
+    assert {item["Isin"]: item["Title"] for item in available if item["Isin"].startswith("NL")} == {
+        nl(1): "ASML Holding", nl(2): "ASML Holding"}
+
+
+def test_bulk_size(fetched, monkeypatch):
+    monkeypatch.setattr(provider("fake"), "bulk_size", 7)
+
+    available, unavailable, failed = asyncio.run(webscraper.scrapeProductData([xx(index) for index in range(20)]))
+
+    assert provider("fake").calls == 3
+    assert len(available) + len(unavailable) == 20
+    assert not failed and not fetched
+
+
+def test_resolve(fetched):
+    async def resolve():
+        return [await webscraper.resolveProduct(text) for text in (xx(1), "Track " + nl(1), xx(1))]
+
+    (fake_isin, fake_valid, _), (ing_isin, ing_valid, ing_data), again = asyncio.run(resolve())
+
+    assert (fake_isin, fake_valid) == (xx(1), True)
+    assert (ing_isin, ing_valid, ing_data["Isin"]) == (nl(1), True, nl(1))
+    # The second resolve of the fake ISIN comes from the quote cache
+    assert again[:2] == (xx(1), True)
+    assert provider("fake").calls == 1
+    assert fetched == [nl(1)]
+
+
+def test_no_provider(fetched):
+    providers.enable(("fake",))
+
+    available, unavailable, failed = asyncio.run(webscraper.scrapeProductData([nl(1), xx(1)]))
+
+    assert failed == [{"Isin": nl(1), "Error": "no provider"}]
+    assert [item["Isin"] for item in available + unavailable] == [xx(1)]
+    assert not fetched
+    # Without a provider an ISIN is not recognised at all
+    assert asyncio.run(webscraper.resolveProduct(nl(1))) == (nl(1), False, None)
@@ -0,0 +1,26 @@
+# Every query in db.HOT_QUERIES must be served from an index, see benchmarks/query_plans.py
+import asyncio
+import os
+import sys
+
+import pytest
+
+import db
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'benchmarks'))
+
+import query_plans  # noqa: E402
+
+
+@pytest.mark.parametrize("name", list(db.HOT_QUERIES))
+def test_hot_query_uses_index(name, tmp_path):
+    async def check():
+        database = db.Database(str(tmp_path))
+        await database._init()
+        try:
+            await database.create_database()
+            return await query_plans.check_plans(database, {name: db.HOT_QUERIES[name]})
+        finally:
+            await database._close()
+
+    assert asyncio.run(check()) == 0